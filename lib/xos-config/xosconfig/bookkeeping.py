@@ -0,0 +1,7 @@
+# Fields of XOSBase that the synchronizers and the policy engine write to
+# record their progress on an object. They are written through
+# UpdateBookkeeping, and changes to them alone do not make an object dirty.
+# Shared by the core API, the client ORM and the synchronizers, so that all
+# of them agree on the list.
+BOOKKEEPING_FIELDS = ["enacted", "policed", "backend_status", "backend_register",
+                      "backend_need_delete", "backend_need_reap", "policy_status"]
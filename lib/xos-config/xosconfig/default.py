@@ -24,5 +24,17 @@ DEFAULT_VALUES = {
     },
     'node_key': '/opt/cord_profile/node_key',
     'config_dir': '/etc/xos/sync',
-    'backoff_disabled': True
+    'backoff_disabled': True,
+    'step_pool_size': 10,
+    'policy_pool_size': 1,
+    'policy_reconcile_interval': 60,
+    'playbook_cache_size': 1000,
+    'full_scan_interval': 300,
+    'auth_cache_size': 1000,
+    'auth_cache_ttl': 60,
+    'orm_cache_size': 0,
+    'orm_cache_ttl': 30,
+    'grpc': {
+        'workers': 10
+    }
 }
@@ -21,6 +21,18 @@ class XProtoProtobufGeneratorTest(unittest.TestCase):
         links = filter(lambda s:'Key(' in s, output.splitlines())
         self.assertEqual(len(links), 2)
 
+    def test_sync_indexes(self):
+        """
+        [XOS-GenX] Generate DJANGO models, verify the synchronizer's composite indexes
+        """
+        args = FakeArgs()
+        args.files = [VROUTER_XPROTO]
+        args.target = 'django.xtarget'
+        output = XOSGenerator.generate(args)
+
+        self.assertIn("class Meta(XOSBase.Meta):", output)
+        self.assertIn("index_together = (('updated', 'enacted'), ('updated', 'policed'))", output)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,3 +1,4 @@
+import os
 import unittest
 from xosgenx.generator import XOSGenerator
 from helpers import FakeArgs, XProtoTestHelpers
@@ -198,5 +199,305 @@ class XProtoSecurityTest(unittest.TestCase):
         """
         exec(output)
 
+class FakeQ(object):
+    """ Stands in for django.db.models.Q, recording the query as a tuple """
+    def __init__(self, expr=None, **kwargs):
+        self.expr = expr or ('Q', sorted(kwargs.items()))
+
+    def __and__(self, other):
+        return FakeQ(('&', self.expr, other.expr))
+
+    def __or__(self, other):
+        return FakeQ(('|', self.expr, other.expr))
+
+    def __invert__(self):
+        return FakeQ(('~', self.expr))
+
+class FakeQuerySet(object):
+    def __init__(self, q):
+        self.q = q
+
+    def values_list(self, field, flat=False):
+        return ('values_list', self.q.expr, field)
+
+class FakeManager(object):
+    def filter(self, q):
+        return FakeQuerySet(q)
+
+class Privilege(object):
+    objects = FakeManager()
+
+ALL = ('~', ('Q', [('pk__in', [])]))
+
+"""
+The tests below generate queryset filters from security policies and run
+them against a fake Q, checking the query that results.
+"""
+class XProtoSecurityFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.target = XProtoTestHelpers.write_tmp_target("""
+{% for name, policy in proto.policies.items() %}
+{{ xproto_fol_to_python_filter(name, policy, None, proto.policies) }}
+{% endfor %}
+""")
+
+    def generate(self, xproto):
+        """ Generate the filters for xproto, returning them by name """
+        args = FakeArgs()
+        args.inputs = xproto
+        args.target = self.target
+        output = XOSGenerator.generate(args)
+
+        filters = {"Q": FakeQ, "Privilege": Privilege}
+        exec output in filters
+        return filters
+
+    def make_ctx(self, is_admin=False, id=5):
+        ctx = FakeArgs()
+        ctx.user = FakeArgs()
+        ctx.user.is_admin = is_admin
+        ctx.user.id = id
+        return ctx
+
+    def test_constant_side(self):
+        xproto = \
+"""
+    policy output < ctx.user.is_admin | obj.owner.id = ctx.user.id >
+"""
+        filters = self.generate(xproto)
+
+        self.assertEqual(filters["output_security_filter"](self.make_ctx(is_admin=True)).expr, ALL)
+        self.assertEqual(filters["output_security_filter"](self.make_ctx()).expr, ('Q', [('owner__id', 5)]))
+
+    def test_call_policy(self):
+        xproto = \
+"""
+    policy sub_policy < ctx.user.id = obj.user.id >
+    policy output < *sub_policy(child) >
+"""
+        filters = self.generate(xproto)
+
+        self.assertEqual(filters["output_security_filter"](self.make_ctx()).expr, ('Q', [('child__user__id', 5)]))
+
+    def test_exists(self):
+        xproto = \
+"""
+    policy output < exists Privilege: (Privilege.accessor_id = ctx.user.id & Privilege.object_id = obj.id) >
+"""
+        filters = self.generate(xproto)
+
+        subquery = ('values_list', ('Q', [('accessor_id', 5)]), 'object_id')
+        self.assertEqual(filters["output_security_filter"](self.make_ctx()).expr, ('Q', [('id__in', subquery)]))
+
+    def test_not_handled(self):
+        xproto = \
+"""
+    policy sub_policy < {{ obj.user in ctx.users }} >
+    policy output < ctx.user.is_admin | *sub_policy(child) >
+"""
+        filters = self.generate(xproto)
+
+        # these can only be checked one object at a time
+        self.assertEqual(filters["sub_policy_security_filter"](self.make_ctx()), None)
+        self.assertEqual(filters["output_security_filter"](self.make_ctx()), None)
+
+class MemoContext(FakeArgs):
+    """ A security context that memoizes, like the one the API server uses """
+    def __init__(self):
+        self.memo = {}
+        self.user_privileges = None
+
+    def memoize(self, key, fn):
+        if key not in self.memo:
+            self.memo[key] = fn()
+        return self.memo[key]
+
+"""
+The tests below check that generated security checks reuse results through
+the memo of the security context.
+"""
+class XProtoSecurityMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.target = XProtoTestHelpers.write_tmp_target("""
+{% for name, policy in proto.policies.items() %}
+{{ xproto_fol_to_python_test(name, policy, None, '0') }}
+{% endfor %}
+""")
+
+    def generate(self, xproto, names):
+        args = FakeArgs()
+        args.inputs = xproto
+        args.target = self.target
+        output = XOSGenerator.generate(args)
+
+        checks = dict(names)
+        exec output in checks
+        return checks
+
+    def test_memoize_policy_call(self):
+        xproto = \
+"""
+    policy sub_policy < {{ record(obj) }} >
+    policy output < *sub_policy(child) >
+"""
+        calls = []
+        def record(obj):
+            calls.append(obj)
+            return True
+
+        checks = self.generate(xproto, {"record": record})
+
+        child = FakeArgs()
+        objs = [FakeArgs(), FakeArgs()]
+        for obj in objs:
+            obj.child = child
+
+        ctx = MemoContext()
+        for obj in objs:
+            self.assertTrue(checks["output_security_check"](obj, ctx))
+        self.assertEqual(calls, [child])
+
+        # without a memo, each check evaluates the sub-policy
+        for obj in objs:
+            self.assertTrue(checks["output_security_check"](obj, FakeArgs()))
+        self.assertEqual(len(calls), 3)
+
+    def test_preloaded_privileges(self):
+        xproto = \
+"""
+    policy output < exists Privilege: (Privilege.accessor_id = ctx.user.id & Privilege.object_id = obj.id) >
+"""
+        # Privilege.objects must not be used once privileges are preloaded
+        checks = self.generate(xproto, {"Privilege": None})
+
+        privilege = FakeArgs()
+        privilege.accessor_id = 5
+        privilege.object_id = 7
+
+        ctx = MemoContext()
+        ctx.user = FakeArgs()
+        ctx.user.id = 5
+        ctx.user_privileges = [privilege]
+
+        obj = FakeArgs()
+        obj.id = 7
+        self.assertTrue(checks["output_security_check"](obj, ctx))
+        obj = FakeArgs()
+        obj.id = 8
+        self.assertFalse(checks["output_security_check"](obj, ctx))
+
+CORE_XPROTO = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../../../xos/core/models/core.xproto")
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class EvalQ(object):
+    """ Stands in for django.db.models.Q, evaluating the query on a Row """
+    def __init__(self, match=None, **kwargs):
+        self.match = match or (lambda row: all(self.lookup(row, k, v) for (k, v) in kwargs.items()))
+
+    @staticmethod
+    def lookup(row, key, value):
+        path = key.split('__')
+        in_lookup = (path[-1] == 'in')
+        if in_lookup:
+            path = path[:-1]
+        for field in path:
+            row = getattr(row, 'id' if field == 'pk' else field)
+        if in_lookup:
+            return row in list(value)
+        return row == value
+
+    def __and__(self, other):
+        return EvalQ(lambda row: self.match(row) and other.match(row))
+
+    def __or__(self, other):
+        return EvalQ(lambda row: self.match(row) or other.match(row))
+
+    def __invert__(self):
+        return EvalQ(lambda row: not self.match(row))
+
+class EvalManager(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, *qs):
+        return EvalQuerySet([row for row in self.rows if all(q.match(row) for q in qs)])
+
+class EvalQuerySet(list):
+    def values_list(self, field, flat=False):
+        return [getattr(row, field) for row in self]
+
+"""
+The tests below generate the checks and filters of the core policies and
+evaluate both over a set of rows, checking that the filter selects exactly
+the rows that the check accepts.
+"""
+class XProtoCorePolicyFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.target = XProtoTestHelpers.write_tmp_target("""
+{% for name, policy in proto.policies.items() %}
+{% if name in ['site_policy', 'slice_policy', 'service_policy'] %}
+{{ xproto_fol_to_python_test(name, policy, None, '0') }}
+{{ xproto_fol_to_python_filter(name, policy, None, proto.policies) }}
+{% endif %}
+{% endfor %}
+""")
+
+        self.sites = [Row(id=1), Row(id=2)]
+        self.slices = [Row(id=10 + i, site=site, creator=Row(id=creator))
+                       for (i, (site, creator)) in enumerate([(self.sites[0], 5), (self.sites[0], 6),
+                                                              (self.sites[1], 6), (self.sites[1], 7)])]
+        self.services = [Row(id=20), Row(id=21)]
+
+        def privilege(object_type, object_id, permission, accessor_id=5):
+            return Row(accessor_id=accessor_id, accessor_type="User", object_type=object_type,
+                       object_id=object_id, permission=permission)
+
+        privileges = [privilege("Site", 1, "role:admin"),
+                      privilege("Site", 2, "role:user"),
+                      privilege("Slice", 12, "role:admin"),
+                      privilege("Slice", 13, "role:user"),
+                      privilege("Slice", 11, "role:admin", accessor_id=6),
+                      privilege("Service", 20, "role:user")]
+
+        args = FakeArgs()
+        args.inputs = open(CORE_XPROTO).read()
+        args.target = self.target
+        output = XOSGenerator.generate(args)
+
+        self.policies = {"Q": EvalQ, "Privilege": Row(objects=EvalManager(privileges))}
+        exec output in self.policies
+
+    def make_ctx(self, is_admin, write_access, id=5):
+        ctx = FakeArgs()
+        ctx.user = Row(id=id, is_admin=is_admin)
+        ctx.write_access = write_access
+        return ctx
+
+    def check_rows(self, policy, rows):
+        check = self.policies[policy + "_security_check"]
+        security_filter = self.policies[policy + "_security_filter"]
+
+        for is_admin in [False, True]:
+            for write_access in [False, True]:
+                for user_id in [5, 6, 8]:
+                    ctx = self.make_ctx(is_admin, write_access, user_id)
+                    q = security_filter(ctx)
+                    self.assertNotEqual(q, None)
+                    for row in rows:
+                        self.assertEqual(q.match(row), check(row, ctx),
+                                         "%s disagrees on row %d for %s" % (policy, row.id, ctx.user.__dict__))
+
+    def test_site_policy(self):
+        self.check_rows("site_policy", self.sites)
+
+    def test_slice_policy(self):
+        self.check_rows("slice_policy", self.slices)
+
+    def test_service_policy(self):
+        self.check_rows("service_policy", self.services)
+
 if __name__ == '__main__':
     unittest.main()
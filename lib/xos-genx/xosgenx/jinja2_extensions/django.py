@@ -143,6 +143,15 @@ def xproto_django_options_str(field, dport=None):
 
     return format_options_string(output_dict)
 
+def xproto_django_sync_indexes(m):
+    # Composite indexes backing the incremental fetch_pending and
+    # fetch_policies queries. The bookkeeping fields live in the table of
+    # the first concrete model below the abstract XOSBase.
+    if m['name']!='XOSBase' and 'XOSBase' in [b['name'] for b in m['bases']]:
+        return [['updated', 'enacted'], ['updated', 'policed']]
+    else:
+        return []
+
 def xproto_validations(options):
     try:
         return [map(str.strip, validation.split(':')) for validation in unquote(options['validators']).split(',')]
@@ -33,6 +33,10 @@ class AutoVariable:
 def gen_random_string():
     return ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(5))
 
+# Queries that match every row and no rows
+Q_ALL = '(~Q(pk__in=[]))'
+Q_NONE = 'Q(pk__in=[])'
+
 class FOL2Python:
     def __init__(self, context_map=None):
         # This will produce i0, i1, i2 etc.
@@ -42,6 +46,7 @@ class FOL2Python:
         self.loop_variable = self.loopvar.next()
         self.verdict_variable = self.verdictvar.next()
         self.context_map = context_map
+        self.filterable = {}
 
         if not self.context_map:
             self.context_map = {'user': 'self', 'obj': 'obj'}
@@ -224,6 +229,69 @@ class FOL2Python:
         else:
             raise ConstructNotHandled(k)
 
+    def is_free(self, var, fol):
+        """ Whether fol refers to fields of var outside a quantifier over var """
+        if isinstance(fol, str):
+            return fol.startswith(var + '.')
+        elif isinstance(fol, dict):
+            (k, v), = fol.items()
+            if k in QUANTS and v[0] == var:
+                return False
+            return self.is_free(var, v)
+        elif isinstance(fol, (list, tuple)):
+            return any(self.is_free(var, x) for x in fol)
+        else:
+            return False
+
+    def extend_scope(self, fol, k, rhs):
+        """ If the rightmost operand of fol is a quantifier over a variable
+            that rhs uses, return fol with (quantifier body k rhs) as that
+            quantifier's body. Otherwise return None.
+        """
+        try:
+            (k2, v), = fol.items()
+        except AttributeError:
+            return None
+
+        if k2 in QUANTS:
+            var, expr = v
+            if self.is_free(var, rhs):
+                return {k2: [var, {k: [expr, rhs]}]}
+        elif k2 == 'not':
+            extended = self.extend_scope(v, k, rhs)
+            if extended is not None:
+                return {'not': extended}
+        elif k2 in BINOPS:
+            lhs, last = v
+            extended = self.extend_scope(last, k, rhs)
+            if extended is not None:
+                return {k2: [lhs, extended]}
+        return None
+
+    """ The parser binds quantifiers tighter than binary operators, so
+        exists Privilege: A & B & C is read as (exists Privilege: A) & B & C,
+        leaving B and C outside the quantifier even though they refer to
+        Privilege. Move such operands back into the quantifier's body. """
+    def scope_quantifiers(self, fol):
+        try:
+            (k, v), = fol.items()
+        except AttributeError:
+            return fol
+
+        if k == 'not':
+            return {'not': self.scope_quantifiers(v)}
+        elif k in BINOPS:
+            lhs, rhs = [self.scope_quantifiers(x) for x in v]
+            extended = self.extend_scope(lhs, k, rhs)
+            if extended is not None:
+                return extended
+            return {k: [lhs, rhs]}
+        elif k in QUANTS:
+            var, expr = v
+            return {k: [var, self.scope_quantifiers(expr)]}
+        else:
+            return fol
+
     """ Hoist constants out of quantifiers. Depth-first. """
     def hoist_outer(self, fol):
         try:
@@ -438,6 +506,246 @@ def %(fn_name)s(obj, ctx):
 
         return function_ast
 
+    def gen_filter_function(self, fol, policy_name, tag, policies=None):
+        policy_function_name_template = '%s_' + tag
+        policy_function_name = policy_function_name_template % policy_name
+
+        try:
+            kind, expr = self.gen_filter(policy_function_name_template, fol, 'obj', policies)
+            if kind == 'bool':
+                expr = '(%s if %s else %s)' % (Q_ALL, expr, Q_NONE)
+        except (ConstructNotHandled, PolicyException):
+            # Can't be expressed as a query, callers check each row instead
+            expr = 'None'
+
+        function_str = """
+def %(fn_name)s(ctx, prefix=''):
+    return %(expr)s
+        """ % {'fn_name': policy_function_name, 'expr': expr}
+
+        return self.str_to_ast(function_str)
+
+    def can_filter(self, policy_name, policies):
+        """ Whether the filter function of policy_name returns a query """
+        if policy_name in self.filterable:
+            return self.filterable[policy_name]
+
+        if (not policies) or (policy_name not in policies):
+            return False
+
+        # guard against policies that call each other
+        self.filterable[policy_name] = False
+        try:
+            fol = self.hoist_outer(self.scope_quantifiers(policies[policy_name]))
+            self.gen_filter('%s', fol, 'obj', policies)
+            self.filterable[policy_name] = True
+        except (ConstructNotHandled, PolicyException):
+            pass
+
+        return self.filterable[policy_name]
+
+    def filter_term(self, term, var):
+        """ Classify a term as ('field', lookup) if it is a field of var,
+            ('outer', lookup) if it is a field of obj inside a quantifier
+            over var, or ('value', expr) if it does not depend on the row.
+        """
+        if not isinstance(term, str):
+            raise ConstructNotHandled(term)
+
+        if term.startswith(var + '.'):
+            return ('field', term[len(var) + 1:].replace('.', '__'))
+        elif term.startswith('obj.'):
+            return ('outer', term[len('obj.'):].replace('.', '__'))
+        elif term.startswith('ctx.') or term in ['True', 'False', 'None'] or term[0] in ['"', "'"]:
+            return ('value', term)
+
+        try:
+            float(term)
+            return ('value', term)
+        except ValueError:
+            raise ConstructNotHandled(term)
+
+    def filter_key(self, var, lookup):
+        if var == 'obj':
+            return 'prefix + %r' % lookup
+        else:
+            return '%r' % lookup
+
+    def filter_conjuncts(self, fol):
+        try:
+            (k, v), = fol.items()
+        except AttributeError:
+            return [fol]
+
+        if k == '&':
+            lhs, rhs = v
+            return self.filter_conjuncts(lhs) + self.filter_conjuncts(rhs)
+        return [fol]
+
+    def gen_filter(self, fn_template, fol, var, policies=None):
+        """ Translate fol into a Python expression that builds a Django
+            query over var. Returns (kind, expr), where kind is 'q' if expr
+            evaluates to a Q object, or 'bool' if expr does not depend on
+            the row and evaluates to a boolean. Raises ConstructNotHandled
+            for anything that cannot be expressed as a query.
+        """
+        try:
+            (k, v), = fol.items()
+        except AttributeError:
+            k = 'term'
+            v = fol
+
+        if k == 'term':
+            kind, term = self.filter_term(v, var)
+            if kind != 'value':
+                # the truth value of a field is not well defined in SQL
+                raise ConstructNotHandled(v)
+            return ('bool', term)
+        elif k == 'python':
+            raise ConstructNotHandled(k)
+        elif k == 'policy':
+            policy_name, object_name = v
+            if var != 'obj' or not self.can_filter(policy_name, policies):
+                raise ConstructNotHandled(policy_name)
+            policy_fn = fn_template % policy_name
+            return ('q', '%s(ctx, prefix + %r)' % (policy_fn, object_name.replace('.', '__') + '__'))
+        elif k == 'not':
+            kind, expr = self.gen_filter(fn_template, v, var, policies)
+            if kind == 'bool':
+                return ('bool', '(not %s)' % expr)
+            return ('q', '(~%s)' % expr)
+        elif k in ['=', 'in']:
+            lhs, rhs = [self.filter_term(t, var) for t in v]
+
+            if lhs[0] == 'value' and rhs[0] == 'value':
+                operator = {'=': '==', 'in': 'in'}[k]
+                return ('bool', '(%s %s %s)' % (lhs[1], operator, rhs[1]))
+
+            if k == '=' and lhs[0] != 'field':
+                lhs, rhs = rhs, lhs
+            if lhs[0] != 'field' or rhs[0] == 'outer':
+                raise ConstructNotHandled(fol)
+
+            key = self.filter_key(var, lhs[1])
+            if k == 'in':
+                key = key + " + '__in'"
+            if rhs[0] == 'field':
+                value = 'F(%s)' % self.filter_key(var, rhs[1])
+            else:
+                value = rhs[1]
+            return ('q', 'Q(**{%s: %s})' % (key, value))
+        elif k in BINOPS:
+            lhs, rhs = v
+            lkind, lexpr = self.gen_filter(fn_template, lhs, var, policies)
+            rkind, rexpr = self.gen_filter(fn_template, rhs, var, policies)
+
+            if lkind == 'bool' and rkind == 'bool':
+                if k == '&':
+                    return ('bool', '(%s and %s)' % (lexpr, rexpr))
+                elif k == '|':
+                    return ('bool', '(%s or %s)' % (lexpr, rexpr))
+                else:
+                    return ('bool', '((not %s) or %s)' % (lexpr, rexpr))
+            elif lkind == 'bool':
+                # decide the row-independent side when the query is built
+                if k == '&':
+                    return ('q', '(%s if %s else %s)' % (rexpr, lexpr, Q_NONE))
+                elif k == '|':
+                    return ('q', '(%s if %s else %s)' % (Q_ALL, lexpr, rexpr))
+                else:
+                    return ('q', '(%s if %s else %s)' % (rexpr, lexpr, Q_ALL))
+            elif rkind == 'bool':
+                if k == '&':
+                    return ('q', '(%s if %s else %s)' % (lexpr, rexpr, Q_NONE))
+                elif k == '|':
+                    return ('q', '(%s if %s else %s)' % (Q_ALL, rexpr, lexpr))
+                else:
+                    return ('q', '(%s if %s else (~%s))' % (Q_ALL, rexpr, lexpr))
+            else:
+                if k == '&':
+                    return ('q', '(%s & %s)' % (lexpr, rexpr))
+                elif k == '|':
+                    return ('q', '(%s | %s)' % (lexpr, rexpr))
+                else:
+                    return ('q', '((~%s) | %s)' % (lexpr, rexpr))
+        elif k == 'exists':
+            model, expr = v
+            if var != 'obj' or not model.istitle():
+                raise ConstructNotHandled(k)
+
+            # Conjuncts that equate a field of model with a field of obj
+            # correlate the two. Only one is supported, as a subquery.
+            correlations = []
+            rest = []
+            for c in self.filter_conjuncts(expr):
+                try:
+                    (ck, cv), = c.items()
+                    terms = [self.filter_term(t, model) for t in cv]
+                    kinds = sorted([t[0] for t in terms])
+                except (AttributeError, ConstructNotHandled, ValueError):
+                    rest.append(c)
+                    continue
+                if ck == '=' and kinds == ['field', 'outer']:
+                    correlations.append(dict(terms))
+                else:
+                    rest.append(c)
+
+            if len(correlations) > 1:
+                raise ConstructNotHandled(fol)
+
+            if rest:
+                query = rest[0]
+                for c in rest[1:]:
+                    query = {'&': [query, c]}
+                kind, query_expr = self.gen_filter(fn_template, query, model, policies)
+                if kind == 'bool':
+                    query_expr = '(%s if %s else %s)' % (Q_ALL, query_expr, Q_NONE)
+            else:
+                query_expr = Q_ALL
+
+            if not correlations:
+                return ('bool', '%s.objects.filter(%s).exists()' % (model, query_expr))
+
+            correlation = correlations[0]
+            return ('q', 'Q(**{%s: %s.objects.filter(%s).values_list(%r, flat=True)})' % (
+                self.filter_key('obj', correlation['outer']) + " + '__in'", model, query_expr, correlation['field']))
+        else:
+            raise ConstructNotHandled(k)
+
+    def user_privilege_predicate(self, var, expr):
+        """ If expr is a conjunction of equalities that includes
+            Privilege.accessor_id = ctx.user.id, return it as a Python
+            expression over a Privilege __elt. Otherwise return None.
+        """
+        if var != 'Privilege':
+            return None
+
+        conditions = []
+        user_scoped = False
+        for c in self.filter_conjuncts(expr):
+            try:
+                (k, v), = c.items()
+                if k != '=':
+                    return None
+                terms = [self.filter_term(t, var) for t in v]
+            except (AttributeError, ConstructNotHandled, ValueError):
+                return None
+
+            operands = []
+            for ((kind, lookup), term) in zip(terms, v):
+                if kind == 'field':
+                    operands.append('__elt' + term[len(var):])
+                else:
+                    operands.append(term)
+            if sorted(operands) == ['__elt.accessor_id', 'ctx.user.id']:
+                user_scoped = True
+            conditions.append('(%s == %s)' % tuple(operands))
+
+        if not user_scoped:
+            return None
+
+        return '(%s)' % ' and '.join(conditions)
+
     def gen_test(self, fn_template, fol, verdict_var, bindings=None):
         if isinstance(fol, str):
             return self.str_to_ast('%(verdict_var)s = %(constant)s' % {'verdict_var': verdict_var, 'constant': fol})
@@ -448,8 +756,13 @@ def %(fn_name)s(obj, ctx):
             policy_name, object_name = v
 
             policy_fn = fn_template % policy_name
+            # Nested policies are often applied to the same object many
+            # times in a request, so reuse the verdict if ctx can memoize
             call_str = """
-%(verdict_var)s = %(policy_fn)s(obj.%(object_name)s, ctx)
+if hasattr(ctx, 'memoize'):
+    %(verdict_var)s = ctx.memoize(('%(policy_fn)s', obj.%(object_name)s), lambda: %(policy_fn)s(obj.%(object_name)s, ctx))
+else:
+    %(verdict_var)s = %(policy_fn)s(obj.%(object_name)s, ctx)
             """ % {'verdict_var': verdict_var, 'policy_fn': policy_fn, 'object_name': object_name}
 
             call_ast = self.str_to_ast(call_str)
@@ -577,9 +890,24 @@ def %(fn_name)s(obj, ctx):
                 f = self.fol_to_python_filter(var, expr, django=True)
                 entry = f.pop()
 
+                query_str = 'not not %(model)s.objects.filter(%(query)s)' % {'model': var, 'query': entry}
+
+                predicate = self.user_privilege_predicate(var, expr)
+                if predicate:
+                    # answer from the user's privileges if ctx preloaded them
+                    memo_str = '(any(%(predicate)s for __elt in ctx.user_privileges) if ctx.user_privileges is not None else %(query_str)s)' % \
+                               {'predicate': predicate, 'query_str': query_str}
+                else:
+                    memo_str = query_str
+
+                # The query depends only on obj and ctx, and ctx is fixed
+                # for the life of its memo
                 python_str = """
-%(verdict_var)s = not not %(model)s.objects.filter(%(query)s)
-                """ % {'verdict_var': verdict_var, 'model': var, 'query': entry}
+if hasattr(ctx, 'memoize'):
+    %(verdict_var)s = ctx.memoize((%(key)r, obj), lambda: %(memo_str)s)
+else:
+    %(verdict_var)s = %(query_str)s
+                """ % {'verdict_var': verdict_var, 'key': entry, 'memo_str': memo_str, 'query_str': query_str}
 
                 python_ast = ast.parse(python_str)
             else:
@@ -631,6 +959,7 @@ def xproto_fol_to_python_test(policy, fol, model, tag=None):
         raise Exception('Could not find policy:', policy)
 
     f2p = FOL2Python()
+    fol = f2p.scope_quantifiers(fol)
     fol_reduced = f2p.hoist_outer(fol)
 
     if fol_reduced in ['True','False'] and fol != fol_reduced:
@@ -640,11 +969,24 @@ def xproto_fol_to_python_test(policy, fol, model, tag=None):
 
     return astunparse.unparse(a)
 
+def xproto_fol_to_python_filter(policy, fol, model, policies=None, tag=None):
+    if isinstance(fol, jinja2.Undefined):
+        raise Exception('Could not find policy:', policy)
+
+    f2p = FOL2Python()
+    fol = f2p.scope_quantifiers(fol)
+    fol_reduced = f2p.hoist_outer(fol)
+
+    a = f2p.gen_filter_function(fol_reduced, policy, 'security_filter', policies)
+
+    return astunparse.unparse(a)
+
 def xproto_fol_to_python_validator(policy, fol, model, message, tag=None):
     if isinstance(fol, jinja2.Undefined):
         raise Exception('Could not find policy:', policy)
 
     f2p = FOL2Python()
+    fol = f2p.scope_quantifiers(fol)
     fol_reduced = f2p.hoist_outer(fol)
 
     if fol_reduced in ['True','False'] and fol != fol_reduced:
@@ -167,7 +167,7 @@ class User(AbstractBaseUser, PlModelMixIn):
 
     def __init__(self, *args, **kwargs):
         super(User, self).__init__(*args, **kwargs)
-        self._initial = self._dict  # for PlModelMixIn
+        self._reset_initial()  # for PlModelMixIn
         self.silent = False
 
     def isReadOnlyUser(self):
@@ -308,7 +308,7 @@ class User(AbstractBaseUser, PlModelMixIn):
 
         self.push_redis_event()
 
-        self._initial = self._dict
+        self._reset_initial()
 
     def send_temporary_password(self):
         password = User.objects.make_random_password()
@@ -355,6 +355,10 @@ class User(AbstractBaseUser, PlModelMixIn):
     def can_access(self, ctx):
         return security.user_policy_security_check(self, ctx), "user_policy"
 
+    @classmethod
+    def security_filter(cls, ctx):
+        return security.user_policy_security_filter(ctx)
+
 class UserDashboardView(XOSBase):
     user = models.ForeignKey(User, related_name='userdashboardviews')
     dashboardView = models.ForeignKey(
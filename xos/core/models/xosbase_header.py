@@ -0,0 +1 @@
+attic/xosbase_header.py
\ No newline at end of file
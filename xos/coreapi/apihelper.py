@@ -1,7 +1,15 @@
 import base64
+import collections
+import copy
 import datetime
+import hashlib
+import hmac
 import inspect
+import json
+import os
 import pytz
+import redis
+import threading
 import time
 from protos import xos_pb2
 from google.protobuf.empty_pb2 import Empty
@@ -9,99 +17,283 @@ import grpc
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import authenticate as django_authenticate
+from django.db import transaction
 from django.db.models import F,Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from core.models import *
 from xos.exceptions import *
 
 from importlib import import_module
 from django.conf import settings
+from xosconfig import Config
+from xosconfig.bookkeeping import BOOKKEEPING_FIELDS
+from xos.logger import Logger, logging
+logger = Logger(level=logging.INFO)
+
+# Rows read from the database at a time when paginating or streaming
+QUERY_CHUNK_SIZE = 500
+
+# Per-model tables used by objToProto, filled in on first use
+field_converters = {}
+reverse_relations = {}
 
 class XOSDefaultSecurityContext(object):
     grant_access = True
     write_access = True
     read_access = True
 
+    def __init__(self):
+        # Verdicts of nested policies and Privilege queries, reused by the
+        # generated security checks for as long as this context lives
+        self.memo = {}
+        # The Privileges held by user, if preload_privileges() was called
+        self.user_privileges = None
+
+    def memoize(self, key, fn):
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # objects that have not been saved yet can't be hashed
+            return fn()
+
+        result = fn()
+        self.memo[key] = result
+        return result
+
+    def preload_privileges(self):
+        self.user_privileges = list(Privilege.objects.filter(accessor_id=self.user.id))
+
 SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
 
+def translate_exception(e, context):
+    if hasattr(e, 'json_detail'):
+        context.set_details(e.json_detail)
+    elif hasattr(e, 'detail'):
+        context.set_details(e.detail)
+
+    if (type(e) == XOSPermissionDenied):
+        context.set_code(grpc.StatusCode.PERMISSION_DENIED)
+    elif (type(e) == XOSValidationError):
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+    elif (type(e) == XOSNotAuthenticated):
+        context.set_code(grpc.StatusCode.UNAUTHENTICATED)
+    elif (type(e) == XOSNotFound):
+        context.set_code(grpc.StatusCode.NOT_FOUND)
+
+def translate_stream_exceptions(result, context):
+    # the query behind a streaming RPC runs while the stream is read
+    try:
+        for msg in result:
+            yield msg
+    except Exception, e:
+        translate_exception(e, context)
+        raise
+
 def translate_exceptions(function):
     """ this decorator translates XOS exceptions to grpc status codes """
     def wrapper(*args, **kwargs):
+        if "context" in kwargs:
+            context = kwargs["context"]
+        else:
+            context = args[2]
+
         try:
-            return function(*args, **kwargs)
+            result = function(*args, **kwargs)
         except Exception, e:
-            if "context" in kwargs:
-                context = kwargs["context"]
-            else:
-                context = args[2]
-
-            if hasattr(e, 'json_detail'):
-                context.set_details(e.json_detail)
-            elif hasattr(e, 'detail'):
-                context.set_details(e.detail)
-
-            if (type(e) == XOSPermissionDenied):
-                context.set_code(grpc.StatusCode.PERMISSION_DENIED)
-            elif (type(e) == XOSValidationError):
-                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-            elif (type(e) == XOSNotAuthenticated):
-                context.set_code(grpc.StatusCode.UNAUTHENTICATED)
+            translate_exception(e, context)
             raise
-    return wrapper
 
-
-bench_tStart = time.time()
-bench_ops = 0
-def benchmark(function):
-    """ this decorator will report gRPC benchmark statistics every 10 seconds """
-    def wrapper(*args, **kwargs):
-        global bench_tStart
-        global bench_ops
-        result = function(*args, **kwargs)
-        bench_ops = bench_ops+1
-        elap = time.time() - bench_tStart
-        if (elap >= 10):
-            print "performance %d" % (bench_ops/elap)
-            bench_ops=0
-            bench_tStart = time.time()
+        if inspect.isgenerator(result):
+            return translate_stream_exceptions(result, context)
         return result
     return wrapper
 
 class CachedAuthenticator(object):
     """ Django Authentication is very slow (~ 10 ops/second), so cache
         authentication results and reuse them.
+
+        Entries are keyed on an HMAC of the credentials, so no plaintext
+        password is kept, and hold a snapshot of the user. The entries of a
+        user are dropped when the user is saved or deleted in this process,
+        and when XOS publishes a change event for the user (see
+        listen_for_changes), so that changes to is_active, is_admin and the
+        password take effect at once. Changes to bookkeeping fields alone
+        are ignored. The cache keeps at most auth_cache_size entries,
+        evicting the least recently used, and an entry expires
+        auth_cache_ttl seconds after it was added, or when its session does
+        if that is sooner. The ttl also bounds how long a change that
+        bypasses save(), such as a queryset update(), goes unnoticed.
     """
 
-    def __init__(self):
-        self.cached_creds = {}
-        self.timeout = 10          # keep cache entries around for 10s
+    def __init__(self, size=None, ttl=None):
+        self.size = size or Config.get("auth_cache_size")
+        self.ttl = ttl or Config.get("auth_cache_ttl")
+        self.secret = os.urandom(32)
+        self.entries = collections.OrderedDict()
+        self.keys_by_user = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listener = None
+
+    def make_key(self, kind, *credentials):
+        msg = "\0".join([kind] + [unicode(x).encode("utf-8") for x in credentials])
+        return hmac.new(self.secret, msg, hashlib.sha256).digest()
+
+    def remove_entry(self, key):
+        """ Remove the entry for key. The caller holds self.lock. """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            user_id = entry[1].id
+            keys = self.keys_by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_user[user_id]
+        return entry
+
+    def lookup(self, key):
+        """ Return a copy of the user that key was authenticated as, or None """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if (entry is None) or (entry[0] <= time.time()):
+                self.remove_entry(key)
+                self.misses = self.misses + 1
+                return None
+            # reinsert as the most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits = self.hits + 1
+
+        # callers may modify the user they are given
+        return copy.deepcopy(entry[1])
+
+    def store(self, key, user, ttl=None):
+        """ Remember that key authenticated user """
+        ttl = min(self.ttl, ttl) if ttl is not None else self.ttl
+        entry = (time.time() + ttl, copy.deepcopy(user))
+        with self.lock:
+            self.remove_entry(key)
+            self.entries[key] = entry
+            self.keys_by_user.setdefault(user.id, set()).add(key)
+            while len(self.entries) > self.size:
+                self.remove_entry(next(iter(self.entries)))
+
+    def forget(self, key):
+        with self.lock:
+            self.remove_entry(key)
+
+    def forget_user(self, user_id):
+        """ Drop every entry of the user, whose snapshot is now stale """
+        with self.lock:
+            for key in list(self.keys_by_user.get(user_id, [])):
+                self.remove_entry(key)
+                self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_user.clear()
 
     def authenticate(self, username, password):
-        self.trim()
-
-        key = "%s:%s" % (username, password)
-        cred = self.cached_creds.get(key, None)
-        if cred:
-            user = User.objects.filter(id=cred["user_id"])
-            if user:
-               user = user[0]
-               #print "cached authenticated %s:%s as %s" % (username, password, user)
-               return user
+        key = self.make_key("password", username, password)
+        user = self.lookup(key)
+        if user:
+            return user
 
         user = django_authenticate(username=username, password=password)
         if user:
-            #print "django authenticated %s:%s as %s" % (username, password, user)
-            self.cached_creds[key] = {"timeout": time.time() + self.timeout, "user_id": user.id}
+            self.store(key, user)
 
         return user
 
-    def trim(self):
-        """ Delete all cache entries that have expired """
-        for (k, v) in list(self.cached_creds.items()):
-            if time.time() > v["timeout"]:
-                del self.cached_creds[k]
+    def authenticate_session(self, session_key):
+        key = self.make_key("session", session_key)
+        user = self.lookup(key)
+        if user:
+            return user
+
+        s = SessionStore(session_key=session_key)
+        id = s.get("_auth_user_id", None)
+        if not id:
+            return None
+        user = User.objects.get(id=id)
+        if not user.is_active:
+            return None
+        logger.debug("authenticated session as %s" % user)
+        self.store(key, user, ttl=s.get_expiry_age())
+
+        return user
+
+    def forget_session(self, session_key):
+        self.forget(self.make_key("session", session_key))
+
+    def handle_change_event(self, data):
+        """ Drop the entries of the user named by a change event published by
+            User.save
+        """
+        try:
+            event = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        id = event.get("pk")
+        if not id:
+            return
+        changed_fields = event.get("changed_fields", [])
+        if changed_fields and set(BOOKKEEPING_FIELDS).issuperset(changed_fields):
+            return
+        self.forget_user(id)
+
+    def listen_for_changes(self, redis_host="redis"):
+        """ Subscribe to the change events of users. Events missed while not
+            subscribed can't be replayed, so the cache is cleared each time
+            the subscription is (re)established.
+        """
+        while True:
+            try:
+                r = redis.Redis(redis_host)
+                pubsub = r.pubsub()
+                pubsub.subscribe("User")
+                self.clear()
+                for item in pubsub.listen():
+                    if item["type"] == "message":
+                        self.handle_change_event(item["data"])
+            except Exception:
+                logger.log_exc("Auth cache: change feed failed, clearing the cache")
+
+            self.clear()
+            time.sleep(10)
+
+    def start_listener(self, redis_host="redis"):
+        if self.listener:
+            return
+        self.listener = threading.Thread(target=self.listen_for_changes, args=(redis_host,), name="auth-cache")
+        self.listener.daemon = True
+        self.listener.start()
+
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                    "entries": len(self.entries)}
 
 cached_authenticator = CachedAuthenticator()
 
+@receiver(post_save, sender=User)
+def forget_saved_user(sender, instance, created, **kwargs):
+    if created:
+        return
+    changed_fields = instance.changed_fields
+    if (not changed_fields) or (not set(BOOKKEEPING_FIELDS).issuperset(changed_fields)):
+        cached_authenticator.forget_user(instance.id)
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    cached_authenticator.forget_user(instance.id)
+
 class XOSAPIHelperMixin(object):
     def __init__(self):
         import django.apps
@@ -141,54 +333,100 @@ class XOSAPIHelperMixin(object):
         else:
             return int(x.id)
 
-    def objToProto(self, obj):
-        p_obj = self.getProtoClass(obj.__class__)()
-        for field in obj._meta.fields:
-            if getattr(obj, field.name) == None:
-                continue
+    def get_field_converters(self, djangoClass):
+        """ Return a list of (attribute name, message field name, converter)
+            for the fields of djangoClass that are sent in messages. This is
+            worked out once per model rather than once per object.
+        """
+        converters = field_converters.get(djangoClass)
+        if converters is not None:
+            return converters
 
+        converters = []
+        for field in djangoClass._meta.fields:
             ftype = field.get_internal_type()
             if (ftype == "CharField") or (ftype == "TextField") or (ftype == "SlugField"):
-                setattr(p_obj, field.name, str(getattr(obj, field.name)))
+                converters.append( (field.name, field.name, str) )
             elif (ftype == "BooleanField"):
-                setattr(p_obj, field.name, getattr(obj, field.name))
+                converters.append( (field.name, field.name, bool) )
             elif (ftype == "AutoField"):
-                setattr(p_obj, field.name, int(getattr(obj, field.name)))
+                converters.append( (field.name, field.name, int) )
             elif (ftype == "IntegerField") or (ftype == "PositiveIntegerField") or (ftype == "BigIntegerField"):
-                setattr(p_obj, field.name, int(getattr(obj, field.name)))
+                converters.append( (field.name, field.name, int) )
             elif (ftype == "ForeignKey"):
-                setattr(p_obj, field.name+"_id", self.convertForeignKey(getattr(obj, field.name)))
+                # read the id column directly, rather than loading the object
+                converters.append( (field.attname, field.name+"_id", int) )
             elif (ftype == "DateTimeField"):
-                setattr(p_obj, field.name, self.convertDateTime(getattr(obj, field.name)))
+                converters.append( (field.name, field.name, self.convertDateTime) )
             elif (ftype == "FloatField"):
-                setattr(p_obj, field.name, float(getattr(obj, field.name)))
+                converters.append( (field.name, field.name, float) )
             elif (ftype == "GenericIPAddressField"):
-                setattr(p_obj, field.name, str(getattr(obj, field.name)))
-
-        for field in obj._meta.related_objects:
+                converters.append( (field.name, field.name, str) )
+
+        field_converters[djangoClass] = converters
+        return converters
+
+    def get_reverse_relations(self, djangoClass):
+        """ Return the reverse relations of djangoClass that have an _ids
+            field in its message, as a list of (related_name, relation).
+        """
+        relations = reverse_relations.get(djangoClass)
+        if relations is not None:
+            return relations
+
+        pFields = self.getProtoClass(djangoClass).DESCRIPTOR.fields_by_name
+        relations = []
+        for field in djangoClass._meta.related_objects:
             related_name = field.related_name
             if not related_name:
                 continue
             if "+" in related_name:
                 continue
-            try:
-                rel_objs = getattr(obj, related_name)
-            except Exception, e:
-                # django makes catching this exception unnecessarily difficult
-                if type(e).__name__ == "RelatedObjectDoesNotExist":
-                    # OneToOneField throws this if relation does not exist
-                    continue
-                else:
-                    raise
+            if field.one_to_one:
+                continue
+            if related_name+"_ids" not in pFields:
+                continue
+            relations.append( (related_name, field) )
+
+        reverse_relations[djangoClass] = relations
+        return relations
+
+    def prefetch_reverse_ids(self, djangoClass, objs):
+        """ Look up the reverse relation ids of objs, one query per relation
+            for all of objs. Returns a dict mapping related_name to a dict
+            mapping object id to its list of related ids.
+        """
+        ids = [obj.id for obj in objs]
+        result = {}
+        for (related_name, field) in self.get_reverse_relations(djangoClass):
+            ids_by_obj = {}
+            if field.one_to_many:
+                # what getattr(obj, related_name).all() would have returned
+                rel_manager = field.related_model._default_manager
+                rows = rel_manager.filter(**{field.field.name + "__in": ids}).values_list(field.field.name, "id")
+                for (obj_id, rel_id) in rows:
+                    ids_by_obj.setdefault(obj_id, []).append(rel_id)
+            else:
+                for obj in objs:
+                    ids_by_obj[obj.id] = [x.id for x in getattr(obj, related_name).all()]
+            result[related_name] = ids_by_obj
+        return result
 
-            if not hasattr(rel_objs, "all"):
-                # this is in anticipation of OneToOneField causing problems
+    def objToProto(self, obj, reverse_ids=None):
+        if reverse_ids is None:
+            reverse_ids = self.prefetch_reverse_ids(obj.__class__, [obj])
+
+        p_obj = self.getProtoClass(obj.__class__)()
+        for (attname, name, converter) in self.get_field_converters(obj.__class__):
+            value = getattr(obj, attname)
+            if value is None:
                 continue
+            setattr(p_obj, name, converter(value))
 
-            for rel_obj in rel_objs.all():
-                if not hasattr(p_obj,related_name+"_ids"):
-                    continue
-                getattr(p_obj,related_name+"_ids").append(rel_obj.id)
+        for (related_name, ids_by_obj) in reverse_ids.items():
+            rel_ids = ids_by_obj.get(obj.id)
+            if rel_ids:
+                getattr(p_obj, related_name+"_ids").extend(rel_ids)
 
         # Generate a list of class names for the object. This includes its
         # ancestors. Anything that is a descendant of XOSBase or User
@@ -202,6 +440,31 @@ class XOSAPIHelperMixin(object):
 
         return p_obj
 
+    def chunkToProtos(self, objs):
+        objs_by_class = {}
+        for obj in objs:
+            objs_by_class.setdefault(obj.__class__, []).append(obj)
+        reverse_ids = {}
+        for (djangoClass, class_objs) in objs_by_class.items():
+            reverse_ids[djangoClass] = self.prefetch_reverse_ids(djangoClass, class_objs)
+
+        return [self.objToProto(obj, reverse_ids[obj.__class__]) for obj in objs]
+
+    def objsToProtos(self, objs):
+        """ Convert an iterable of objects to messages, QUERY_CHUNK_SIZE
+            objects at a time, so that reverse relations cost one query
+            per relation per chunk rather than per object.
+        """
+        chunk = []
+        for obj in objs:
+            chunk.append(obj)
+            if len(chunk) >= QUERY_CHUNK_SIZE:
+                for p_obj in self.chunkToProtos(chunk):
+                    yield p_obj
+                chunk = []
+        for p_obj in self.chunkToProtos(chunk):
+            yield p_obj
+
     def protoToArgs(self, djangoClass, message):
         args={}
         fmap={}
@@ -244,12 +507,8 @@ class XOSAPIHelperMixin(object):
         return args
 
     def querysetToProto(self, djangoClass, queryset):
-        objs = queryset
         p_objs = self.getPluralProtoClass(djangoClass)()
-
-        for obj in objs:
-           new_obj = p_objs.items.add()
-           new_obj.CopyFrom(self.objToProto(obj))
+        p_objs.items.extend(self.objsToProtos(queryset))
 
         return p_objs
 
@@ -267,13 +526,26 @@ class XOSAPIHelperMixin(object):
             obj = djangoClass.objects.get(id=id)
         return obj
 
-    def xos_security_gate(self, obj, user, **access_types):
+    def make_security_context(self, user, preload=False, **access_types):
+        """ Make a security context to pass to can_access. A context may be
+            reused for many objects in one request. If preload is set, all
+            of the user's privileges are loaded with a single query.
+        """
         sec_ctx = XOSDefaultSecurityContext()
         sec_ctx.user = user
 
         for k,v in access_types.items():
             setattr(sec_ctx, k, v)
 
+        if preload and (user is not None):
+            sec_ctx.preload_privileges()
+
+        return sec_ctx
+
+    def xos_security_gate(self, obj, user, sec_ctx=None, **access_types):
+        if sec_ctx is None:
+            sec_ctx = self.make_security_context(user, **access_types)
+
         obj_ctx = obj
 
         verdict, policy_name = obj.can_access(ctx = sec_ctx)
@@ -291,17 +563,42 @@ class XOSAPIHelperMixin(object):
 
             raise XOSPermissionDenied("User %(user_email)s cannot access %(django_class_name)s %(descriptor)s due to policy %(policy_name)s"%{'user_email':user.email, 'django_class_name':obj.__class__.__name__, 'policy_name': policy_name, 'descriptor': object_descriptor})
 
-    def xos_security_check(self, obj, user, **access_types):
-        sec_ctx = XOSDefaultSecurityContext()
-        sec_ctx.user = user
-        for k,v in access_types.items():
-            setattr(sec_ctx, k, v)
+    def xos_security_check(self, obj, user, sec_ctx=None, **access_types):
+        if sec_ctx is None:
+            sec_ctx = self.make_security_context(user, **access_types)
 
         obj_ctx = obj
 
         verdict, _ = obj.can_access(ctx = sec_ctx)
         return verdict
 
+    def security_checked(self, queryset, user):
+        """ Yield the objects of queryset that user may read, checking each
+            one. The checks share a security context, so the user's
+            privileges are loaded once and nested policy verdicts are reused.
+        """
+        sec_ctx = self.make_security_context(user, preload=True, read_access=True)
+        for obj in queryset:
+            if self.xos_security_check(obj, user, sec_ctx=sec_ctx):
+                yield obj
+
+    def readable_queryset(self, djangoClass, queryset, user):
+        """ Restrict queryset to the objects user may read, in the database
+            if the security policy of djangoClass can be expressed as a
+            query. Returns (queryset, check), where check is True if each
+            object must still be checked with xos_security_check.
+        """
+        if not hasattr(djangoClass, "security_filter"):
+            return (queryset, True)
+
+        sec_ctx = self.make_security_context(user, read_access=True)
+
+        q = djangoClass.security_filter(ctx = sec_ctx)
+        if q is None:
+            return (queryset, True)
+
+        return (queryset.filter(q), False)
+
     def get(self, djangoClass, user, id):
         obj = self.get_live_or_deleted_object(djangoClass, id)
 
@@ -319,16 +616,7 @@ class XOSAPIHelperMixin(object):
         new_obj.save()
         return self.objToProto(new_obj)
 
-    def update(self, djangoClass, user, id, message, context):
-        obj = self.get_live_or_deleted_object(djangoClass, id)
-        obj.caller = user
-
-        self.xos_security_gate(obj, user, write_access=True)
-
-        args = self.protoToArgs(djangoClass, message)
-        for (k,v) in args.iteritems():
-            setattr(obj, k, v)
-
+    def get_save_kwargs(self, context):
         save_kwargs={}
         for (k, v) in context.invocation_metadata():
             if k=="update_fields":
@@ -337,10 +625,111 @@ class XOSAPIHelperMixin(object):
                 save_kwargs["caller_kind"] = v
             elif k=="always_update_timestamp":
                 save_kwargs["always_update_timestamp"] = True
+        return save_kwargs
+
+    def get_preserve_fields(self, context):
+        """ The fields that an update must leave as they are in the
+            database. Clients name the bookkeeping fields they did not
+            assign, since their copy of those may be stale.
+        """
+        for (k, v) in context.invocation_metadata():
+            if k=="preserve_fields":
+                return v.split(",")
+        return []
+
+    def update_object(self, djangoClass, user, obj, message, save_kwargs, preserve_fields=[]):
+        obj.caller = user
+
+        self.xos_security_gate(obj, user, write_access=True)
+
+        args = self.protoToArgs(djangoClass, message)
+        for (k,v) in args.iteritems():
+            if k in preserve_fields:
+                continue
+            setattr(obj, k, v)
 
         obj.save(**save_kwargs)
+        return obj
+
+    def update(self, djangoClass, user, id, message, context):
+        obj = self.get_live_or_deleted_object(djangoClass, id)
+        obj = self.update_object(djangoClass, user, obj, message, self.get_save_kwargs(context),
+                                 self.get_preserve_fields(context))
         return self.objToProto(obj)
 
+    def get_objects_by_id(self, djangoClass, ids):
+        """ Retrieve live or deleted objects with one query. Returns a dict
+            mapping id to object; ids that do not exist are left out.
+        """
+        return dict([(obj.id, obj) for obj in djangoClass._base_manager.filter(id__in=list(ids))])
+
+    def bulk_get(self, djangoClass, user, ids):
+        objs_by_id = self.get_objects_by_id(djangoClass, ids)
+
+        sec_ctx = self.make_security_context(user, preload=(len(objs_by_id) > 1), read_access=True)
+        objs = []
+        for id in ids:
+            obj = objs_by_id.get(id)
+            if obj is None:
+                continue
+            self.xos_security_gate(obj, user, sec_ctx=sec_ctx)
+            objs.append(obj)
+
+        return self.querysetToProto(djangoClass, objs)
+
+    def bulk_update(self, djangoClass, user, request, context):
+        objs_by_id = self.get_objects_by_id(djangoClass, [message.id for message in request.items])
+        save_kwargs = self.get_save_kwargs(context)
+        preserve_fields = self.get_preserve_fields(context)
+
+        objs = []
+        with transaction.atomic():
+            for message in request.items:
+                obj = objs_by_id.get(message.id)
+                if obj is None:
+                    raise XOSNotFound("%s %d does not exist" % (djangoClass.__name__, message.id))
+                objs.append(self.update_object(djangoClass, user, obj, message, save_kwargs, preserve_fields))
+
+        return self.querysetToProto(djangoClass, objs)
+
+    def update_bookkeeping(self, user, request):
+        """ Write the bookkeeping fields of many objects in one transaction.
+            Used by the synchronizer to flush its write-behind buffer.
+        """
+        sec_ctx = self.make_security_context(user, preload=(len(request.items) > 1), write_access=True)
+        updates = []
+        for item in request.items:
+            djangoClass = self.get_model(item.class_name)
+            fields = json.loads(item.fields)
+
+            args = {}
+            for (name, val) in fields.items():
+                if name not in BOOKKEEPING_FIELDS:
+                    raise XOSPermissionDenied("Field %s of %s is not a bookkeeping field" % (name, item.class_name))
+                if (djangoClass._meta.get_field(name).get_internal_type() == "DateTimeField") and (val is not None):
+                    val = datetime.datetime.fromtimestamp(val, tz=pytz.utc)
+                args[name] = val
+
+            try:
+                obj = self.get_live_or_deleted_object(djangoClass, item.id)
+            except djangoClass.DoesNotExist:
+                # purged since the synchronizer loaded it
+                continue
+            self.xos_security_gate(obj, user, sec_ctx=sec_ctx)
+            updates.append((obj, args))
+
+        with transaction.atomic():
+            for (obj, args) in updates:
+                type(obj)._base_manager.filter(pk=obj.pk).update(**args)
+
+        if not request.silent:
+            for (obj, args) in updates:
+                for (k, v) in args.items():
+                    setattr(obj, k, v)
+                obj.push_redis_event(changed_fields=args.keys())
+
+        return Empty()
+
     def delete(self, djangoClass, user, id):
       obj = djangoClass.objects.get(id=id)
 
@@ -376,16 +765,68 @@ class XOSAPIHelperMixin(object):
 
         return q
 
+    def incremental_q(self, request):
+        # Objects changed since the caller's last fetch, plus the ones that
+        # fetch returned, which may still be dirty.
+        utc = pytz.utc
+        since = datetime.datetime.fromtimestamp(request.updated_since, tz=utc)
+        return Q(updated__gte=since) | Q(id__in=list(request.ids))
+
+    def is_paginated(self, request):
+        return bool(request.offset or request.limit or request.after_id)
+
+    def paginate(self, queryset, user, request, check=True):
+        """ Yield the objects of queryset that user may read, in id order,
+            honoring the offset, limit and after_id of request. The queryset
+            is read QUERY_CHUNK_SIZE rows at a time, so the whole table is
+            never held in memory. If check is False, the queryset is already
+            restricted to what user may read.
+        """
+        if request.after_id:
+            queryset = queryset.filter(id__gt=request.after_id)
+        queryset = queryset.order_by("id")
+
+        if check:
+            sec_ctx = self.make_security_context(user, preload=True, read_access=True)
+
+        skip = request.offset
+        remaining = request.limit or None
+        last_id = None
+        while True:
+            chunk = queryset
+            if last_id is not None:
+                chunk = chunk.filter(id__gt=last_id)
+            chunk = list(chunk[:QUERY_CHUNK_SIZE])
+
+            for obj in chunk:
+                if check and not self.xos_security_check(obj, user, sec_ctx=sec_ctx):
+                    continue
+                if skip:
+                    skip = skip - 1
+                    continue
+                yield obj
+                if remaining is not None:
+                    remaining = remaining - 1
+                    if remaining == 0:
+                        return
+
+            if len(chunk) < QUERY_CHUNK_SIZE:
+                return
+            last_id = chunk[-1].id
+
     def list(self, djangoClass, user):
-        queryset = djangoClass.objects.all()
-        filtered_queryset = (elt for elt in queryset if self.xos_security_check(elt, user, read_access=True))
+        (queryset, check) = self.readable_queryset(djangoClass, djangoClass.objects.all(), user)
+        if check:
+            filtered_queryset = self.security_checked(queryset, user)
+        else:
+            filtered_queryset = queryset
 
         # FIXME: Implement auditing here
         # logging.info("User requested x objects, y objects were filtered out by policy z")
 
         return self.querysetToProto(djangoClass, filtered_queryset)
 
-    def filter(self, djangoClass, user, request):
+    def filter_queryset(self, djangoClass, request):
         query = None
         if request.kind == request.DEFAULT:
             for element in request.elements:
@@ -393,14 +834,21 @@ class XOSAPIHelperMixin(object):
                     query = query & self.query_element_to_q(element)
                 else:
                     query = self.query_element_to_q(element)
-            queryset = djangoClass.objects.filter(query)
+            if query:
+                queryset = djangoClass.objects.filter(query)
+            else:
+                queryset = djangoClass.objects.all()
         elif request.kind == request.SYNCHRONIZER_DIRTY_OBJECTS:
             query = (Q(enacted__lt=F('updated')) | Q(enacted=None)) & Q(lazy_blocked=False) &Q(no_sync=False)
+            if request.incremental:
+                query = query & self.incremental_q(request)
             queryset = djangoClass.objects.filter(query)
         elif request.kind == request.SYNCHRONIZER_DELETED_OBJECTS:
             queryset = djangoClass.deleted_objects.all()
         elif request.kind == request.SYNCHRONIZER_DIRTY_POLICIES:
             query = (Q(policed__lt=F('updated')) | Q(policed=None)) & Q(no_policy=False)
+            if request.incremental:
+                query = query & self.incremental_q(request)
             queryset = djangoClass.objects.filter(query)
         elif request.kind == request.SYNCHRONIZER_DELETED_POLICIES:
             query = Q(policed__lt=F('updated')) | Q(policed=None)
@@ -408,13 +856,32 @@ class XOSAPIHelperMixin(object):
         elif request.kind == request.ALL:
             queryset = djangoClass.objects.all()
 
-        filtered_queryset = (elt for elt in queryset if self.xos_security_check(elt, user, read_access=True))
+        return queryset
+
+    def filter(self, djangoClass, user, request):
+        queryset = self.filter_queryset(djangoClass, request)
+        (queryset, check) = self.readable_queryset(djangoClass, queryset, user)
+
+        if self.is_paginated(request):
+            filtered_queryset = self.paginate(queryset, user, request, check)
+        elif check:
+            filtered_queryset = self.security_checked(queryset, user)
+        else:
+            filtered_queryset = queryset
 
         # FIXME: Implement auditing here
         # logging.info("User requested x objects, y objects were filtered out by policy z")
 
         return self.querysetToProto(djangoClass, filtered_queryset)
 
+    def stream(self, djangoClass, user, request):
+        """ Like filter, but returns an iterator of messages, one per object,
+            for use by the server-streaming Stream<Model> calls.
+        """
+        queryset = self.filter_queryset(djangoClass, request)
+        (queryset, check) = self.readable_queryset(djangoClass, queryset, user)
+        return self.objsToProtos(self.paginate(queryset, user, request, check))
+
     def authenticate(self, context, required=False):
         for (k, v) in context.invocation_metadata():
             if (k.lower()=="authorization"):
@@ -427,12 +894,9 @@ class XOSAPIHelperMixin(object):
                         raise XOSPermissionDenied("failed to authenticate %s:%s" % (username, password))
                     return user
             elif (k.lower()=="x-xossession"):
-                 s = SessionStore(session_key=v)
-                 id = s.get("_auth_user_id", None)
-                 if not id:
+                 user = cached_authenticator.authenticate_session(v)
+                 if not user:
                      raise XOSPermissionDenied("failed to authenticate token %s" % v)
-                 user = User.objects.get(id=id)
-                 print "authenticated sessionid %s as %s" % (v, user)
                  return user
 
         if required:
@@ -15,8 +15,11 @@
 #
 
 """gRPC server endpoint"""
+import hashlib
+import inspect
 import os
 import sys
+import threading
 import uuid
 from collections import OrderedDict
 from os.path import abspath, basename, dirname, join, walk
@@ -33,7 +36,10 @@ from protos import xos_pb2, schema_pb2, modeldefs_pb2, utility_pb2
 from xos_grpc_api import XosService
 from xos_modeldefs_api import ModelDefsService
 from xos_utility_api import UtilityService
+from apihelper import cached_authenticator
+from rpc_metrics import rpc_metrics, MetricsInterceptor, MetricsHTTPServer
 from google.protobuf.empty_pb2 import Empty
+from xosconfig import Config
 
 from xos.logger import Logger, logging
 logger = Logger(level=logging.INFO)
@@ -46,6 +52,99 @@ SERVER_CA="/usr/local/share/ca-certificates/local_certs.crt"
 #SERVER_CERT="certs/server.crt"
 #SERVER_CA="certs/ca.crt"
 
+# values of grpc.default_compression_algorithm
+COMPRESSION_ALGORITHMS = {"none": 0, "deflate": 1, "gzip": 2}
+
+class InstrumentedThreadPoolExecutor(futures.ThreadPoolExecutor):
+    """ A ThreadPoolExecutor that keeps count of the work items waiting for
+        a worker (queued) and the ones being run (in_flight). grpc runs
+        each RPC as one work item, so these are the RPC queue depth and
+        the number of RPCs in progress.
+    """
+
+    def __init__(self, max_workers):
+        super(InstrumentedThreadPoolExecutor, self).__init__(max_workers)
+        self.workers = max_workers
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.stats_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.stats_lock:
+            self.queued = self.queued + 1
+
+        def run():
+            with self.stats_lock:
+                self.queued = self.queued - 1
+                self.in_flight = self.in_flight + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.stats_lock:
+                    self.in_flight = self.in_flight - 1
+                    self.completed = self.completed + 1
+
+        return super(InstrumentedThreadPoolExecutor, self).submit(run)
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {"workers": self.workers,
+                    "queued": self.queued,
+                    "in_flight": self.in_flight,
+                    "completed": self.completed}
+
+def get_server_options():
+    """ Build the grpc channel arguments from the grpc section of the
+        config. Settings that are not present are left at grpc's defaults.
+    """
+    options = []
+    for (key, arg) in (("max_send_message_length", "grpc.max_send_message_length"),
+                       ("max_receive_message_length", "grpc.max_receive_message_length"),
+                       ("max_concurrent_streams", "grpc.max_concurrent_streams"),
+                       ("keepalive_time_ms", "grpc.keepalive_time_ms"),
+                       ("keepalive_timeout_ms", "grpc.keepalive_timeout_ms")):
+        value = Config.get("grpc." + key)
+        if value:
+            options.append((arg, int(value)))
+
+    if Config.get("grpc.keepalive_permit_without_calls"):
+        options.append(("grpc.keepalive_permit_without_calls", 1))
+
+    compression = Config.get("grpc.compression")
+    if compression:
+        options.append(("grpc.default_compression_algorithm", COMPRESSION_ALGORITHMS[compression]))
+
+    return options
+
+def make_server(thread_pool):
+    """ Create the grpc server. Older grpcio releases take neither channel
+        options nor a concurrency limit, in which case those settings are
+        ignored with a warning.
+    """
+    kwargs = {}
+    args = inspect.getargspec(grpc.server).args
+
+    options = get_server_options()
+    if options:
+        if "options" in args:
+            kwargs["options"] = options
+        else:
+            logger.warning("grpc.server does not accept options, ignoring %s" % ", ".join([x[0] for x in options]))
+
+    max_concurrent_rpcs = Config.get("grpc.max_concurrent_rpcs")
+    if max_concurrent_rpcs:
+        if "maximum_concurrent_rpcs" in args:
+            kwargs["maximum_concurrent_rpcs"] = max_concurrent_rpcs
+        else:
+            logger.warning("grpc.server does not accept maximum_concurrent_rpcs, ignoring it")
+
+    return grpc.server(thread_pool, **kwargs)
+
+# Metadata key a client may send with GetSchema, naming the schema it has
+# cached, and that the server returns with the hash of its schema
+SCHEMA_HASH_KEY = "x-xos-schema-hash"
+
 class SchemaService(schema_pb2.SchemaServiceServicer):
 
     def __init__(self, thread_pool):
@@ -54,6 +153,9 @@ class SchemaService(schema_pb2.SchemaServiceServicer):
         self.schemas = schema_pb2.Schemas(protos=protos,
                                           swagger_from='xos.proto',
                                           yang_from='xos.proto')
+        # returned instead of the schema to clients that already have it
+        self.unchanged = schema_pb2.Schemas(swagger_from='xos.proto',
+                                            yang_from='xos.proto')
 
     def stop(self):
         pass
@@ -89,19 +191,41 @@ class SchemaService(schema_pb2.SchemaServiceServicer):
                 descriptor=descriptor_content
             )
 
+        self.schema_hash = self._hash_schema(proto_map.values())
+
         return proto_map.values()
 
+    def _hash_schema(self, protos):
+        """ sha256 over the name, text and uncompressed descriptor of each
+            proto file, in name order. xosapi's client computes the same.
+        """
+        h = hashlib.sha256()
+        for proto in sorted(protos, key=lambda x: x.file_name):
+            for part in (proto.file_name, proto.proto, zlib.decompress(proto.descriptor)):
+                if isinstance(part, unicode):
+                    part = part.encode("utf-8")
+                h.update("%d:" % len(part))
+                h.update(part)
+        return h.hexdigest()
+
     def GetSchema(self, request, context):
-        """Return current schema files and descriptor"""
+        """Return current schema files and descriptor. A client that sends
+           the hash of the current schema gets an empty list of files.
+        """
+        context.set_trailing_metadata(((SCHEMA_HASH_KEY, self.schema_hash),))
+        for (k, v) in context.invocation_metadata():
+            if (k.lower() == SCHEMA_HASH_KEY) and (v == self.schema_hash):
+                return self.unchanged
         return self.schemas
 
 class XOSGrpcServer(object):
 
     def __init__(self, port=50055):
         self.port = port
-        logger.info('init-grpc-server port=%d' % self.port)
-        self.thread_pool = futures.ThreadPoolExecutor(max_workers=10)
-        self.server = grpc.server(self.thread_pool)
+        self.workers = Config.get("grpc.workers")
+        logger.info('init-grpc-server port=%d workers=%d' % (self.port, self.workers))
+        self.thread_pool = InstrumentedThreadPoolExecutor(max_workers=self.workers)
+        self.server = make_server(self.thread_pool)
 
         server_key = open(SERVER_KEY,"r").read()
         server_cert = open(SERVER_CERT,"r").read()
@@ -110,6 +234,18 @@ class XOSGrpcServer(object):
         self.credentials = grpc.ssl_server_credentials([(server_key, server_cert)], server_ca, False)
 
         self.services = []
+        self.interceptor = MetricsInterceptor(rpc_metrics)
+        self.metrics_server = None
+        self.stats_thread = None
+        self.stopped = threading.Event()
+
+    def get_stats(self):
+        """ Return the live RPC queue depth and in-flight count """
+        return self.thread_pool.get_stats()
+
+    def log_stats(self, interval):
+        while not self.stopped.wait(interval):
+            logger.info("grpc-server-stats %s" % self.get_stats())
 
     def start(self):
         logger.debug('starting')
@@ -132,11 +268,29 @@ class XOSGrpcServer(object):
         # strat the server
         self.server.start()
 
+        rpc_metrics.add_source("server", self.get_stats)
+        rpc_metrics.add_source("auth_cache", cached_authenticator.get_stats)
+        cached_authenticator.start_listener()
+
+        metrics_port = Config.get("grpc.metrics_port")
+        if metrics_port:
+            self.metrics_server = MetricsHTTPServer(metrics_port, rpc_metrics).start()
+            logger.info('serving metrics on http://127.0.0.1:%d/metrics' % metrics_port)
+
+        stats_interval = Config.get("grpc.stats_interval")
+        if stats_interval:
+            self.stats_thread = threading.Thread(target=self.log_stats, args=(stats_interval,))
+            self.stats_thread.daemon = True
+            self.stats_thread.start()
+
         logger.info('started')
         return self
 
     def stop(self, grace=0):
         logger.debug('stopping')
+        self.stopped.set()
+        if self.metrics_server:
+            self.metrics_server.stop()
         for service in self.services:
             service.stop()
         self.server.stop(grace)
@@ -151,7 +305,7 @@ class XOSGrpcServer(object):
         :return: None
         """
         self.services.append(service)
-        activator_func(service, self.server)
+        activator_func(self.interceptor.intercept(service), self.server)
 
 
 def restart_chameleon():
@@ -0,0 +1,250 @@
+#
+# Copyright 2017 the original author or authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Per-RPC metrics for the core API
+
+    MetricsInterceptor wraps the RPC methods of each servicer registered
+    with the gRPC server and records, per method, a latency histogram, the
+    status codes returned, request and response bytes, and the number of
+    rows returned by List, Filter, Stream and BulkGet calls.
+
+    The metrics are served as JSON by the utility service's GetMetrics RPC
+    and, when grpc.metrics_port is set, by a HTTP endpoint on localhost.
+"""
+
+import BaseHTTPServer
+import json
+import threading
+import time
+
+from xos.logger import Logger, logging
+logger = Logger(level=logging.INFO)
+
+# Upper bounds of the latency histogram buckets, in milliseconds. Calls
+# slower than the last bound are counted in a final overflow bucket.
+LATENCY_BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+class MethodMetrics(object):
+    def __init__(self):
+        self.count = 0
+        self.codes = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rows = 0
+
+    def record(self, elapsed, code, bytes_in, bytes_out, rows):
+        ms = elapsed * 1000.0
+        bucket = 0
+        while (bucket < len(LATENCY_BUCKETS)) and (ms > LATENCY_BUCKETS[bucket]):
+            bucket = bucket + 1
+
+        self.count = self.count + 1
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.latency_buckets[bucket] = self.latency_buckets[bucket] + 1
+        self.latency_sum = self.latency_sum + ms
+        self.latency_max = max(self.latency_max, ms)
+        self.bytes_in = self.bytes_in + bytes_in
+        self.bytes_out = self.bytes_out + bytes_out
+        self.rows = self.rows + rows
+
+    def to_dict(self):
+        bounds = [str(x) for x in LATENCY_BUCKETS] + ["+Inf"]
+        return {"count": self.count,
+                "errors": self.count - self.codes.get("OK", 0),
+                "codes": dict(self.codes),
+                "latency_ms": {"buckets": zip(bounds, self.latency_buckets),
+                               "sum": self.latency_sum,
+                               "max": self.latency_max,
+                               "mean": self.latency_sum / self.count if self.count else 0.0},
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "rows": self.rows}
+
+class RPCMetrics(object):
+    """ Thread-safe registry of MethodMetrics, keyed by method name """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.time()
+        # name -> function returning a dict, for gauges owned by others
+        self.sources = {}
+
+    def record(self, method, elapsed, code, bytes_in=0, bytes_out=0, rows=0):
+        with self.lock:
+            metrics = self.methods.get(method)
+            if metrics is None:
+                metrics = self.methods[method] = MethodMetrics()
+            metrics.record(elapsed, code, bytes_in, bytes_out, rows)
+
+    def add_source(self, name, fn):
+        self.sources[name] = fn
+
+    def snapshot(self):
+        with self.lock:
+            methods = dict([(name, m.to_dict()) for (name, m) in self.methods.items()])
+        result = {"uptime": time.time() - self.started,
+                  "methods": methods}
+        for (name, fn) in self.sources.items():
+            try:
+                result[name] = fn()
+            except:
+                logger.log_exc("Exception while reading metrics source %s" % name)
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.started = time.time()
+
+rpc_metrics = RPCMetrics()
+
+class MetricsContext(object):
+    """ Wraps a ServicerContext to remember the status code set on it """
+
+    def __init__(self, context):
+        self._context = context
+        self.code = None
+
+    def set_code(self, code):
+        self.code = code
+        self._context.set_code(code)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+def code_name(code):
+    return getattr(code, "name", str(code))
+
+def message_size(msg):
+    try:
+        return msg.ByteSize()
+    except AttributeError:
+        return 0
+
+def response_rows(msg):
+    # List, Filter and BulkGet return a plural message with an items field
+    items = getattr(msg, "items", None)
+    if items is None:
+        return 0
+    return len(items)
+
+class MetricsInterceptor(object):
+    """ Records metrics for every RPC of the servicers passed to intercept().
+
+        grpcio 1.0.x has no server interceptor API, so rather than hooking
+        into the server this replaces each RPC method of the servicer with
+        a wrapper before it is registered.
+    """
+
+    def __init__(self, metrics=rpc_metrics):
+        self.metrics = metrics
+
+    def get_rpc_names(self, service):
+        """ Return (service name, RPC names) from the generated base class """
+        for cls in type(service).__mro__:
+            if cls.__name__.endswith("Servicer") and not cls.__name__.startswith("Beta"):
+                names = [k for (k, v) in cls.__dict__.items() if callable(v) and k[:1].isupper()]
+                return (cls.__name__[:-len("Servicer")], names)
+        return (type(service).__name__, [])
+
+    def intercept(self, service):
+        (service_name, names) = self.get_rpc_names(service)
+        for name in names:
+            setattr(service, name, self.wrap("%s/%s" % (service_name, name), getattr(service, name)))
+        return service
+
+    def wrap(self, method_name, fn):
+        metrics = self.metrics
+
+        def wrapper(request, context):
+            tStart = time.time()
+            bytes_in = message_size(request)
+            context = MetricsContext(context)
+            try:
+                result = fn(request, context)
+            except:
+                code = code_name(context.code) if context.code else "UNKNOWN"
+                metrics.record(method_name, time.time() - tStart, code, bytes_in)
+                raise
+
+            if hasattr(result, "ByteSize"):
+                code = code_name(context.code) if context.code else "OK"
+                metrics.record(method_name, time.time() - tStart, code, bytes_in,
+                               result.ByteSize(), response_rows(result))
+                return result
+
+            return self.wrap_stream(method_name, result, context, tStart, bytes_in)
+
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+
+    def wrap_stream(self, method_name, result, context, tStart, bytes_in):
+        """ Record a streaming RPC once the stream ends """
+        bytes_out = 0
+        rows = 0
+        code = "OK"
+        try:
+            for msg in result:
+                bytes_out = bytes_out + message_size(msg)
+                rows = rows + 1
+                yield msg
+        except GeneratorExit:
+            code = "CANCELLED"
+            raise
+        except:
+            code = "UNKNOWN"
+            raise
+        finally:
+            if context.code:
+                code = code_name(context.code)
+            self.metrics.record(method_name, time.time() - tStart, code, bytes_in, bytes_out, rows)
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.metrics.snapshot(), indent=2, sort_keys=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsHTTPServer(object):
+    """ Serves the metrics as JSON at http://127.0.0.1:<port>/metrics """
+
+    def __init__(self, port, metrics=rpc_metrics):
+        self.httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+        self.httpd.metrics = metrics
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,5 +1,6 @@
 import base64
 import fnmatch
+import json
 import os
 import sys
 import time
@@ -16,7 +17,8 @@ import django.apps
 from django.db.models import F,Q
 from core.models import *
 from xos.exceptions import *
-from apihelper import XOSAPIHelperMixin, translate_exceptions
+from apihelper import XOSAPIHelperMixin, translate_exceptions, cached_authenticator
+from rpc_metrics import rpc_metrics
 
 # The Tosca engine expects to be run from /opt/xos/tosca/ or equivalent. It
 # needs some sys.path fixing up.
@@ -78,6 +80,7 @@ class UtilityService(utility_pb2.utilityServicer, XOSAPIHelperMixin):
     def Logout(self, request, context):
         for (k, v) in context.invocation_metadata():
             if (k.lower()=="x-xossession"):
+                cached_authenticator.forget_session(v)
                 s = SessionStore(session_key=v)
                 if "_auth_user_id" in s:
                     del s["_auth_user_id"]
@@ -212,3 +215,12 @@ class UtilityService(utility_pb2.utilityServicer, XOSAPIHelperMixin):
         res.xproto = xproto
         return res
 
+    @translate_exceptions
+    def GetMetrics(self, request, context):
+        user=self.authenticate(context, required=True)
+        if not user.is_admin:
+            raise XOSPermissionDenied("Only admins may read metrics")
+
+        res = utility_pb2.Metrics()
+        res.json = json.dumps(rpc_metrics.snapshot())
+        return res
@@ -4,9 +4,10 @@ import socket
 import sys
 import base64
 import time
+from collections import OrderedDict
 from xosconfig import Config
 from synchronizers.new_base.syncstep import SyncStep
-from synchronizers.new_base.ansible_helper import run_template_ssh
+from synchronizers.new_base.ansible_helper import run_template_ssh, run_template_ssh_batch
 from synchronizers.new_base.modelaccessor import *
 from xos.logger import Logger, logging
 
@@ -22,6 +23,11 @@ class SyncInstanceUsingAnsible(SyncStep):
     # requested_interval=0
     # template_name = "sync_vcpetenant.yaml"
 
+    # Fields that determine how ansible connects to the context. Objects
+    # that agree on all of them can share a batched playbook run.
+    connection_fields = ["hostname", "instance_name", "instance_id", "username", "ssh_ip", "baremetal_ssh",
+                         "private_key"]
+
     def __init__(self, **args):
         SyncStep.__init__(self, **args)
 
@@ -170,9 +176,8 @@ class SyncInstanceUsingAnsible(SyncStep):
 
         return fields
 
-    def sync_record(self, o):
-        logger.info("sync'ing object %s" % str(o), extra=o.tologdict())
-
+    def get_sync_fields(self, o):
+        """ Return the fields that are passed to the playbook to sync o """
         self.prepare_record(o)
 
         if self.skip_ansible_fields(o):
@@ -221,10 +226,69 @@ class SyncInstanceUsingAnsible(SyncStep):
 
         fields.update(self.get_extra_attributes(o))
 
+        return fields
+
+    def sync_record(self, o):
+        logger.info("sync'ing object %s" % str(o), extra=o.tologdict())
+
+        fields = self.get_sync_fields(o)
+
         self.sync_fields(o, fields)
 
         o.save()
 
+    def sync_records(self, objs):
+        """ Batched counterpart of sync_record, used when batch_size is set.
+
+            Objects whose playbooks would ssh into the same context are
+            grouped, and each group is synced by one run of the template
+            (batch_template_name if defined), which must loop over
+            xos_batch. Steps that override sync_fields should not enable
+            batching, since sync_fields is bypassed here.
+        """
+        exceptions = [None] * len(objs)
+
+        groups = OrderedDict()
+        for (i, o) in enumerate(objs):
+            logger.info("sync'ing object %s in batch" % str(o), extra=o.tologdict())
+            try:
+                fields = self.get_sync_fields(o)
+            except Exception as e:
+                exceptions[i] = e
+                continue
+            key = tuple([fields.get(k, None) for k in self.connection_fields])
+            groups.setdefault(key, []).append((i, o, fields))
+
+        template_name = getattr(self, "batch_template_name", self.template_name)
+
+        for group in groups.values():
+            first_fields = group[0][2]
+            connection = dict([(k, first_fields[k]) for k in self.connection_fields if k in first_fields])
+            items = [fields for (i, o, fields) in group]
+
+            tStart = time.time()
+            try:
+                (results, errors) = run_template_ssh_batch(template_name, connection, items)
+            except Exception as e:
+                for (i, o, fields) in group:
+                    exceptions[i] = e
+                continue
+            logger.info("batch playbook execution time %d for %d objects" % (int(time.time() - tStart), len(group)))
+
+            for (i, o, fields) in group:
+                tag = fields["ansible_tag"]
+                if tag in errors:
+                    exceptions[i] = Exception(errors[tag])
+                    continue
+                try:
+                    if hasattr(self, "map_sync_outputs"):
+                        self.map_sync_outputs(o, results[tag])
+                    o.save()
+                except Exception as e:
+                    exceptions[i] = e
+
+        return exceptions
+
     def delete_record(self, o):
         try:
             controller = o.get_controller()
@@ -0,0 +1,144 @@
+""" ansible_executor.py
+
+    A pool of long-lived worker processes that run Ansible playbooks.
+
+    Each worker imports Ansible once at startup and then receives jobs over a
+    pipe, rather than paying for interpreter startup and the Ansible import
+    on every playbook. Jobs still go through ansible_main.run_playbook, which
+    sets ANSIBLE_CONFIG / ANSIBLE_HOSTS and reloads ansible_runner (and with
+    it ansible.constants) for every job, so jobs do not leak settings into
+    each other.
+"""
+
+import atexit
+import os
+import Queue
+import sys
+import threading
+import traceback
+from multiprocessing import Process, Pipe
+
+from xos.logger import observer_logger as logger
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+
+def worker_main(conn):
+    # Pre-warm: pay for the Ansible import once per worker
+    try:
+        import ansible_runner
+    except:
+        pass
+
+    import ansible_main
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+
+        if job is None:
+            return
+
+        result = ansible_main.run_playbook(job["ansible_hosts"], job["ansible_config"], job["fqp"], job["opts"])
+        try:
+            conn.send(result)
+        except:
+            # Most likely the results could not be pickled
+            conn.send({"stats": None, "aresults": None, "exception": traceback.format_exc()})
+
+
+class AnsibleWorker(object):
+    def __init__(self):
+        (self.conn, child_conn) = Pipe()
+        self.process = Process(target=worker_main, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def run(self, job):
+        self.conn.send(job)
+        return self.conn.recv()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class AnsibleExecutor(object):
+    """ Runs playbooks on a fixed number of pre-warmed worker processes.
+        run_playbook() may be called from any thread; callers block until a
+        worker is free.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(self.size):
+            self.idle.put(self.start_worker())
+
+    def start_worker(self):
+        worker = AnsibleWorker()
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def replace_worker(self, worker):
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        worker.stop()
+        return self.start_worker()
+
+    def run_playbook(self, ansible_hosts, ansible_config, fqp, opts):
+        job = {"ansible_hosts": ansible_hosts,
+               "ansible_config": ansible_config,
+               "fqp": fqp,
+               "opts": opts}
+
+        worker = self.idle.get()
+        try:
+            if not worker.is_alive():
+                worker = self.replace_worker(worker)
+            result = worker.run(job)
+        except (EOFError, IOError):
+            # The worker died mid-job. Start a fresh one for the next caller.
+            logger.log_exc("Ansible worker died while running %s" % fqp)
+            worker = self.replace_worker(worker)
+            result = {"stats": None, "aresults": None, "exception": traceback.format_exc()}
+        finally:
+            self.idle.put(worker)
+
+        return result
+
+    def stop(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.stop()
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor(size):
+    """ Return the process-wide executor, starting it on first use """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = AnsibleExecutor(size)
+            atexit.register(executor.stop)
+    return executor
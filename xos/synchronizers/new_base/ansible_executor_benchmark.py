@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+""" ansible_executor_benchmark.py
+
+    Compare the per-record overhead of running a trivial playbook through
+    the fork-per-playbook path against the pre-warmed AnsibleExecutor.
+
+    Usage:
+        python ansible_executor_benchmark.py -C synchronizer_config.yaml [-n 20] [-w 4]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")))
+
+NOOP_PLAYBOOK = """---
+- hosts: localhost
+  connection: local
+  gather_facts: False
+  tasks:
+  - name: noop
+    debug: msg="{{ tag }}"
+"""
+
+
+def time_runs(func, count, dir):
+    tStart = time.time()
+    for i in range(count):
+        fqp = os.path.join(dir, "noop-%d.yaml" % i)
+        open(fqp, "w").write(NOOP_PLAYBOOK)
+        (stats, aresults) = func(None, None, fqp, {"tag": "noop-%d" % i})
+        if aresults is None:
+            raise Exception("playbook %s failed" % fqp)
+    return (time.time() - tStart) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-C", dest="config", required=True, help="synchronizer config file")
+    parser.add_argument("-n", dest="count", type=int, default=20, help="playbooks per path")
+    parser.add_argument("-w", dest="workers", type=int, default=4, help="executor workers")
+    args = parser.parse_args()
+
+    from xosconfig import Config
+    Config.init(os.path.abspath(args.config), 'synchronizer-config-schema.yaml')
+
+    from synchronizers.new_base import ansible_helper
+    from synchronizers.new_base.ansible_executor import AnsibleExecutor
+
+    dir = tempfile.mkdtemp()
+    try:
+        def fork_path(ansible_hosts, ansible_config, fqp, opts):
+            result = ansible_helper.run_playbook_fork(ansible_hosts, ansible_config, fqp, opts)
+            return (result.get("stats"), result.get("aresults"))
+
+        executor = AnsibleExecutor(args.workers)
+        # let the workers finish importing ansible before timing them
+        time.sleep(5)
+
+        def executor_path(ansible_hosts, ansible_config, fqp, opts):
+            result = executor.run_playbook(ansible_hosts, ansible_config, fqp, opts)
+            return (result.get("stats"), result.get("aresults"))
+
+        fork_time = time_runs(fork_path, args.count, dir)
+        executor_time = time_runs(executor_path, args.count, dir)
+        executor.stop()
+    finally:
+        shutil.rmtree(dir)
+
+    print "playbooks per path:        %d" % args.count
+    print "fork per playbook:         %.3f s/record" % fork_time
+    print "pre-warmed executor (%d):   %.3f s/record" % (args.workers, executor_time)
+    print "overhead saved per record: %.3f s" % (fork_time - executor_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import jinja2
+import hashlib
 import tempfile
 import os
 import json
@@ -12,17 +13,43 @@ import re
 import traceback
 import subprocess
 import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from xosconfig import Config
 from xos.logger import observer_logger as logger
 from multiprocessing import Process, Queue
-from xosconfig import Config
+from ansible_executor import get_executor
 
 
 step_dir = Config.get("steps_dir")
 sys_dir = Config.get("sys_dir")
 
+# Compiled templates are cached on disk so that they survive restarts and
+# are shared with other synchronizer processes.
+bytecode_cache = None
+if sys_dir:
+    try:
+        bytecode_cache_dir = os.path.join(sys_dir, ".jinja_cache")
+        if not os.path.isdir(bytecode_cache_dir):
+            os.makedirs(bytecode_cache_dir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    except OSError:
+        logger.log_exc("Failed to create jinja bytecode cache in %s" % sys_dir)
+if not bytecode_cache:
+    bytecode_cache = jinja2.FileSystemBytecodeCache()
+
 os_template_loader = jinja2.FileSystemLoader( searchpath=[step_dir, "/opt/xos/synchronizers/shared_templates"])
-os_template_env = jinja2.Environment(loader=os_template_loader)
+os_template_env = jinja2.Environment(loader=os_template_loader, bytecode_cache=bytecode_cache)
+
+# Rendered playbooks, most recently used last, mapped to the hash of the
+# template and opts they were rendered from. Playbooks that fall off the end
+# are deleted along with their output files, unless a run is still using
+# them; playbooks_in_use counts the runs of each.
+PLAYBOOK_SUFFIXES = ["", ".out", ".result", ".key", ".config", ".hosts"]
+playbook_cache = OrderedDict()
+playbook_cache_lock = threading.Lock()
+playbooks_in_use = {}
+prepared_dirs = set()
 
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
@@ -40,18 +67,107 @@ def get_playbook_fn(opts, path):
     objname = opts["ansible_tag"]
 
     pathed_sys_dir = os.path.join(sys_dir, path)
-    if not os.path.isdir(pathed_sys_dir):
-        os.makedirs(pathed_sys_dir)
+    if pathed_sys_dir not in prepared_dirs:
+        if not os.path.isdir(pathed_sys_dir):
+            os.makedirs(pathed_sys_dir)
+
+        # symlink steps/roles into sys/roles so that playbooks can access roles
+        roledir = os.path.join(step_dir,"roles")
+        rolelink = os.path.join(pathed_sys_dir, "roles")
+        if os.path.isdir(roledir) and not os.path.islink(rolelink):
+            os.symlink(roledir,rolelink)
 
-    # symlink steps/roles into sys/roles so that playbooks can access roles
-    roledir = os.path.join(step_dir,"roles")
-    rolelink = os.path.join(pathed_sys_dir, "roles")
-    if os.path.isdir(roledir) and not os.path.islink(rolelink):
-        os.symlink(roledir,rolelink)
+        prepared_dirs.add(pathed_sys_dir)
 
     return (opts, os.path.join(pathed_sys_dir,objname))
 
-def run_playbook(ansible_hosts, ansible_config, fqp, opts):
+def get_playbook_hash(template, opts):
+    h = hashlib.sha1()
+    h.update(template.name)
+    if template.filename and os.path.exists(template.filename):
+        h.update(str(os.path.getmtime(template.filename)))
+    h.update(json.dumps(opts, sort_keys=True, default=repr))
+    return h.hexdigest()
+
+def remove_playbook_files(fqp):
+    for suffix in PLAYBOOK_SUFFIXES:
+        fn = fqp + suffix
+        try:
+            if os.path.exists(fn):
+                os.remove(fn)
+        except OSError:
+            logger.log_exc("Failed to remove %s" % fn)
+
+def touch_playbook(fqp, playbook_hash):
+    """ Record fqp as the most recently used playbook and delete the least
+        recently used ones beyond playbook_cache_size. Playbooks that are in
+        use are skipped, and deleted by a later call once they are not.
+    """
+    cache_size = Config.get("playbook_cache_size")
+
+    evicted = []
+    with playbook_cache_lock:
+        playbook_cache.pop(fqp, None)
+        playbook_cache[fqp] = playbook_hash
+        excess = len(playbook_cache) - cache_size
+        for old_fqp in playbook_cache:
+            if len(evicted) >= excess:
+                break
+            if old_fqp not in playbooks_in_use:
+                evicted.append(old_fqp)
+        for old_fqp in evicted:
+            del playbook_cache[old_fqp]
+
+    for old_fqp in evicted:
+        remove_playbook_files(old_fqp)
+
+@contextmanager
+def playbook_in_use(fqp):
+    """ Keep the files of fqp from being deleted while a run uses them """
+    with playbook_cache_lock:
+        playbooks_in_use[fqp] = playbooks_in_use.get(fqp, 0) + 1
+    try:
+        yield
+    finally:
+        with playbook_cache_lock:
+            playbooks_in_use[fqp] -= 1
+            if not playbooks_in_use[fqp]:
+                del playbooks_in_use[fqp]
+
+def load_playbook_cache():
+    """ Add the playbooks left in sys_dir by earlier runs to the cache,
+        oldest first, so that they are cleaned up like the ones we render.
+        They have no hash, so they are rendered again before they are used.
+    """
+    mtimes = {}
+    for (dirpath, dirnames, filenames) in os.walk(sys_dir):
+        if ".jinja_cache" in dirnames:
+            dirnames.remove(".jinja_cache")
+        for fn in filenames:
+            pathname = os.path.join(dirpath, fn)
+            if os.path.islink(pathname):
+                continue
+            fqp = pathname
+            for suffix in PLAYBOOK_SUFFIXES:
+                if suffix and fn.endswith(suffix):
+                    fqp = pathname[:-len(suffix)]
+                    break
+            try:
+                mtimes[fqp] = max(mtimes.get(fqp, 0), os.path.getmtime(pathname))
+            except OSError:
+                # removed while we were looking
+                pass
+
+    with playbook_cache_lock:
+        for fqp in sorted(mtimes.keys(), key=lambda x: mtimes[x]):
+            if fqp not in playbook_cache:
+                playbook_cache[fqp] = None
+
+if sys_dir and os.path.isdir(sys_dir):
+    load_playbook_cache()
+
+def run_playbook_fork(ansible_hosts, ansible_config, fqp, opts):
+    """ Run the playbook in a freshly started python process """
     args = {"ansible_hosts": ansible_hosts,
             "ansible_config": ansible_config,
             "fqp": fqp,
@@ -76,9 +192,27 @@ def run_playbook(ansible_hosts, ansible_config, fqp, opts):
         os.system("python %s %s %s" % (ansible_main_fn, args_fn, result_fn))
 
         result = pickle.loads(open(result_fn).read())
+    finally:
+        if not keep_temp_files:
+            if args_fn and os.path.exists(args_fn):
+                os.remove(args_fn)
+            if result_fn and os.path.exists(result_fn):
+                os.remove(result_fn)
+            os.rmdir(dir)
+
+    return result
 
-        if hasattr(result, "exception"):
-            logger.log_error("Exception in playbook: %s" % result["exception"])
+def run_playbook(ansible_hosts, ansible_config, fqp, opts):
+    ansible_workers = Config.get("ansible_workers")
+
+    try:
+        if ansible_workers:
+            result = get_executor(ansible_workers).run_playbook(ansible_hosts, ansible_config, fqp, opts)
+        else:
+            result = run_playbook_fork(ansible_hosts, ansible_config, fqp, opts)
+
+        if "exception" in result:
+            logger.error("Exception in playbook: %s" % result["exception"])
 
         stats = result.get("stats", None)
         aresults = result.get("aresults", None)
@@ -86,26 +220,39 @@ def run_playbook(ansible_hosts, ansible_config, fqp, opts):
         logger.log_exc("Exception running ansible_main")
         stats = None
         aresults = None
-    finally:
-        if not keep_temp_files:
-            if args_fn and os.path.exists(args_fn):
-                os.remove(args_fn)
-            if result_fn and os.path.exists(result_fn):
-                os.remove(result_fn)
-            os.rmdir(dir)
 
     return (stats, aresults)
 
-def run_template(name, opts, path='', expected_num=None, ansible_config=None, ansible_hosts=None, run_ansible_script=None, object=None):
+def render_playbook(name, opts, path):
     template = os_template_env.get_template(name)
-    buffer = template.render(opts)
+    playbook_hash = get_playbook_hash(template, opts)
+
+    (tagged_opts, fqp) = get_playbook_fn(opts, path)
+
+    with playbook_cache_lock:
+        unchanged = (playbook_cache.get(fqp, None) == playbook_hash)
+
+    # An identical playbook was already rendered to this file, so there is
+    # no need to render and write it again.
+    if not (unchanged and os.path.exists(fqp)):
+        buffer = template.render(opts)
+
+        f = open(fqp,'w')
+        f.write(buffer)
+        f.close()
 
+    touch_playbook(fqp, playbook_hash)
+
+    return (tagged_opts, fqp)
+
+def run_template(name, opts, path='', expected_num=None, ansible_config=None, ansible_hosts=None, run_ansible_script=None, object=None):
     (opts, fqp) = get_playbook_fn(opts, path)
+    with playbook_in_use(fqp):
+        return _run_template(name, opts, path, expected_num, ansible_config, ansible_hosts, run_ansible_script, object)
+
+def _run_template(name, opts, path, expected_num, ansible_config, ansible_hosts, run_ansible_script, object):
+    (opts, fqp) = render_playbook(name, opts, path)
 
-    f = open(fqp,'w')
-    f.write(buffer)
-    f.flush()
-    
     """
     q = Queue()
     p = Process(target=run_playbook, args=(ansible_hosts, ansible_config, fqp, opts, q,))
@@ -188,7 +335,66 @@ def run_template(name, opts, path='', expected_num=None, ansible_config=None, an
     processed_results = map(lambda x:x._result, ok_results)
     return processed_results[1:] # 0 is setup
 
-def run_template_ssh(name, opts, path='', expected_num=None, object=None):
+def get_result_msg(result):
+    try:
+        return result['msg']
+    except (KeyError, TypeError):
+        return "no message"
+
+def run_template_batch(name, items, path='', opts={}, ansible_config=None, ansible_hosts=None):
+    """ Run one playbook on behalf of several objects.
+
+        The template is rendered with 'xos_batch' set to items, a list of
+        per-object option dicts that each carry a unique 'ansible_tag', plus
+        any shared options in opts. Tasks in the template are expected to
+        loop over xos_batch, for example with 'with_items: "{{ xos_batch }}"'.
+
+        Returns (results, errors). results maps each ansible_tag to the list
+        of per-item results of looped tasks, in task order. errors maps the
+        ansible_tag of each item that failed to its error message. A failed
+        or unreachable task that is not looped fails every item.
+    """
+
+    opts = opts.copy()
+    opts["xos_batch"] = items
+    if not opts.get("ansible_tag", None):
+        opts["ansible_tag"] = "batch_" + id_generator()
+
+    (opts, fqp) = get_playbook_fn(opts, path)
+    with playbook_in_use(fqp):
+        render_playbook(name, opts, path)
+        stats, aresults = run_playbook(ansible_hosts, ansible_config, fqp, opts)
+
+    if (aresults is None):
+        raise Exception("Error executing playbook %s" % fqp)
+
+    tags = [item["ansible_tag"] for item in items]
+    results = dict([(tag, []) for tag in tags])
+    errors = {}
+
+    for x in aresults:
+        item_results = x._result.get("results", None) if isinstance(x._result, dict) else None
+
+        if item_results is None:
+            # Not a looped task, so it speaks for the whole batch
+            if x.is_failed() or x.is_unreachable():
+                for tag in tags:
+                    errors.setdefault(tag, get_result_msg(x._result))
+            continue
+
+        for item_result in item_results:
+            item = item_result.get("item", None)
+            if not isinstance(item, dict) or item.get("ansible_tag", None) not in results:
+                continue
+            tag = item["ansible_tag"]
+            if item_result.get("failed", False) or item_result.get("unreachable", False):
+                errors.setdefault(tag, get_result_msg(item_result))
+            elif not item_result.get("skipped", False):
+                results[tag].append(item_result)
+
+    return (results, errors)
+
+def setup_ssh_files(opts, path):
     instance_name = opts["instance_name"]
     hostname = opts["hostname"]
     private_key = opts["private_key"]
@@ -249,7 +455,27 @@ def run_template_ssh(name, opts, path='', expected_num=None, object=None):
     print "ANSIBLE_CONFIG=%s" % config_pathname
     print "ANSIBLE_HOSTS=%s" % hosts_pathname
 
-    return run_template(name, opts, path, ansible_config = config_pathname, ansible_hosts = hosts_pathname, run_ansible_script="/opt/xos/synchronizers/base/run_ansible_verbose", object=object)
+    return (opts, config_pathname, hosts_pathname)
+
+def run_template_ssh(name, opts, path='', expected_num=None, object=None):
+    (opts, fqp) = get_playbook_fn(opts, path)
+    with playbook_in_use(fqp):
+        (opts, config_pathname, hosts_pathname) = setup_ssh_files(opts, path)
+
+        return run_template(name, opts, path, ansible_config = config_pathname, ansible_hosts = hosts_pathname, run_ansible_script="/opt/xos/synchronizers/base/run_ansible_verbose", object=object)
+
+def run_template_ssh_batch(name, opts, items, path=''):
+    """ Like run_template_ssh, but runs one playbook for all items. opts holds
+        the ssh connection options, which must be the same for every item.
+    """
+    opts = opts.copy()
+    opts["ansible_tag"] = "batch_" + id_generator()
+
+    (opts, fqp) = get_playbook_fn(opts, path)
+    with playbook_in_use(fqp):
+        (opts, config_pathname, hosts_pathname) = setup_ssh_files(opts, path)
+
+        return run_template_batch(name, items, path, opts=opts, ansible_config=config_pathname, ansible_hosts=hosts_pathname)
 
 
 
@@ -1,6 +1,7 @@
 from modelaccessor import ModelAccessor
 import pytz
 import datetime
+import json
 import time
 
 class CoreApiModelAccessor(ModelAccessor):
@@ -21,7 +22,13 @@ class CoreApiModelAccessor(ModelAccessor):
         objs = []
         for main_obj in main_objs:
             if (not deletion):
-                lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_OBJECTS)
+                window = self.get_fetch_window("pending", main_obj)
+                if window and (window["since"] is not None):
+                    lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_OBJECTS,
+                                                            updated_since=window["since"], ids=window["ids"])
+                else:
+                    lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_OBJECTS)
+                lobjs = self.save_fetch_window(window, lobjs)
             else:
                 lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DELETED_OBJECTS)
             objs.extend(lobjs)
@@ -35,7 +42,13 @@ class CoreApiModelAccessor(ModelAccessor):
         objs = []
         for main_obj in main_objs:
             if (not deletion):
-                lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_POLICIES)
+                window = self.get_fetch_window("policies", main_obj)
+                if window and (window["since"] is not None):
+                    lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_POLICIES,
+                                                            updated_since=window["since"], ids=window["ids"])
+                else:
+                    lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DIRTY_POLICIES)
+                lobjs = self.save_fetch_window(window, lobjs)
             else:
                 lobjs = main_obj.objects.filter_special(main_obj.objects.SYNCHRONIZER_DELETED_POLICIES)
             objs.extend(lobjs)
@@ -56,6 +69,19 @@ class CoreApiModelAccessor(ModelAccessor):
         now = datetime.datetime.utcnow().replace(tzinfo=utc)
         return time.mktime(now.timetuple())
 
+    def update_bookkeeping(self, updates, silent=False):
+        request = self.orm.make_BookkeepingUpdates()
+        request.silent = silent
+        for (o, values) in updates:
+            item = request.items.add()
+            item.class_name = o.model_name
+            item.id = o.id
+            item.fields = json.dumps(values)
+        self.orm.invoke("UpdateBookkeeping", request)
+
+    def fetch_window_start(self):
+        return self.now() - self.FETCH_WINDOW_OVERLAP
+
     def is_type(self, obj, name):
         return obj._wrapped_class.__class__.__name__ == name
 
@@ -65,6 +91,15 @@ class CoreApiModelAccessor(ModelAccessor):
     def get_content_type_id(self, obj):
         return obj.self_content_type_id
 
+    def get_foreign_key_ids(self, obj):
+        ids = []
+        for fk in obj._fkmap.values():
+            if fk["kind"] == "fk":
+                id = getattr(obj, fk["src_fieldName"])
+                if id:
+                    ids.append((fk["modelName"], id))
+        return ids
+
     def create_obj(self, cls, **kwargs):
         return cls.objects.new(**kwargs)
 
@@ -8,7 +8,7 @@ logger = Logger(level=logging.INFO)
 
 
 def update_diag(diag_class, loop_end=None, loop_start=None, syncrecord_start=None, sync_start=None,
-                backend_status=None):
+                backend_status=None, step_metrics=None):
     observer_name = Config.get("name")
 
     try:
@@ -33,6 +33,8 @@ def update_diag(diag_class, loop_end=None, loop_start=None, syncrecord_start=Non
             br['last_syncrecord_start'] = syncrecord_start
         if sync_start:
             br['last_synchronizer_start'] = sync_start
+        if step_metrics:
+            br['step_metrics'] = step_metrics
         if backend_status:
             diag.backend_status = backend_status
         diag.backend_register = json.dumps(br)
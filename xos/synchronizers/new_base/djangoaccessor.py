@@ -1,10 +1,11 @@
+import datetime
 import traceback
 
 import django.apps
 from django.db import reset_queries
 from django.utils import timezone
 from modelaccessor import ModelAccessor
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import F, Q
 from django import setup as django_setup # django 1.7
 from django.contrib.contenttypes.models import ContentType
@@ -31,7 +32,11 @@ class DjangoModelAccessor(ModelAccessor):
         objs = []
         for main_obj in main_objs:
             if (not deletion):
+                window = self.get_fetch_window("pending", main_obj)
                 lobjs = main_obj.objects.filter(Q(enacted__lt=F('updated')) | Q(enacted=None),Q(lazy_blocked=False),Q(no_sync=False))
+                if window and (window["since"] is not None):
+                    lobjs = lobjs.filter(Q(updated__gte=window["since"]) | Q(id__in=window["ids"]))
+                lobjs = self.save_fetch_window(window, lobjs)
             else:
                 lobjs = main_obj.deleted_objects.all()
             objs.extend(lobjs)
@@ -45,13 +50,28 @@ class DjangoModelAccessor(ModelAccessor):
         objs = []
         for main_obj in main_objs:
             if (not deletion):
+                window = self.get_fetch_window("policies", main_obj)
                 res = main_obj.objects.filter((Q(policed__lt=F('updated')) | Q(policed=None)) & Q(no_policy=False))
+                if window and (window["since"] is not None):
+                    res = res.filter(Q(updated__gte=window["since"]) | Q(id__in=window["ids"]))
+                res = self.save_fetch_window(window, res)
             else:
                 res = main_obj.deleted_objects.filter(Q(policed__lt=F('updated')) | Q(policed=None))
             objs.extend(res)
 
         return objs
 
+    def update_bookkeeping(self, updates, silent=False):
+        # Bookkeeping fields need none of save()'s checks, so write them
+        # with one UPDATE per object in a single transaction.
+        with transaction.atomic():
+            for (o, values) in updates:
+                type(o)._base_manager.filter(pk=o.pk).update(**values)
+
+        if not silent:
+            for (o, values) in updates:
+                o.push_redis_event(changed_fields=values.keys())
+
     def reset_queries(self):
         reset_queries()
 
@@ -85,6 +105,9 @@ class DjangoModelAccessor(ModelAccessor):
     def now(self):
         return timezone.now()
 
+    def fetch_window_start(self):
+        return self.now() - datetime.timedelta(seconds=self.FETCH_WINDOW_OVERLAP)
+
     def is_type(self, obj, name):
         return type(obj) == self.get_model_class(name)
 
@@ -94,6 +117,15 @@ class DjangoModelAccessor(ModelAccessor):
     def get_content_type_id(self, obj):
         return ContentType.objects.get_for_model(obj)
 
+    def get_foreign_key_ids(self, obj):
+        ids = []
+        for f in obj._meta.fields:
+            if f.many_to_one:
+                id = getattr(obj, f.attname)
+                if id is not None:
+                    ids.append((f.related_model.__name__, id))
+        return ids
+
     def create_obj(self, cls, **kwargs):
         return cls(**kwargs)
 
@@ -1,5 +1,6 @@
 import os
 import imp
+import functools
 import inspect
 import time
 import sys
@@ -16,6 +17,7 @@ from xosconfig import Config
 from synchronizers.new_base.steps import *
 from syncstep import SyncStep, NullSyncStep
 from toposort import toposort
+from workerpool import WorkerPool, DAGScheduler
 from synchronizers.new_base.error_mapper import *
 from synchronizers.new_base.steps.sync_object import SyncObject
 from synchronizers.new_base.modelaccessor import *
@@ -62,6 +64,10 @@ STEP_STATUS_WORKING = 1
 STEP_STATUS_OK = 2
 STEP_STATUS_KO = 3
 
+# Change events that touch only bookkeeping fields, most likely our own
+# write-back after syncing an object, do not make a model dirty.
+IGNORED_EVENT_FIELDS = set(BOOKKEEPING_FIELDS)
+
 
 def invert_graph(g):
     ig = {}
@@ -86,6 +92,17 @@ class XOSObserver:
 
         self.driver = DRIVER
         self.observer_name = Config.get("name")
+        self.step_pool_size = Config.get("step_pool_size")
+        self.step_metrics = {}
+
+        # Change feed state. The listener thread adds the names of models
+        # that changed to dirty_models; run_once consumes them.
+        self.full_scan_interval = Config.get("full_scan_interval")
+        self.dirty_models = set()
+        self.dirty_lock = threading.Lock()
+        self.change_feed_ok = False
+        self.last_full_scan = 0
+        self.active_steps = None
 
     def wait_for_event(self, timeout):
         self.event_cond.acquire()
@@ -98,6 +115,22 @@ class XOSObserver:
         self.event_cond.notify()
         self.event_cond.release()
 
+    def step_is_change_driven(self, step):
+        # A step that computes its own pending set may depend on something
+        # other than model changes, so it is only skipped if it uses the
+        # standard fetch_pending.
+        return getattr(step.fetch_pending, "im_func", None) is SyncStep.fetch_pending.im_func
+
+    def get_step_models(self, step):
+        models = set()
+        for attr in ["observes", "provides"]:
+            objs = getattr(step, attr, [])
+            if type(objs) is not list:
+                objs = [objs]
+            for obj in objs:
+                models.add(getattr(obj, "__name__", str(obj)))
+        return models
+
     def load_sync_steps(self):
         dep_path = Config.get("dependency_graph")
         logger.info('Loading model dependency graph from %s' % dep_path)
@@ -184,13 +217,29 @@ class XOSObserver:
 
         pp = pprint.PrettyPrinter(indent=4)
         logger.debug(pp.pformat(step_graph))
+        cycles = []
         self.ordered_steps = toposort(
-            self.dependency_graph, phantom_steps + map(lambda s: s.__name__, self.sync_steps))
+            self.dependency_graph, phantom_steps + map(lambda s: s.__name__, self.sync_steps), cycles)
+        for cycle in cycles:
+            logger.warning("Dependency cycle among steps: %s" % " -> ".join(cycle))
         self.ordered_steps = [
             i for i in self.ordered_steps if i != 'SyncObject']
 
         logger.info("Order of steps=%s" % self.ordered_steps)
 
+        # Models whose changes cause each step to run. A value of None means
+        # the step runs on every pass.
+        self.step_models = {}
+        for s in self.ordered_steps:
+            if s.startswith('#'):
+                self.step_models[s] = set([s[1:]])
+            else:
+                step = self.step_lookup[s]
+                if self.step_is_change_driven(step):
+                    self.step_models[s] = self.get_step_models(step)
+                else:
+                    self.step_models[s] = None
+
         self.load_run_times()
 
     def check_duration(self, step, duration):
@@ -242,6 +291,12 @@ class XOSObserver:
             for e in self.ordered_steps:
                 self.last_deletion_run_times[e] = 0
 
+    def log_step_metrics(self):
+        for kind in ["sync", "deletion"]:
+            for (step_name, m) in self.step_metrics.get(kind, {}).items():
+                logger.debug("Step %s %s: queued %.3fs, ran %.3fs" %
+                             (step_name, kind, m["queue_latency"], m["run_latency"]))
+
     def lookup_step_class(self, s):
         if ('#' in s):
             return NullSyncStep
@@ -295,57 +350,33 @@ class XOSObserver:
                 (step.__name__, str(deletion)))
 
             dependency_graph = self.dependency_graph if not deletion else self.deletion_dependency_graph
-            # if not deletion else self.deletion_step_conditions
-            step_conditions = self.step_conditions
-            step_status = self.step_status  # if not deletion else self.deletion_step_status
-
-            # Wait for step dependencies to be met
-            try:
-                deps = dependency_graph[S]
-                has_deps = True
-            except KeyError:
-                has_deps = False
+            step_status = self.step_status
+            step_status[S] = STEP_STATUS_WORKING
 
+            # The scheduler only dispatches a step after all of its
+            # dependencies have finished, so their status is final here.
             go = True
-
-            failed_dep = None
-            if (has_deps):
-                for d in deps:
-                    if d == step.__name__:
-                        logger.debug(
-                            "   step %s self-wait skipped" %
-                            step.__name__)
-                        go = True
-                        continue
-
-                    cond = step_conditions[d]
-                    cond.acquire()
-                    if (step_status[d] is STEP_STATUS_WORKING):
-                        logger.debug(
-                            "  step %s wait on dep %s" %
-                            (step.__name__, d))
-                        cond.wait()
-                        logger.debug(
-                            "  step %s wait on dep %s cond returned" %
-                            (step.__name__, d))
-                    elif step_status[d] == STEP_STATUS_OK:
-                        go = True
-                    else:
-                        logger.debug(
-                            "  step %s has failed dep %s" %
-                            (step.__name__, d))
-                        go = False
-                        failed_dep = d
-                    cond.release()
-                    if (not go):
-                        break
-            else:
-                go = True
+            for d in dependency_graph.get(S, []):
+                if d == step.__name__:
+                    logger.debug(
+                        "   step %s self-wait skipped" %
+                        step.__name__)
+                    continue
+
+                if step_status.get(d, STEP_STATUS_OK) != STEP_STATUS_OK:
+                    logger.debug(
+                        "  step %s has failed dep %s" %
+                        (step.__name__, d))
+                    go = False
+                    break
 
             if (not go):
                 logger.debug("Step %s skipped" % step.__name__)
                 self.failed_steps.append(step)
                 my_status = STEP_STATUS_KO
+            elif (self.active_steps is not None) and (S not in self.active_steps):
+                logger.debug("Step %s skipped, no changes to its models" % step.__name__)
+                my_status = STEP_STATUS_OK
             else:
                 sync_step = self.lookup_step(S)
                 sync_step.__name__ = step.__name__
@@ -404,6 +435,8 @@ class XOSObserver:
 
                         if failed_objects:
                             self.failed_step_objects.update(failed_objects)
+                            # Retry the failed objects on the next pass
+                            self.mark_dirty(self.step_models.get(S) or [])
 
                         logger.debug(
                             "Step %r succeeded, deletion=%s" %
@@ -416,20 +449,13 @@ class XOSObserver:
                             (sync_step.__name__, e))
                         logger.log_exc("Exception in sync step")
                         self.failed_steps.append(S)
+                        self.mark_dirty(self.step_models.get(S) or [])
                         my_status = STEP_STATUS_KO
                 else:
                     logger.info("Step %r succeeded due to non-run" % step)
                     my_status = STEP_STATUS_OK
 
-            try:
-                my_cond = step_conditions[S]
-                my_cond.acquire()
-                step_status[S] = my_status
-                my_cond.notify_all()
-                my_cond.release()
-            except KeyError as e:
-                logger.debug('Step %r is a leaf' % step)
-                pass
+            step_status[S] = my_status
         finally:
             try:
                 model_accessor.reset_queries()
@@ -437,12 +463,112 @@ class XOSObserver:
                 # this shouldn't happen, but in case it does, catch it...
                 logger.log_exc("exception in reset_queries")
 
-            model_accessor.connection_close()
+    def mark_dirty(self, model_names):
+        with self.dirty_lock:
+            self.dirty_models.update(model_names)
+
+    def take_dirty_models(self):
+        with self.dirty_lock:
+            dirty = self.dirty_models
+            self.dirty_models = set()
+        return dirty
+
+    def get_watched_models(self):
+        models = set()
+        for v in self.step_models.values():
+            if v:
+                models.update(v)
+        return models
+
+    def handle_change_event(self, channel, data, watched):
+        """ Mark the models named by a change event published by
+            XOSBase.push_redis_event as dirty. Returns True if the event
+            concerns a model that one of our steps watches.
+        """
+        try:
+            event = json.loads(data)
+        except (TypeError, ValueError):
+            event = {}
+
+        changed_fields = event.get("changed_fields", [])
+        if changed_fields and IGNORED_EVENT_FIELDS.issuperset(changed_fields):
+            return False
+
+        # The channel is the concrete class name. Steps may observe a base
+        # class, so also consider every class in the object's hierarchy.
+        names = set([channel])
+        class_names = event.get("object", {}).get("class_names")
+        if class_names:
+            names.update(class_names.split(","))
+
+        names = names & watched
+        if not names:
+            return False
+
+        self.mark_dirty(names)
+        return True
+
+    def listen_for_changes(self):
+        """ Subscribe to the model change events published to Redis. While
+            the subscription is down, run_once falls back to full scans.
+        """
+        while True:
+            try:
+                import redis
+                r = redis.Redis("redis")
+                pubsub = r.pubsub()
+                pubsub.psubscribe("*")
+                watched = self.get_watched_models()
+                logger.info("Synchronizer change feed subscribed, watching %s" % sorted(watched))
+
+                self.change_feed_ok = True
+                # Events may have been missed while we were not subscribed
+                self.mark_dirty(watched)
+
+                for item in pubsub.listen():
+                    if item["type"] not in ["message", "pmessage"]:
+                        continue
+                    if self.handle_change_event(item["channel"], item["data"], watched):
+                        self.event_cond.acquire()
+                        self.event_cond.notify()
+                        self.event_cond.release()
+            except ImportError:
+                logger.info("redis module not available, synchronizer will poll")
+                self.change_feed_ok = False
+                return
+            except Exception:
+                logger.log_exc("Synchronizer change feed failed, falling back to full scans")
+
+            self.change_feed_ok = False
+            time.sleep(10)
+
+    def start_change_feed(self):
+        t = threading.Thread(target=self.listen_for_changes, name="change-feed")
+        t.daemon = True
+        t.start()
+
+    def select_steps(self):
+        """ Decide which steps run on this pass. Returns None to run every
+            step, or the set of step names whose models changed.
+        """
+        if (not self.change_feed_ok) or (time.time() - self.last_full_scan >= self.full_scan_interval):
+            self.take_dirty_models()
+            self.last_full_scan = time.time()
+            return None
+
+        dirty = self.take_dirty_models()
+        active = set()
+        for (s, models) in self.step_models.items():
+            if (models is None) or (models & dirty):
+                active.add(s)
+        return active
 
     def run(self):
         if not self.driver.enabled:
             return
 
+        self.start_change_feed()
+
         while True:
             logger.debug('Waiting for event')
             self.wait_for_event(timeout=5)
@@ -451,6 +577,11 @@ class XOSObserver:
             self.run_once()
 
     def run_once(self):
+        self.active_steps = self.select_steps()
+        if (self.active_steps is not None) and (not self.active_steps):
+            # Nothing changed since the last pass
+            return
+
         try:
             model_accessor.check_db_connection_okay()
 
@@ -458,60 +589,44 @@ class XOSObserver:
             error_map_file = Config.get('error_map_path')
             self.error_mapper = ErrorMapper(error_map_file)
 
-            # Two passes. One for sync, the other for deletion.
-            for deletion in [False, True]:
-                # Set of individual objects within steps that failed
-                self.failed_step_objects = set()
-
-                # Set up conditions and step status
-                # This is needed for steps to run in parallel
-                # while obeying dependencies.
-
-                providers = set()
-                dependency_graph = self.dependency_graph if not deletion else self.deletion_dependency_graph
-
-                for v in dependency_graph.values():
-                    if (v):
-                        providers.update(v)
+            # One pool of workers serves both passes. Each worker closes its
+            # database connection when the pool is shut down.
+            pool = WorkerPool(self.step_pool_size, name='synchronizer',
+                              exit_hook=model_accessor.connection_close)
+            self.step_metrics = {"pool_size": pool.size, "sync": {}, "deletion": {}}
 
-                self.step_conditions = {}
-                self.step_status = {}
-
-                for p in list(providers):
-                    self.step_conditions[p] = threading.Condition()
-
-                    self.step_status[p] = STEP_STATUS_WORKING
-
-                self.failed_steps = []
-
-                threads = []
-                logger.debug('Deletion=%r...' % deletion)
-                schedule = self.ordered_steps if not deletion else reversed(
-                    self.ordered_steps)
+            try:
+                # Two passes. One for sync, the other for deletion.
+                for deletion in [False, True]:
+                    # Set of individual objects within steps that failed
+                    self.failed_step_objects = set()
 
-                for S in schedule:
-                    thread = threading.Thread(
-                        target=self.sync, name='synchronizer', args=(
-                            S, deletion))
+                    self.step_status = {}
+                    self.failed_steps = []
 
                     logger.debug('Deletion=%r...' % deletion)
-                    threads.append(thread)
+                    dependency_graph = self.dependency_graph if not deletion else self.deletion_dependency_graph
+                    schedule = self.ordered_steps if not deletion else reversed(
+                        self.ordered_steps)
 
-                # Start threads
-                for t in threads:
-                    t.start()
+                    # Steps run in parallel on the pool while obeying
+                    # dependencies.
+                    scheduler = DAGScheduler(pool, dependency_graph, schedule,
+                                             functools.partial(self.sync, deletion=deletion))
+                    metrics = scheduler.run()
 
-                # another spot to clean up debug state
-                try:
-                    model_accessor.reset_queries()
-                except:
-                    # this shouldn't happen, but in case it does, catch it...
-                    logger.log_exc("exception in reset_queries")
+                    self.step_metrics["deletion" if deletion else "sync"] = metrics
+
+                    # another spot to clean up debug state
+                    try:
+                        model_accessor.reset_queries()
+                    except:
+                        # this shouldn't happen, but in case it does, catch it...
+                        logger.log_exc("exception in reset_queries")
+            finally:
+                pool.shutdown()
 
-                # Wait for all threads to finish before continuing with the run
-                # loop
-                for t in threads:
-                    t.join()
+            self.log_step_metrics()
 
             self.save_run_times()
 
@@ -520,6 +635,7 @@ class XOSObserver:
             model_accessor.update_diag(
                 loop_end=loop_end,
                 loop_start=loop_start,
+                step_metrics=self.step_metrics,
                 backend_status="1 - Bottom Of Loop")
 
         except Exception as e:
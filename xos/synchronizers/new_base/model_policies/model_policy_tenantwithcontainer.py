@@ -2,6 +2,13 @@ from synchronizers.new_base.modelaccessor import *
 from synchronizers.new_base.policy import Policy
 from synchronizers.new_base.exceptions import *
 
+import threading
+
+# The policy engine runs the handlers of these policies concurrently. This
+# lock serializes their read-modify-writes of what tenants share: the
+# addresses of an AddressPool and the placement of tenants on instances.
+allocation_lock = threading.RLock()
+
 class Scheduler(object):
     # XOS Scheduler Abstract Base Class
     # Used to implement schedulers that pick which node to put instances on
@@ -54,6 +61,7 @@ class LeastLoadedNodeScheduler(Scheduler):
 
 class TenantWithContainerPolicy(Policy):
     model_name = None # This policy is abstract. Inherit this class into your own policy and override model_name
+    thread_safe = True
 
     def handle_create(self, tenant):
         return self.handle_update(tenant)
@@ -88,16 +96,17 @@ class TenantWithContainerPolicy(Policy):
             raise Exception("no vrouter services")
         vrouter_service = vrouter_service[0]
 
-        ap = AddressPool.objects.filter(name=address_pool_name, service_id=vrouter_service.id)
-        if not ap:
-            raise Exception("vRouter unable to find addresspool %s" % name)
-        ap = ap[0]
+        with allocation_lock:
+            ap = AddressPool.objects.filter(name=address_pool_name, service_id=vrouter_service.id)
+            if not ap:
+                raise Exception("vRouter unable to find addresspool %s" % name)
+            ap = ap[0]
 
-        ip = ap.get_address()
-        if not ip:
-            raise Exception("AddressPool '%s' has run out of addresses." % ap.name)
+            ip = ap.get_address()
+            if not ip:
+                raise Exception("AddressPool '%s' has run out of addresses." % ap.name)
 
-        ap.save()  # save the AddressPool to account for address being removed from it
+            ap.save()  # save the AddressPool to account for address being removed from it
 
         subscriber_service = None
         if "subscriber_service" in kwargs:
@@ -128,7 +137,8 @@ class TenantWithContainerPolicy(Policy):
                 link.save()
         except:
             # cleanup if anything went wrong
-            ap.put_address(ip)
+            with allocation_lock:
+                ap.put_address(ip)
             if (t and t.id):
                 t.delete()
             raise
@@ -193,57 +203,58 @@ class TenantWithContainerPolicy(Policy):
             tenant.instance.delete()
             tenant.instance = None
 
-        if tenant.instance is None:
-            if not tenant.owner.slices.count():
-                raise SynchronizerConfigurationError("The service has no slices")
-
-            new_instance_created = False
-            instance = None
-            if self.get_legacy_tenant_attribute(tenant, "use_same_instance_for_multiple_tenants", default=False):
-                # Find if any existing instances can be used for this tenant
-                slices = tenant.owner.slices.all()
-                instance = self.pick_least_loaded_instance_in_slice(slices, desired_image)
-
-            if not instance:
-                slice = tenant.owner.slices.first()
-
-                flavor = slice.default_flavor
-                if not flavor:
-                    flavors = Flavor.objects.filter(name="m1.small")
-                    if not flavors:
-                        raise SynchronizerConfigurationError("No m1.small flavor")
-                    flavor = flavors[0]
-
-                if slice.default_isolation == "container_vm":
-                    raise Exception("Not implemented")
-                else:
-                    (node, parent) = LeastLoadedNodeScheduler(slice).pick()
-
-                assert(slice is not None)
-                assert(node is not None)
-                assert(desired_image is not None)
-                assert(tenant.creator is not None)
-                assert(node.site_deployment.deployment is not None)
-                assert(flavor is not None)
-
-                try:
-                    instance = Instance(slice=slice,
-                                        node=node,
-                                        image=desired_image,
-                                        creator=tenant.creator,
-                                        deployment=node.site_deployment.deployment,
-                                        flavor=flavor,
-                                        isolation=slice.default_isolation,
-                                        parent=parent)
-                    self.save_instance(instance)
-                    new_instance_created = True
-
-                    tenant.instance = instance
-                    tenant.save()
-                except:
-                    # NOTE: We don't have transactional support, so if the synchronizer crashes and exits after
-                    #       creating the instance, but before adding it to the tenant, then we will leave an
-                    #       orphaned instance.
-                    if new_instance_created:
-                        instance.delete()
-                    raise
\ No newline at end of file
+        with allocation_lock:
+            if tenant.instance is None:
+                if not tenant.owner.slices.count():
+                    raise SynchronizerConfigurationError("The service has no slices")
+
+                new_instance_created = False
+                instance = None
+                if self.get_legacy_tenant_attribute(tenant, "use_same_instance_for_multiple_tenants", default=False):
+                    # Find if any existing instances can be used for this tenant
+                    slices = tenant.owner.slices.all()
+                    instance = self.pick_least_loaded_instance_in_slice(slices, desired_image)
+
+                if not instance:
+                    slice = tenant.owner.slices.first()
+
+                    flavor = slice.default_flavor
+                    if not flavor:
+                        flavors = Flavor.objects.filter(name="m1.small")
+                        if not flavors:
+                            raise SynchronizerConfigurationError("No m1.small flavor")
+                        flavor = flavors[0]
+
+                    if slice.default_isolation == "container_vm":
+                        raise Exception("Not implemented")
+                    else:
+                        (node, parent) = LeastLoadedNodeScheduler(slice).pick()
+
+                    assert(slice is not None)
+                    assert(node is not None)
+                    assert(desired_image is not None)
+                    assert(tenant.creator is not None)
+                    assert(node.site_deployment.deployment is not None)
+                    assert(flavor is not None)
+
+                    try:
+                        instance = Instance(slice=slice,
+                                            node=node,
+                                            image=desired_image,
+                                            creator=tenant.creator,
+                                            deployment=node.site_deployment.deployment,
+                                            flavor=flavor,
+                                            isolation=slice.default_isolation,
+                                            parent=parent)
+                        self.save_instance(instance)
+                        new_instance_created = True
+
+                        tenant.instance = instance
+                        tenant.save()
+                    except:
+                        # NOTE: We don't have transactional support, so if the synchronizer crashes and exits after
+                        #       creating the instance, but before adding it to the tenant, then we will leave an
+                        #       orphaned instance.
+                        if new_instance_created:
+                            instance.delete()
+                        raise
\ No newline at end of file
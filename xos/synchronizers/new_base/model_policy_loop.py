@@ -1,21 +1,65 @@
 from synchronizers.new_base.modelaccessor import *
-from synchronizers.new_base.dependency_walker_new import *
 from synchronizers.new_base.policy import Policy
+from synchronizers.new_base.workerpool import WorkerPool, DAGScheduler
 from xos.logger import Logger, logging
 
 import imp
+import inspect
+import json
+import os
 import pdb
+import threading
 import time
 import traceback
 
 logger = Logger(level=logging.DEBUG)
 
+# Change events that touch only bookkeeping fields, written back by the
+# policy engine and the synchronizers, do not need policing.
+IGNORED_EVENT_FIELDS = set(BOOKKEEPING_FIELDS)
+
 class XOSPolicyEngine(object):
-    def __init__(self, policies_dir):
+    def __init__(self, policies_dir, pool_size=None):
         self.model_policies = self.load_model_policies(policies_dir)
         self.policies_by_name = {}
         self.policies_by_class = {}
 
+        # Objects are policed concurrently on a pool of this many threads,
+        # subject to the model dependency graph. The default of 1 polices
+        # them one at a time.
+        self.pool_size = pool_size or Config.get("policy_pool_size")
+        self.model_dependency_graph = self.load_dependency_graph()
+
+        # Policies that are thread_safe share one instance and run
+        # concurrently. Each thread gets its own instance of the others,
+        # and the handlers of each of them run one at a time under its lock
+        # in policy_locks.
+        self.policy_instances = {}
+        self.policy_locks = {}
+        self.policy_instances_lock = threading.Lock()
+        self.thread_policy_instances = threading.local()
+
+        # (policy name, action) -> counters, see record_policy_latency()
+        self.policy_metrics = {}
+        self.policy_metrics_lock = threading.Lock()
+
+        # (model name, id) -> pending policed/policy_status write, see
+        # queue_policy_status()
+        self.policy_status_writes = {}
+        self.policy_status_lock = threading.Lock()
+
+        # Change feed state. The listener thread adds the names of models
+        # that changed to dirty_models and wakes run(). Every
+        # policy_reconcile_interval seconds, or every poll_interval seconds
+        # while the feed is down, all models are polled instead.
+        self.poll_interval = 5
+        self.reconcile_interval = Config.get("policy_reconcile_interval")
+        self.event_cond = threading.Condition()
+        self.dirty_models = set()
+        self.dirty_lock = threading.Lock()
+        self.change_feed_ok = False
+        self.last_full_scan = 0
+
         for policy in self.model_policies:
             if not policy.model_name in self.policies_by_name:
                 self.policies_by_name[policy.model_name] = []
@@ -59,6 +103,100 @@ class XOSPolicyEngine(object):
             pass
         return
 
+    def load_dependency_graph(self):
+        """ Return the model dependency graph, mapping each model name to the
+            names of the models it depends on.
+        """
+        dep_path = Config.get("dependency_graph")
+        try:
+            return json.loads(open(dep_path).read())
+        except Exception:
+            logger.log_exc("MODEL POLICY: unable to load dependency graph %s, models will be policed in any order" % dep_path)
+            return {}
+
+    def get_model_dependencies(self, model_names, deletion=False):
+        """ For each name in model_names, return the set of the others that
+            must be policed first: the ones it depends on, directly or not,
+            or for deletions the ones that depend on it.
+        """
+        closure = {}
+        for name in model_names:
+            seen = set()
+            pending = list(self.model_dependency_graph.get(name, []))
+            while pending:
+                dep = pending.pop()
+                if dep not in seen:
+                    seen.add(dep)
+                    pending.extend(self.model_dependency_graph.get(dep, []))
+            closure[name] = seen
+
+        result = {}
+        for name in model_names:
+            if deletion:
+                result[name] = set([x for x in model_names if (x != name) and (name in closure[x])])
+            else:
+                result[name] = set([x for x in model_names if (x != name) and (x in closure[name])])
+        return result
+
+    def get_policy_instance(self, policy):
+        if not policy.thread_safe:
+            instances = getattr(self.thread_policy_instances, "instances", None)
+            if instances is None:
+                instances = self.thread_policy_instances.instances = {}
+            if policy not in instances:
+                instances[policy] = policy()
+            return instances[policy]
+
+        with self.policy_instances_lock:
+            if policy not in self.policy_instances:
+                self.policy_instances[policy] = policy()
+            return self.policy_instances[policy]
+
+    def get_policy_lock(self, policy):
+        with self.policy_instances_lock:
+            if policy not in self.policy_locks:
+                self.policy_locks[policy] = threading.Lock()
+            return self.policy_locks[policy]
+
+    def call_policy(self, policy, action, instance):
+        """ Call the handle_<action> method of policy on instance and record
+            its latency. Time spent waiting for the policy's lock is not
+            counted.
+        """
+        handler = getattr(self.get_policy_instance(policy), "handle_%s" % action)
+        if policy.thread_safe:
+            self.time_policy(policy, action, handler, instance)
+        else:
+            with self.get_policy_lock(policy):
+                self.time_policy(policy, action, handler, instance)
+
+    def time_policy(self, policy, action, handler, instance):
+        start = time.time()
+        try:
+            handler(instance)
+        except:
+            self.record_policy_latency(policy.__name__, action, time.time() - start, True)
+            raise
+        self.record_policy_latency(policy.__name__, action, time.time() - start, False)
+
+    def record_policy_latency(self, policy_name, action, elapsed, failed):
+        with self.policy_metrics_lock:
+            m = self.policy_metrics.get((policy_name, action))
+            if m is None:
+                m = self.policy_metrics[(policy_name, action)] = {"count": 0, "failures": 0, "total": 0.0, "max": 0.0}
+            m["count"] += 1
+            m["total"] += elapsed
+            m["max"] = max(m["max"], elapsed)
+            if failed:
+                m["failures"] += 1
+
+    def get_policy_metrics(self):
+        """ Return {(policy name, action): {count, failures, total, max}},
+            with latencies in seconds, accumulated since startup.
+        """
+        with self.policy_metrics_lock:
+            return dict([(k, dict(v)) for (k, v) in self.policy_metrics.items()])
+
     def load_model_policies(self, policies_dir):
         policies=[]
         for fn in os.listdir(policies_dir):
@@ -106,63 +244,257 @@ class XOSPolicyEngine(object):
             if hasattr(policy, method_name):
                 try:
                     logger.debug("MODEL POLICY: calling handler %s %s %s %s" % (sender_name, instance, policy.__name__, method_name))
-                    getattr(policy(), method_name)(instance)
+                    self.call_policy(policy, action, instance)
                     logger.debug("MODEL POLICY: completed handler %s %s %s %s" % (sender_name, instance, policy.__name__, method_name))
                 except:
                     logger.log_exc("MODEL POLICY: Exception when running handler")
                     policies_failed = True
 
-                    try:
-                        instance.policy_status = "2 - %s" % traceback.format_exc(limit=1)
-                        instance.save(update_fields=["policy_status"])
-                    except:
-                        logger.log_exc("MODEL_POLICY: Exception when storing policy_status")
+                    instance.policy_status = "2 - %s" % traceback.format_exc(limit=1)
+                    self.queue_policy_status(instance, ["policy_status"])
 
         if not policies_failed:
-            try:
-                instance.policed=new_policed
-                instance.policy_status = "1 - done"
-                instance.save(update_fields=['policed', 'policy_status'])
-            except:
-                logger.log_exc('MODEL POLICY: Object %r failed to update policed timestamp' % instance)
+            instance.policed=new_policed
+            instance.policy_status = "1 - done"
+            self.queue_policy_status(instance, ['policed', 'policy_status'])
+
+    def queue_policy_status(self, instance, update_fields):
+        """ Buffer a write of the policed and policy_status fields of
+            instance. Writes to the same object are coalesced, and the
+            buffer is written by flush_policy_status at the end of a pass.
+        """
+        key = (getattr(instance, "model_name", instance.__class__.__name__), instance.id)
+        with self.policy_status_lock:
+            entry = self.policy_status_writes.setdefault(key, {"obj": instance, "values": {}})
+            for field in update_fields:
+                entry["values"][field] = getattr(instance, field)
+
+    def flush_policy_status(self):
+        """ Write out the buffered policed and policy_status fields in bulk.
+            The writes are silent, so they publish no change events.
+        """
+        with self.policy_status_lock:
+            entries = self.policy_status_writes.values()
+            self.policy_status_writes = {}
+
+        if not entries:
+            return
+
+        try:
+            model_accessor.update_bookkeeping([(e["obj"], e["values"]) for e in entries], silent=True)
+        except:
+            logger.log_exc("MODEL POLICY: Bulk policy status update failed, saving objects one at a time")
+            for e in entries:
+                try:
+                    e["obj"].save(update_fields=e["values"].keys())
+                except:
+                    logger.log_exc('MODEL POLICY: Object %r failed to update policed timestamp' % e["obj"])
 
     def noop(self, o,p):
             pass
 
+    def mark_dirty(self, model_names):
+        with self.dirty_lock:
+            self.dirty_models.update(model_names)
+        self.event_cond.acquire()
+        self.event_cond.notify()
+        self.event_cond.release()
+
+    def take_dirty_models(self):
+        with self.dirty_lock:
+            dirty = self.dirty_models
+            self.dirty_models = set()
+        return dirty
+
+    def wait_for_event(self, timeout):
+        self.event_cond.acquire()
+        # mark_dirty notifies after updating dirty_models, so an event that
+        # arrived during the last pass is not lost
+        if not self.dirty_models:
+            self.event_cond.wait(timeout)
+        self.event_cond.release()
+
+    def get_watched_models(self):
+        return set(self.policies_by_name.keys())
+
+    def handle_change_event(self, channel, data, watched):
+        """ Mark the models named by a change event published by
+            XOSBase.push_redis_event as dirty. Returns True if the event
+            concerns a model that has a policy.
+        """
+        try:
+            event = json.loads(data)
+        except (TypeError, ValueError):
+            event = {}
+
+        changed_fields = event.get("changed_fields", [])
+        if changed_fields and IGNORED_EVENT_FIELDS.issuperset(changed_fields):
+            return False
+
+        # The channel is the concrete class name. Policies may be written
+        # for a base class, so also consider the object's hierarchy.
+        names = set([channel])
+        class_names = event.get("object", {}).get("class_names")
+        if class_names:
+            names.update(class_names.split(","))
+
+        names = names & watched
+        if not names:
+            return False
+
+        self.mark_dirty(names)
+        return True
+
+    def listen_for_changes(self):
+        """ Subscribe to the model change events published to Redis. While
+            the subscription is down, run() falls back to polling.
+        """
+        while True:
+            try:
+                import redis
+                r = redis.Redis("redis")
+                pubsub = r.pubsub()
+                pubsub.psubscribe("*")
+                watched = self.get_watched_models()
+                logger.info("MODEL POLICY: change feed subscribed, watching %s" % sorted(watched))
+
+                self.change_feed_ok = True
+                # Events may have been missed while we were not subscribed
+                self.mark_dirty(watched)
+
+                for item in pubsub.listen():
+                    if item["type"] not in ["message", "pmessage"]:
+                        continue
+                    self.handle_change_event(item["channel"], item["data"], watched)
+            except ImportError:
+                logger.info("MODEL POLICY: redis module not available, policies will be polled")
+                self.change_feed_ok = False
+                return
+            except Exception:
+                logger.log_exc("MODEL POLICY: change feed failed, falling back to polling")
+
+            self.change_feed_ok = False
+            time.sleep(10)
+
+    def start_change_feed(self):
+        t = threading.Thread(target=self.listen_for_changes, name="policy-change-feed")
+        t.daemon = True
+        t.start()
+
+    def select_models(self):
+        """ Decide which models to police on this pass. Returns None to poll
+            every model, or the set of model names that changed.
+        """
+        if (not self.change_feed_ok) or (time.time() - self.last_full_scan >= self.reconcile_interval):
+            self.take_dirty_models()
+            self.last_full_scan = time.time()
+            return None
+
+        return self.take_dirty_models()
+
     def run(self):
+        self.start_change_feed()
+
         while (True):
-            start = time.time()
             try:
-                self.run_policy_once()
+                model_names = self.select_models()
+                if (model_names is None) or model_names:
+                    self.run_policy_once(model_names)
             except:
                 logger.log_exc("MODEL_POLICY: Exception in run()")
-            if (time.time() - start < 5):
-                time.sleep(5)
+
+            self.wait_for_event(timeout=self.poll_interval)
+
+    def execute_model_policies(self, work, deletion=False):
+        """ Run execute_model_policy(object, action) for each pair in work.
+
+            Objects of a model are policed only after the objects of the
+            models it depends on (for deletions, the models that depend on
+            it) are done. Otherwise objects are policed concurrently, though
+            the handlers of a policy that is not thread_safe do not overlap
+            each other.
+        """
+        if not work:
+            return
+
+        if (self.pool_size <= 1) or (len(work) == 1):
+            for (o, action) in work:
+                self.execute_model_policy(o, action)
+            return
+
+        # The nodes are the indexes of the objects in work, plus a ("done",
+        # model) node per model that completes once all its objects have.
+        # Objects wait on the "done" nodes of the models they depend on.
+        by_model = {}
+        for (i, (o, action)) in enumerate(work):
+            by_model.setdefault(getattr(o, "model_name", o.__class__.__name__), []).append(i)
+
+        dependencies = self.get_model_dependencies(by_model.keys(), deletion)
+        graph = {}
+        for (model_name, indexes) in by_model.items():
+            graph[("done", model_name)] = indexes
+            for i in indexes:
+                graph[i] = [("done", x) for x in dependencies[model_name]]
+
+        def police(node):
+            if not isinstance(node, tuple):
+                self.execute_model_policy(*work[node])
+
+        nodes = range(len(work)) + [("done", x) for x in by_model.keys()]
+        pool = WorkerPool(min(self.pool_size, len(work)), name="model-policy",
+                          exit_hook=model_accessor.connection_close)
+        try:
+            DAGScheduler(pool, graph, nodes, police).run()
+        finally:
+            pool.shutdown()
+
+    def log_policy_metrics(self):
+        for ((policy_name, action), m) in sorted(self.get_policy_metrics().items()):
+            logger.info("MODEL POLICY: %s %s count=%d failures=%d mean=%.3fs max=%.3fs" %
+                        (policy_name, action, m["count"], m["failures"], m["total"] / m["count"], m["max"]))
 
     # TODO: This loop is different from the synchronizer event_loop, but they both do mostly the same thing. Look for
     # ways to combine them.
 
-    def run_policy_once(self):
-            models = self.policies_by_class.keys()
+    def run_policy_once(self, model_names=None):
+            """ Police the objects of every model, or if model_names is
+                given, of the models with those names.
+            """
+            if model_names is None:
+                models = self.policies_by_class.keys()
+            else:
+                models = set()
+                for name in model_names:
+                    models.update([policy.model for policy in self.policies_by_name.get(name, [])])
+                models = list(models)
 
-            logger.debug("MODEL POLICY: run_policy_once()")
+            logger.debug("MODEL POLICY: run_policy_once(%s)" % (sorted(model_names) if model_names is not None else "all"))
 
             model_accessor.check_db_connection_okay()
 
             objects = model_accessor.fetch_policies(models, False)
             deleted_objects = model_accessor.fetch_policies(models, True)
 
+            work = []
             for o in objects:
                 if o.deleted:
                     # This shouldn't happen, but previous code was examining o.deleted. Verify.
                     continue
                 if not o.policed:
-                    self.execute_model_policy(o, "create")
+                    work.append((o, "create"))
                 else:
-                    self.execute_model_policy(o, "update")
+                    work.append((o, "update"))
+
+            start = time.time()
+            try:
+                self.execute_model_policies(work)
+                self.execute_model_policies([(o, "delete") for o in deleted_objects], deletion=True)
+            finally:
+                self.flush_policy_status()
 
-            for o in deleted_objects:
-                self.execute_model_policy(o, "delete")
+            if work or deleted_objects:
+                logger.info("MODEL POLICY: policed %d objects in %.3fs" % (len(work) + len(deleted_objects), time.time() - start))
+                self.log_policy_metrics()
 
             try:
                 model_accessor.reset_queries()
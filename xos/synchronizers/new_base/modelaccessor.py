@@ -11,7 +11,10 @@
 import functools
 import os
 import signal
+import threading
+import time
 from xosconfig import Config
+from xosconfig.bookkeeping import BOOKKEEPING_FIELDS
 from diag import update_diag
 
 from xos.logger import Logger, logging
@@ -20,11 +23,24 @@ logger = Logger(level=logging.INFO)
 
 orig_sigint = None
 model_accessor = None
+orm_cache = None
 
 
 class ModelAccessor(object):
+    # An incremental fetch also returns objects updated up to this many
+    # seconds before the previous fetch started, in case the transaction
+    # that saved them committed after that fetch ran.
+    FETCH_WINDOW_OVERLAP = 10
+
     def __init__(self):
         self.all_model_classes = self.get_all_model_classes()
+        self.fetch_windows = {}
+
+        # write-behind buffer for save_bookkeeping
+        self.bookkeeping = {}
+        self.bookkeeping_since = None
+        self.bookkeeping_lock = threading.Lock()
+        self.bookkeeping_flush_lock = threading.Lock()
 
     def get_all_model_classes(self):
         """ Build a dictionary of all model class names """
@@ -46,6 +62,103 @@ class ModelAccessor(object):
         """ Execute the default fetch_pending query """
         raise Exception("Not Implemented")
 
+    def fetch_window_start(self):
+        """ Return the time, in the units of the updated field, from which
+            the next incremental fetch should start.
+        """
+        raise Exception("Not Implemented")
+
+    def get_fetch_window(self, kind, main_obj):
+        """ Begin an incremental fetch of kind ("pending" or "policies") for
+            main_obj. Returns None if incremental fetching is disabled.
+            Otherwise returns a window whose "since" and "ids" say which
+            objects need to be considered: those updated at or after since,
+            plus those in ids, which an earlier fetch returned and which may
+            still be dirty. A since of None means a full scan is due.
+        """
+        if not Config.get("incremental_fetch"):
+            return None
+
+        key = (kind, main_obj.__name__)
+        window = {"key": key, "since": None, "ids": [], "start": self.fetch_window_start(),
+                  "full_scan": time.time()}
+
+        last = self.fetch_windows.get(key)
+        if last and (time.time() - last["full_scan"] < Config.get("full_scan_interval")):
+            window["since"] = last["start"]
+            window["ids"] = last["ids"]
+            window["full_scan"] = last["full_scan"]
+
+        return window
+
+    def save_fetch_window(self, window, objs):
+        """ Complete an incremental fetch started with get_fetch_window.
+            Returns objs as a list.
+        """
+        objs = list(objs)
+        if window is not None:
+            window["ids"] = [o.id for o in objs]
+            self.fetch_windows[window["key"]] = window
+        return objs
+
+    def save_bookkeeping(self, o, update_fields):
+        """ Save the synchronizer bookkeeping fields (enacted, backend_status,
+            ...) of o.
+
+            If bookkeeping_flush_interval is set, the write is buffered:
+            writes to the same object are coalesced, and the buffer is
+            written in bulk by flush_bookkeeping, or as soon as its oldest
+            write is bookkeeping_flush_interval seconds old.
+        """
+        flush_interval = Config.get("bookkeeping_flush_interval")
+        if not flush_interval:
+            o.save(update_fields=update_fields)
+            return
+
+        key = (getattr(o, "model_name", o.__class__.__name__), o.pk)
+        with self.bookkeeping_lock:
+            entry = self.bookkeeping.setdefault(key, {"obj": o, "values": {}})
+            entry["obj"] = o
+            for field in update_fields:
+                entry["values"][field] = getattr(o, field)
+            if self.bookkeeping_since is None:
+                self.bookkeeping_since = time.time()
+            flush = (time.time() - self.bookkeeping_since >= flush_interval)
+
+        if flush:
+            self.flush_bookkeeping()
+
+    def flush_bookkeeping(self):
+        """ Write out the buffered bookkeeping updates """
+        with self.bookkeeping_flush_lock:
+            with self.bookkeeping_lock:
+                entries = self.bookkeeping.values()
+                self.bookkeeping = {}
+                self.bookkeeping_since = None
+
+            if not entries:
+                return
+
+            try:
+                self.update_bookkeeping([(e["obj"], e["values"]) for e in entries])
+            except:
+                logger.log_exc("Bulk bookkeeping update failed, saving objects one at a time")
+                for e in entries:
+                    try:
+                        for (k, v) in e["values"].items():
+                            setattr(e["obj"], k, v)
+                        e["obj"].save(update_fields=e["values"].keys())
+                    except:
+                        logger.log_exc("Could not save bookkeeping fields of %s" % e["obj"])
+
+    def update_bookkeeping(self, updates, silent=False):
+        """ Write bookkeeping fields in bulk. updates is a list of
+            (object, {field_name: value}). If silent is set, accessors that
+            can do so publish no change events for the writes.
+        """
+        for (o, values) in updates:
+            o.save(update_fields=values.keys())
+
     def reset_queries(self):
         """ Reset any state between passes of synchronizer. For django, to
             limit memory consumption of cached queries.
@@ -74,10 +187,11 @@ class ModelAccessor(object):
         """ Return the current time for timestamping purposes """
         raise Exception("Not Implemented")
 
-    def update_diag(self, loop_end=None, loop_start=None, syncrecord_start=None, sync_start=None, backend_status=None):
+    def update_diag(self, loop_end=None, loop_start=None, syncrecord_start=None, sync_start=None, backend_status=None,
+                    step_metrics=None):
         if self.has_model_class("Diag"):
             return update_diag(self.get_model_class("Diag"), loop_end, loop_start, syncrecord_start, sync_start,
-                               backend_status)
+                               backend_status, step_metrics)
 
     def is_type(self, obj, name):
         """ returns True is obj is of model type "name" """
@@ -87,6 +201,12 @@ class ModelAccessor(object):
         """ returns True if obj is of model type "name" or is a descendant """
         raise Exception("Not Implemented")
 
+    def get_foreign_key_ids(self, obj):
+        """ Return a (model name, id) pair for each object that obj refers
+            to with a foreign key.
+        """
+        return []
+
     def get_content_type_id(self, obj):
         raise Exception("Not Implemented")
 
@@ -142,6 +262,19 @@ def grpcapi_reconnect(client, reactor):
     # this will prevent updated timestamps from being automatically updated
     client.xos_orm.caller_kind = "synchronizer"
 
+    # Share one object cache across reconnects, so that its invalidation
+    # listener is only started once
+    global orm_cache
+    if Config.get("orm_cache_size"):
+        if not orm_cache:
+            from xosapi.orm import ORMCache
+            orm_cache = ORMCache(size=Config.get("orm_cache_size"), ttl=Config.get("orm_cache_ttl"))
+            orm_cache.start_listener()
+        else:
+            # the models may have changed while we were disconnected
+            orm_cache.clear()
+        client.xos_orm.set_cache(orm_cache)
+
     from apiaccessor import CoreApiModelAccessor
     model_accessor = CoreApiModelAccessor(orm=client.xos_orm)
 
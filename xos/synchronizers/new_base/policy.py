@@ -15,8 +15,16 @@ class Policy(object):
             handle_create ... called when a model is created
             handle_update ... called when a model is updated
             handle_delete ... called when a model is deleted
+
+        Set thread_safe to True if the handlers keep no state in the policy
+        object and may run at the same time as each other. The policy engine
+        then shares one instance of the policy between its threads and runs
+        its handlers concurrently. Otherwise the handlers of the policy run
+        one at a time, though they may overlap those of other policies.
     """
 
+    thread_safe = False
+
     def __init__(self):
         self.logger = Logger(level=logging.DEBUG)
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+""" policy_cascade_benchmark.py
+
+    Measure how long a change takes to cascade through a chain of model
+    policies, where the policy of each model in the chain creates an
+    object of the next one. The policy engine is run once polling every
+    model, and once driven by change events.
+
+    Objects live in memory and change events are delivered directly to
+    the engine instead of through Redis, so only the engine's own latency
+    is measured.
+
+    Usage:
+        python policy_cascade_benchmark.py [-C synchronizer_config.yaml] [-n 4] [-i 1.0] [-r 3]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")))
+
+
+class FakeObject(object):
+    def __init__(self, store, model_name, id):
+        self.store = store
+        self.model_name = model_name
+        self.id = id
+        self.deleted = False
+        self.policed = None
+        self.policy_status = None
+
+    def save(self, update_fields=None):
+        pass
+
+
+class FakeModelAccessor(object):
+    """ Keeps objects in memory. If engine is set, every object created is
+        announced to it like XOSBase.push_redis_event would.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = []
+        self.engine = None
+
+    def create(self, model_name):
+        with self.lock:
+            o = FakeObject(self, model_name, len(self.objects) + 1)
+            self.objects.append(o)
+        if self.engine:
+            event = json.dumps({"pk": o.id, "changed_fields": [], "object": {"class_names": model_name}})
+            self.engine.handle_change_event(model_name, event, self.engine.get_watched_models())
+        return o
+
+    def fetch_policies(self, models, deletion=False):
+        if deletion:
+            return []
+        with self.lock:
+            return [o for o in self.objects if (o.model_name in models) and (not o.policed)]
+
+    def now(self):
+        return time.time()
+
+    def update_bookkeeping(self, updates, silent=False):
+        pass
+
+    def check_db_connection_okay(self):
+        pass
+
+    def reset_queries(self):
+        pass
+
+    def connection_close(self):
+        pass
+
+
+def make_policies(hops, done):
+    """ Return policies for models Hop0 ... Hop<hops>. The policy of each
+        model creates an object of the next, and the last one sets done.
+    """
+    from synchronizers.new_base.policy import Policy
+
+    policies = []
+    for i in range(hops + 1):
+        def handle_create(self, instance, next_model="Hop%d" % (i + 1), last=(i == hops)):
+            if last:
+                done.set()
+            else:
+                instance.store.create(next_model)
+
+        policies.append(type("Hop%dPolicy" % i, (Policy,), {"model_name": "Hop%d" % i,
+                                                           "model": "Hop%d" % i,
+                                                           "handle_create": handle_create}))
+    return policies
+
+
+def time_cascade(hops, poll_interval, events):
+    from synchronizers.new_base import model_policy_loop
+    from synchronizers.new_base.model_policy_loop import XOSPolicyEngine
+
+    done = threading.Event()
+    policies = make_policies(hops, done)
+    accessor = FakeModelAccessor()
+    model_policy_loop.model_accessor = accessor
+
+    class BenchmarkPolicyEngine(XOSPolicyEngine):
+        def load_model_policies(self, policies_dir):
+            return policies
+
+        def load_dependency_graph(self):
+            return {}
+
+        def start_change_feed(self):
+            self.change_feed_ok = events
+
+        def run_policy_once(self, model_names=None):
+            # the engine thread outlives the run, keep it off later runs
+            if not done.is_set():
+                XOSPolicyEngine.run_policy_once(self, model_names)
+
+    engine = BenchmarkPolicyEngine(policies_dir=None)
+    engine.poll_interval = poll_interval
+    if events:
+        accessor.engine = engine
+
+    t = threading.Thread(target=engine.run)
+    t.daemon = True
+    t.start()
+
+    # let the first pass, which polls every model, go by
+    time.sleep(0.1)
+
+    tStart = time.time()
+    accessor.create("Hop0")
+    if not done.wait(poll_interval * (hops + 2) + 10):
+        raise Exception("cascade did not complete")
+    return time.time() - tStart
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-C", dest="config", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_config.yaml"),
+                        help="synchronizer config file")
+    parser.add_argument("-n", dest="hops", type=int, default=4, help="policy hops in the cascade")
+    parser.add_argument("-i", dest="interval", type=float, default=1.0, help="poll interval, in seconds (5 in production)")
+    parser.add_argument("-r", dest="repeat", type=int, default=3, help="runs per mode, the mean is reported")
+    args = parser.parse_args()
+
+    from xosconfig import Config
+    Config.init(os.path.abspath(args.config), 'synchronizer-config-schema.yaml')
+
+    results = []
+    for (label, events) in (("polling", False), ("change events", True)):
+        elapsed = [time_cascade(args.hops, args.interval, events) for i in range(args.repeat)]
+        results.append((label, sum(elapsed) / len(elapsed)))
+
+    print "policy hops:            %d" % args.hops
+    print "poll interval:          %.1f s" % args.interval
+    for (label, elapsed) in results:
+        print "%-22s  %.3f s (%.3f s/hop)" % (label + ":", elapsed, elapsed / args.hops)
+    print "speedup:                %.1fx" % (results[0][1] / results[1][1])
+
+
+if __name__ == "__main__":
+    main()
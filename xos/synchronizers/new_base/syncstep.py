@@ -3,11 +3,15 @@ import base64
 from xosconfig import Config
 from xos.logger import Logger, logging
 from synchronizers.new_base.modelaccessor import *
-from synchronizers.new_base.ansible_helper import run_template
+from synchronizers.new_base.ansible_helper import run_template, run_template_batch
 
 import json
 import time
 import pdb
+import threading
+from collections import OrderedDict
+from synchronizers.new_base.workerpool import WorkerPool
+from synchronizers.new_base.toposort import toposort
 
 logger = Logger(level=logging.DEBUG)
 
@@ -59,6 +63,15 @@ class SyncStep(object):
 
     slow = False
 
+    # Number of pending objects that call() may sync concurrently. Steps
+    # whose objects can be synced independently may raise this.
+    max_parallel = 1
+
+    # If set, call() syncs pending objects in groups of up to batch_size
+    # with sync_records(), running one playbook per group rather than one
+    # per object. The playbook must loop over xos_batch.
+    batch_size = None
+
     def get_prop(self, prop):
         # NOTE config_dir is never define, is this used?
         sync_config_dir = Config.get("config_dir")
@@ -125,7 +138,7 @@ class SyncStep(object):
             if (model_accessor.obj_in_list(failed, peer_objects)):
                 if (obj.backend_status != failed.backend_status):
                     obj.backend_status = failed.backend_status
-                    obj.save(update_fields=['backend_status'])
+                    model_accessor.save_bookkeeping(obj, ['backend_status'])
                 raise FailedDependency("Failed dependency for %s:%s peer %s:%s failed  %s:%s" % (
                 obj_class_name(obj), str(getattr(obj, "pk", "no_pk")), obj_class_name(peer_object),
                 str(getattr(peer_object, "pk", "no_pk")), obj_class_name(failed), str(getattr(failed, "pk", "no_pk"))))
@@ -185,139 +198,370 @@ class SyncStep(object):
         except AttributeError:
             pass
 
-    def call(self, failed=[], deletion=False):
-        pending = self.fetch_pending(deletion)
+    def get_shard_key(self, o):
+        """ Objects that share a shard key are never synced concurrently when
+            max_parallel is set. Override this to serialize objects that
+            touch the same resource, for example the same host. Objects
+            linked by a foreign key always share a shard, see get_shards.
+        """
+        return (obj_class_name(o), getattr(o, "pk", id(o)))
 
-        for o in pending:
-            # another spot to clean up debug state
-            try:
-                model_accessor.reset_queries()
-            except:
-                # this shouldn't happen, but in case it does, catch it...
-                logger.log_exc("exception in reset_queries", extra=o.tologdict())
+    def get_shards(self, pending):
+        """ Split pending into lists of objects that may be synced
+            concurrently with each other.
+
+            Objects with the same shard key, and objects linked by a
+            foreign key, such as an Instance and its parent, land in the
+            same shard. Within a shard objects come after the objects
+            they link to, so a dependency is synced before its dependents
+            and check_failed_dependencies sees it if it failed.
+        """
+        # union-find over indexes into pending
+        parent = range(len(pending))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        by_shard_key = {}
+        by_id = {}
+        for (i, o) in enumerate(pending):
+            key = self.get_shard_key(o)
+            if key in by_shard_key:
+                parent[find(i)] = find(by_shard_key[key])
+            else:
+                by_shard_key[key] = i
+            by_id[(obj_class_name(o), getattr(o, "pk", None))] = i
+
+        links = {}
+        for (i, o) in enumerate(pending):
+            links[i] = [by_id[k] for k in model_accessor.get_foreign_key_ids(o) if by_id.get(k, i) != i]
+            for j in links[i]:
+                parent[find(i)] = find(j)
+
+        shards = OrderedDict()
+        for i in range(len(pending)):
+            shards.setdefault(find(i), []).append(i)
+
+        # a cycle of links leaves the order within the cycle arbitrary
+        cycles = []
+        result = [[pending[i] for i in toposort(links, indexes, cycles)] for indexes in shards.values()]
+        for cycle in cycles:
+            logger.warning("Dependency cycle among pending objects: %s" %
+                           " -> ".join(["%s:%s" % (obj_class_name(pending[i]), getattr(pending[i], "pk", None)) for i in cycle]))
+        return result
+
+    def get_batches(self, pending):
+        """ Split pending into lists of up to batch_size objects, each
+            synced by one playbook run. Batches may run concurrently, so a
+            shard is never split across batches, and a shard larger than
+            batch_size gets a batch of its own.
+        """
+        batches = []
+        batch = []
+        for shard in self.get_shards(pending):
+            if batch and (len(batch) + len(shard) > self.batch_size):
+                batches.append(batch)
+                batch = []
+            batch.extend(shard)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def in_backoff(self, o):
+        """ Return True if o failed recently and should not be retried yet """
+        backoff_disabled = Config.get("backoff_disabled")
+
+        try:
+            scratchpad = json.loads(o.backend_register)
+            if (scratchpad):
+                next_run = scratchpad['next_run']
+                if (not backoff_disabled and next_run > time.time()):
+                    return True
+        except:
+            logger.log_exc("Exception while loading scratchpad", extra=o.tologdict())
+            pass
+
+        return False
+
+    def check_failed_dependencies(self, o, failed):
+        with self.failed_lock:
+            failed_snapshot = list(failed)
+        for f in failed_snapshot:
+            self.check_dependencies(o, f)  # Raises exception if failed
+
+    def mark_need_delete(self, o):
+        # Mark this as an object that will require delete. Do
+        # this now rather than after the syncstep,
+        if not (o.backend_need_delete):
+            o.backend_need_delete = True
+            o.save(update_fields=['backend_need_delete'])
+
+    def mark_synced(self, o, new_enacted):
+        model_accessor.update_diag(syncrecord_start=time.time(), backend_status="1 - Synced Record")
+        o.enacted = new_enacted
+        scratchpad = {'next_run': 0, 'exponent': 0, 'last_success': time.time()}
+        o.backend_register = json.dumps(scratchpad)
+        o.backend_status = "1 - OK"
+        model_accessor.journal_object(o, "syncstep.call.save_update")
+        model_accessor.save_bookkeeping(o, ['enacted', 'backend_status', 'backend_register'])
+        logger.info("save sync object, new enacted = %s" % str(new_enacted))
+
+    def mark_failed(self, o, e):
+        """ Record the failure of o in backend_status and schedule its retry """
+        try:
+            if (o.backend_status.startswith('2 - ')):
+                str_e = '%s // %r' % (o.backend_status[4:], e)
+                str_e = elim_dups(str_e)
+            else:
+                str_e = '%r' % e
+        except:
+            str_e = '%r' % e
 
-            sync_failed = False
+        try:
+            error = self.error_map.map(str_e)
+        except:
+            error = '%s' % str_e
+
+        if isinstance(e, InnocuousException):
+            o.backend_status = '1 - %s' % error
+        else:
+            o.backend_status = '2 - %s' % error
+
+        try:
+            scratchpad = json.loads(o.backend_register)
+            scratchpad['exponent']
+        except:
+            logger.log_exc("Exception while updating scratchpad", extra=o.tologdict())
+            scratchpad = {'next_run': 0, 'exponent': 0, 'last_success': time.time(), 'failures': 0}
+
+        # Second failure
+        if (scratchpad['exponent']):
+            if isinstance(e, DeferredException):
+                delay = scratchpad['exponent'] * 60  # 1 minute
+            else:
+                delay = scratchpad['exponent'] * 600  # 10 minutes
+            # cap delays at 8 hours
+            if (delay > 8 * 60 * 60):
+                delay = 8 * 60 * 60
+            scratchpad['next_run'] = time.time() + delay
+
+        try:
+            scratchpad['exponent'] += 1
+        except:
+            scratchpad['exponent'] = 1
+
+        try:
+            scratchpad['failures'] += 1
+        except KeyError:
+            scratchpad['failures'] = 1
+
+        scratchpad['last_failure'] = time.time()
 
-            backoff_disabled = Config.get("backoff_disabled")
+        o.backend_register = json.dumps(scratchpad)
 
+        # TOFIX:
+        # DatabaseError: value too long for type character varying(140)
+        if (model_accessor.obj_exists(o)):
             try:
-                scratchpad = json.loads(o.backend_register)
-                if (scratchpad):
-                    next_run = scratchpad['next_run']
-                    if (not backoff_disabled and next_run > time.time()):
-                        sync_failed = True
+                o.backend_status = o.backend_status[:1024]
+                model_accessor.save_bookkeeping(o, ['backend_status', 'backend_register'])
             except:
-                logger.log_exc("Exception while loading scratchpad", extra=o.tologdict())
+                print "Could not update backend status field!"
                 pass
 
-            if (not sync_failed):
-                try:
-                    for f in failed:
-                        self.check_dependencies(o, f)  # Raises exception if failed
-                    if (deletion):
-                        if getattr(o, "backend_need_reap", False):
-                            # the object has already been deleted and marked for reaping
-                            model_accessor.journal_object(o, "syncstep.call.already_marked_reap")
-                        else:
-                            model_accessor.journal_object(o, "syncstep.call.delete_record")
-                            self.delete_record(o)
-                            model_accessor.journal_object(o, "syncstep.call.delete_set_reap")
-                            o.backend_need_reap = True
-                            o.save(update_fields=['backend_need_reap'])
-                            # o.delete(purge=True)
-                    else:
-                        new_enacted = model_accessor.now()
-                        try:
-                            run_always = self.run_always
-                        except AttributeError:
-                            run_always = False
-
-                        # Mark this as an object that will require delete. Do
-                        # this now rather than after the syncstep,
-                        if not (o.backend_need_delete):
-                            o.backend_need_delete = True
-                            o.save(update_fields=['backend_need_delete'])
-
-                        model_accessor.journal_object(o, "syncstep.call.sync_record")
-                        self.sync_record(o)
-
-                        model_accessor.update_diag(syncrecord_start=time.time(), backend_status="1 - Synced Record")
-                        o.enacted = new_enacted
-                        scratchpad = {'next_run': 0, 'exponent': 0, 'last_success': time.time()}
-                        o.backend_register = json.dumps(scratchpad)
-                        o.backend_status = "1 - OK"
-                        model_accessor.journal_object(o, "syncstep.call.save_update")
-                        o.save(update_fields=['enacted', 'backend_status', 'backend_register'])
-                        logger.info("save sync object, new enacted = %s" % str(new_enacted))
-                except (InnocuousException, Exception, DeferredException) as e:
-                    logger.log_exc("sync step failed!", extra=o.tologdict())
-                    try:
-                        if (o.backend_status.startswith('2 - ')):
-                            str_e = '%s // %r' % (o.backend_status[4:], e)
-                            str_e = elim_dups(str_e)
-                        else:
-                            str_e = '%r' % e
-                    except:
-                        str_e = '%r' % e
+    def sync_object(self, o, failed, deletion):
+        # another spot to clean up debug state
+        try:
+            model_accessor.reset_queries()
+        except:
+            # this shouldn't happen, but in case it does, catch it...
+            logger.log_exc("exception in reset_queries", extra=o.tologdict())
 
-                    try:
-                        error = self.error_map.map(str_e)
-                    except:
-                        error = '%s' % str_e
+        sync_failed = self.in_backoff(o)
 
-                    if isinstance(e, InnocuousException):
-                        o.backend_status = '1 - %s' % error
+        if (not sync_failed):
+            try:
+                self.check_failed_dependencies(o, failed)
+                if (deletion):
+                    if getattr(o, "backend_need_reap", False):
+                        # the object has already been deleted and marked for reaping
+                        model_accessor.journal_object(o, "syncstep.call.already_marked_reap")
                     else:
-                        o.backend_status = '2 - %s' % error
+                        model_accessor.journal_object(o, "syncstep.call.delete_record")
+                        self.delete_record(o)
+                        model_accessor.journal_object(o, "syncstep.call.delete_set_reap")
+                        o.backend_need_reap = True
+                        o.save(update_fields=['backend_need_reap'])
+                        # o.delete(purge=True)
+                else:
+                    new_enacted = model_accessor.now()
+
+                    self.mark_need_delete(o)
+
+                    model_accessor.journal_object(o, "syncstep.call.sync_record")
+                    self.sync_record(o)
+
+                    self.mark_synced(o, new_enacted)
+            except (InnocuousException, Exception, DeferredException) as e:
+                logger.log_exc("sync step failed!", extra=o.tologdict())
+                self.mark_failed(o, e)
+                sync_failed = True
+
+        if (sync_failed):
+            with self.failed_lock:
+                failed.append(o)
 
-                    try:
-                        scratchpad = json.loads(o.backend_register)
-                        scratchpad['exponent']
-                    except:
-                        logger.log_exc("Exception while updating scratchpad", extra=o.tologdict())
-                        scratchpad = {'next_run': 0, 'exponent': 0, 'last_success': time.time(), 'failures': 0}
-
-                    # Second failure
-                    if (scratchpad['exponent']):
-                        if isinstance(e, DeferredException):
-                            delay = scratchpad['exponent'] * 60  # 1 minute
-                        else:
-                            delay = scratchpad['exponent'] * 600  # 10 minutes
-                        # cap delays at 8 hours
-                        if (delay > 8 * 60 * 60):
-                            delay = 8 * 60 * 60
-                        scratchpad['next_run'] = time.time() + delay
+    def get_batch_tag(self, o):
+        return getattr(o, "ansible_tag", "%s_%s" % (obj_class_name(o), str(getattr(o, "pk", "no_pk"))))
 
-                    try:
-                        scratchpad['exponent'] += 1
-                    except:
-                        scratchpad['exponent'] = 1
+    def sync_records(self, objs):
+        """ Sync several objects with a single run of the playbook.
 
-                    try:
-                        scratchpad['failures'] += 1
-                    except KeyError:
-                        scratchpad['failures'] = 1
-
-                    scratchpad['last_failure'] = time.time()
-
-                    o.backend_register = json.dumps(scratchpad)
-
-                    # TOFIX:
-                    # DatabaseError: value too long for type character varying(140)
-                    if (model_accessor.obj_exists(o)):
-                        try:
-                            o.backend_status = o.backend_status[:1024]
-                            o.save(update_fields=['backend_status', 'backend_register', 'updated'])
-                        except:
-                            print "Could not update backend status field!"
-                            pass
-                    sync_failed = True
-
-            if (sync_failed):
-                failed.append(o)
+            Used instead of sync_record when batch_size is set. The playbook
+            is rendered with xos_batch holding the map_sync_inputs of each
+            object, and must loop over it (see run_template_batch). Each
+            object's map_sync_outputs receives the results of its own items.
+
+            Returns a list with, for each object, None if it was synced or
+            the exception that made it fail.
+        """
+        exceptions = [None] * len(objs)
+
+        batch = []
+        for (i, o) in enumerate(objs):
+            try:
+                tenant_fields = self.map_sync_inputs(o)
+            except Exception as e:
+                exceptions[i] = e
+                continue
+            if tenant_fields == SyncStep.SYNC_WITHOUT_RUNNING:
+                continue
+            tenant_fields = dict(tenant_fields)
+            tenant_fields["ansible_tag"] = self.get_batch_tag(o)
+            batch.append((i, o, tenant_fields))
+
+        if not batch:
+            return exceptions
+
+        main_objs = self.observes
+        if (type(main_objs) is list):
+            main_objs = main_objs[0]
+
+        path = ''.join(main_objs.__name__).lower()
+        playbook = getattr(self, "batch_playbook", self.playbook)
+
+        try:
+            (results, errors) = run_template_batch(playbook, [fields for (i, o, fields) in batch], path=path)
+        except Exception as e:
+            for (i, o, fields) in batch:
+                exceptions[i] = e
+            return exceptions
+
+        for (i, o, fields) in batch:
+            tag = fields["ansible_tag"]
+            if tag in errors:
+                exceptions[i] = Exception(errors[tag])
+            elif hasattr(self, "map_sync_outputs"):
+                try:
+                    self.map_sync_outputs(o, results[tag])
+                except Exception as e:
+                    exceptions[i] = e
+
+        return exceptions
+
+    def sync_batch(self, objs, failed):
+        ready = []
+        for o in objs:
+            try:
+                model_accessor.reset_queries()
+            except:
+                # this shouldn't happen, but in case it does, catch it...
+                logger.log_exc("exception in reset_queries", extra=o.tologdict())
+
+            if self.in_backoff(o):
+                with self.failed_lock:
+                    failed.append(o)
+                continue
+
+            try:
+                self.check_failed_dependencies(o, failed)
+                self.mark_need_delete(o)
+                model_accessor.journal_object(o, "syncstep.call.sync_records")
+                ready.append(o)
+            except Exception as e:
+                logger.log_exc("sync step failed!", extra=o.tologdict())
+                self.mark_failed(o, e)
+                with self.failed_lock:
+                    failed.append(o)
+
+        if not ready:
+            return
+
+        new_enacted = model_accessor.now()
+        try:
+            exceptions = self.sync_records(ready)
+        except Exception as e:
+            logger.log_exc("sync step failed!")
+            exceptions = [e] * len(ready)
+
+        for (o, e) in zip(ready, exceptions):
+            if e is None:
+                self.mark_synced(o, new_enacted)
+            else:
+                logger.error("sync step failed for %s: %r" % (str(o), e), extra=o.tologdict())
+                self.mark_failed(o, e)
+                with self.failed_lock:
+                    failed.append(o)
+
+    def sync_shard(self, objs, failed, deletion):
+        for o in objs:
+            self.sync_object(o, failed, deletion)
+
+    def call(self, failed=[], deletion=False):
+        pending = self.fetch_pending(deletion)
+
+        self.failed_lock = threading.Lock()
+
+        try:
+            self.sync_pending(pending, failed, deletion)
+        finally:
+            # write out the bookkeeping fields buffered by save_bookkeeping
+            model_accessor.flush_bookkeeping()
 
         return failed
 
+    def sync_pending(self, pending, failed, deletion):
+        if self.batch_size and (not deletion):
+            # Each batch is synced by a single playbook run. Batches may
+            # themselves run concurrently if max_parallel is set.
+            batches = self.get_batches(pending)
+
+            pool = WorkerPool(min(self.max_parallel, max(len(batches), 1)), name="synchronizer-syncstep",
+                              exit_hook=model_accessor.connection_close)
+            try:
+                for objs in batches:
+                    pool.submit(self.sync_batch, objs, failed)
+            finally:
+                pool.shutdown()
+        elif (self.max_parallel > 1) and (len(pending) > 1):
+            # Objects within a shard are synced in order; independent
+            # shards are synced concurrently.
+            shards = self.get_shards(pending)
+
+            pool = WorkerPool(min(self.max_parallel, len(shards)), name="synchronizer-syncstep",
+                              exit_hook=model_accessor.connection_close)
+            try:
+                for objs in shards:
+                    pool.submit(self.sync_shard, objs, failed, deletion)
+            finally:
+                pool.shutdown()
+        else:
+            for o in pending:
+                self.sync_object(o, failed, deletion)
+
     def __call__(self, **args):
         return self.call(**args)
 
@@ -0,0 +1,112 @@
+import unittest
+from mock import patch
+import mock
+import shutil
+import tempfile
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+import jinja2
+import synchronizers.new_base.ansible_helper as ansible_helper
+
+class TestRenderPlaybook(unittest.TestCase):
+    def setUp(self):
+        self.sys_dir = tempfile.mkdtemp()
+        self.step_dir = tempfile.mkdtemp()
+        open(os.path.join(self.step_dir, "sync_mock.yaml"), "w").write("name: {{ name }}\n")
+
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=[self.step_dir]))
+        self.patches = [patch.object(ansible_helper, "sys_dir", self.sys_dir),
+                        patch.object(ansible_helper, "step_dir", self.step_dir),
+                        patch.object(ansible_helper, "os_template_env", env)]
+        for p in self.patches:
+            p.start()
+        ansible_helper.playbook_cache.clear()
+        ansible_helper.prepared_dirs.clear()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.sys_dir)
+        shutil.rmtree(self.step_dir)
+
+    def test_render(self):
+        (opts, fqp) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+        self.assertEqual(fqp, os.path.join(self.sys_dir, "mock", "foo_1"))
+        self.assertEqual(open(fqp).read(), "name: foo")
+
+    def test_render_skips_identical(self):
+        (opts, fqp) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+        with patch.object(jinja2.Template, "render") as render:
+            ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+            self.assertFalse(render.called)
+
+        ansible_helper.render_playbook("sync_mock.yaml", {"name": "bar", "ansible_tag": "foo_1"}, "mock")
+        self.assertEqual(open(fqp).read(), "name: bar")
+
+    def test_render_rewrites_missing_file(self):
+        (opts, fqp) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+        os.remove(fqp)
+        ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+        self.assertEqual(open(fqp).read(), "name: foo")
+
+    def test_lru_cleanup(self):
+        with patch.object(ansible_helper.Config, "get", return_value=2):
+            fqps = []
+            for i in range(3):
+                (opts, fqp) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_%d" % i}, "mock")
+                open(fqp + ".out", "w").write("output")
+                fqps.append(fqp)
+
+            # touching foo_1 makes foo_2 the least recently used
+            ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+            ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_3"}, "mock")
+
+        self.assertFalse(os.path.exists(fqps[0]))
+        self.assertFalse(os.path.exists(fqps[0] + ".out"))
+        self.assertTrue(os.path.exists(fqps[1]))
+        self.assertFalse(os.path.exists(fqps[2]))
+        self.assertEqual(ansible_helper.playbook_cache.keys(), [fqps[1], os.path.join(self.sys_dir, "mock", "foo_3")])
+
+    def test_lru_skips_in_use(self):
+        with patch.object(ansible_helper.Config, "get", return_value=1):
+            (opts, fqp0) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_0"}, "mock")
+            with ansible_helper.playbook_in_use(fqp0):
+                (opts, fqp1) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+                self.assertTrue(os.path.exists(fqp0))
+                self.assertFalse(os.path.exists(fqp1))
+
+            # no longer in use, so the next render cleans it up
+            (opts, fqp2) = ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_2"}, "mock")
+
+        self.assertFalse(os.path.exists(fqp0))
+        self.assertTrue(os.path.exists(fqp2))
+        self.assertEqual(ansible_helper.playbook_cache.keys(), [fqp2])
+        self.assertEqual(ansible_helper.playbooks_in_use, {})
+
+    def test_load_playbook_cache(self):
+        os.makedirs(os.path.join(self.sys_dir, "mock"))
+        os.makedirs(os.path.join(self.sys_dir, ".jinja_cache"))
+        os.symlink(self.step_dir, os.path.join(self.sys_dir, "mock", "roles"))
+        old_1 = os.path.join(self.sys_dir, "mock", "old_1")
+        old_2 = os.path.join(self.sys_dir, "mock", "old_2")
+        for (fn, mtime) in [(old_1, 200), (old_1 + ".out", 300), (old_2 + ".key", 100),
+                            (os.path.join(self.sys_dir, ".jinja_cache", "t"), 0)]:
+            open(fn, "w").write("x")
+            os.utime(fn, (mtime, mtime))
+
+        ansible_helper.load_playbook_cache()
+        self.assertEqual(ansible_helper.playbook_cache.keys(), [old_2, old_1])
+
+        with patch.object(ansible_helper.Config, "get", return_value=1):
+            ansible_helper.render_playbook("sync_mock.yaml", {"name": "foo", "ansible_tag": "foo_1"}, "mock")
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.sys_dir, "mock"))), ["foo_1", "roles"])
+        self.assertTrue(os.path.exists(os.path.join(self.sys_dir, ".jinja_cache", "t")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from mock import patch
+import mock
+import json
+import time
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+from synchronizers.new_base.syncstep import SyncStep
+from synchronizers.new_base.event_loop import XOSObserver
+
+class Slice(object):
+    pass
+
+class Instance(object):
+    pass
+
+class SyncSlices(SyncStep):
+    provides = [Slice]
+    observes = Slice
+
+class SyncInstances(SyncStep):
+    provides = [Instance]
+    observes = Instance
+
+class PollSomething(SyncStep):
+    provides = []
+    observes = []
+
+    def fetch_pending(self, deletion=False):
+        return []
+
+def make_event(class_names, changed_fields=["name"]):
+    return json.dumps({"pk": 1, "changed_fields": changed_fields, "object": {"class_names": class_names}})
+
+class TestChangeFeed(unittest.TestCase):
+    def setUp(self):
+        with patch.object(XOSObserver, "load_sync_steps"):
+            self.observer = XOSObserver([SyncSlices, SyncInstances])
+        self.observer.step_models = {"SyncSlices": set(["Slice"]),
+                                     "SyncInstances": set(["Instance"])}
+        self.observer.change_feed_ok = True
+        self.observer.last_full_scan = time.time()
+        self.watched = self.observer.get_watched_models()
+
+    def test_step_models(self):
+        self.assertEqual(self.observer.get_step_models(SyncInstances), set(["Instance"]))
+        self.assertTrue(self.observer.step_is_change_driven(SyncSlices))
+        self.assertFalse(self.observer.step_is_change_driven(PollSomething))
+
+    def test_only_dirty_steps_run(self):
+        self.assertTrue(self.observer.handle_change_event("Slice", make_event("Slice,XOSBase"), self.watched))
+        self.assertEqual(self.observer.select_steps(), set(["SyncSlices"]))
+        # the dirty set was consumed
+        self.assertEqual(self.observer.select_steps(), set())
+
+    def test_subclass_event(self):
+        self.assertTrue(self.observer.handle_change_event("MyInstance", make_event("MyInstance,Instance,XOSBase"), self.watched))
+        self.assertEqual(self.observer.select_steps(), set(["SyncInstances"]))
+
+    def test_ignored_events(self):
+        self.assertFalse(self.observer.handle_change_event("Site", make_event("Site,XOSBase"), self.watched))
+        self.assertFalse(self.observer.handle_change_event("Slice", make_event("Slice", ["enacted", "backend_status"]), self.watched))
+        self.assertEqual(self.observer.select_steps(), set())
+
+    def test_idle_pass_does_nothing(self):
+        with patch("synchronizers.new_base.event_loop.model_accessor") as accessor:
+            self.observer.run_once()
+            self.assertFalse(accessor.check_db_connection_okay.called)
+
+    def test_full_scan(self):
+        self.observer.last_full_scan = time.time() - Config.get("full_scan_interval")
+        self.assertEqual(self.observer.select_steps(), None)
+        self.assertEqual(self.observer.select_steps(), set())
+
+    def test_feed_down(self):
+        self.observer.change_feed_ok = False
+        self.assertEqual(self.observer.select_steps(), None)
+
+    def test_steps_that_poll(self):
+        self.observer.step_models["PollSomething"] = None
+        self.assertEqual(self.observer.select_steps(), set(["PollSomething"]))
+
+if __name__ == '__main__':
+    unittest.main()
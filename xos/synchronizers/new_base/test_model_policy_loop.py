@@ -0,0 +1,297 @@
+import unittest
+from mock import patch
+import mock
+import json
+import threading
+import time
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+from synchronizers.new_base.policy import Policy
+from synchronizers.new_base.model_policy_loop import XOSPolicyEngine
+
+class FakeModel(object):
+    def __init__(self, model_name, id):
+        self.model_name = model_name
+        self.id = id
+        self.policed = None
+        self.policy_status = None
+
+    def save(self, update_fields=None):
+        pass
+
+# (model_name, id, action) of each policy call, as (start, end) times
+calls = {}
+calls_lock = threading.Lock()
+
+def record(instance, action):
+    start = time.time()
+    time.sleep(0.05)
+    with calls_lock:
+        calls[(instance.model_name, instance.id, action)] = (start, time.time())
+
+class SitePolicy(Policy):
+    model_name = "Site"
+    thread_safe = True
+    instances_created = 0
+
+    def __init__(self):
+        SitePolicy.instances_created += 1
+
+    def handle_create(self, instance):
+        record(instance, "create")
+
+    def handle_delete(self, instance):
+        record(instance, "delete")
+
+class SlicePolicy(Policy):
+    model_name = "Slice"
+    instances_created = 0
+
+    def __init__(self):
+        SlicePolicy.instances_created += 1
+
+    def handle_create(self, instance):
+        record(instance, "create")
+
+    def handle_delete(self, instance):
+        record(instance, "delete")
+
+class NetworkPolicy(Policy):
+    model_name = "Network"
+
+    def handle_create(self, instance):
+        record(instance, "create")
+
+class FailingPolicy(Policy):
+    model_name = "Slice"
+
+    def handle_update(self, instance):
+        raise Exception("failed")
+
+class TestModelPolicyLoop(unittest.TestCase):
+    def setUp(self):
+        calls.clear()
+        SitePolicy.instances_created = 0
+        SlicePolicy.instances_created = 0
+        for policy in (SitePolicy, SlicePolicy, NetworkPolicy, FailingPolicy):
+            policy.model = policy.model_name
+        with patch.object(XOSPolicyEngine, "load_model_policies", return_value=[SitePolicy, SlicePolicy, NetworkPolicy, FailingPolicy]), \
+             patch.object(XOSPolicyEngine, "load_dependency_graph", return_value={"Slice": ["Site"], "Site": []}):
+            self.engine = XOSPolicyEngine(policies_dir=None, pool_size=4)
+
+        self.model_accessor = patch("synchronizers.new_base.model_policy_loop.model_accessor").start()
+        self.model_accessor.now.return_value = 1
+
+    def tearDown(self):
+        patch.stopall()
+
+    def make_objects(self, model_name, count):
+        return [FakeModel(model_name, i) for i in range(count)]
+
+    def test_dependencies(self):
+        self.assertEqual(self.engine.get_model_dependencies(["Site", "Slice"]),
+                         {"Site": set(), "Slice": set(["Site"])})
+        self.assertEqual(self.engine.get_model_dependencies(["Site", "Slice"], deletion=True),
+                         {"Site": set(["Slice"]), "Slice": set()})
+
+    def test_create_order(self):
+        objects = self.make_objects("Slice", 3) + self.make_objects("Site", 3)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+
+        self.assertEqual(len(calls), 6)
+        sites_done = max([v[1] for (k, v) in calls.items() if k[0] == "Site"])
+        slices_started = min([v[0] for (k, v) in calls.items() if k[0] == "Slice"])
+        self.assertTrue(sites_done <= slices_started)
+
+        # the three sites ran concurrently
+        sites = [v for (k, v) in calls.items() if k[0] == "Site"]
+        self.assertTrue(max([v[0] for v in sites]) < min([v[1] for v in sites]))
+
+        for o in objects:
+            self.assertEqual(o.policed, 1)
+            self.assertEqual(o.policy_status, "1 - done")
+
+    def test_delete_order(self):
+        objects = self.make_objects("Site", 2) + self.make_objects("Slice", 2)
+        self.engine.execute_model_policies([(o, "delete") for o in objects], deletion=True)
+
+        self.assertEqual(len(calls), 4)
+        slices_done = max([v[1] for (k, v) in calls.items() if k[0] == "Slice"])
+        sites_started = min([v[0] for (k, v) in calls.items() if k[0] == "Site"])
+        self.assertTrue(slices_done <= sites_started)
+
+    def test_default_pool_size(self):
+        with patch.object(XOSPolicyEngine, "load_model_policies", return_value=[]), \
+             patch.object(XOSPolicyEngine, "load_dependency_graph", return_value={}):
+            engine = XOSPolicyEngine(policies_dir=None)
+        self.assertEqual(engine.pool_size, 1)
+
+    def test_thread_safe_policy_shared(self):
+        objects = self.make_objects("Site", 5)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+        self.assertEqual(SitePolicy.instances_created, 1)
+
+    def test_policy_serialized(self):
+        objects = self.make_objects("Slice", 5)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+
+        # each thread made its own instance
+        self.assertTrue(1 < SlicePolicy.instances_created <= 4)
+
+        # and the handlers did not overlap
+        slices = sorted(calls.values())
+        for (prev, next) in zip(slices, slices[1:]):
+            self.assertTrue(prev[1] <= next[0])
+
+    def test_policies_not_serialized_with_each_other(self):
+        objects = self.make_objects("Slice", 2) + self.make_objects("Network", 2)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+
+        slices = sorted([v for (k, v) in calls.items() if k[0] == "Slice"])
+        networks = sorted([v for (k, v) in calls.items() if k[0] == "Network"])
+        self.assertTrue(slices[0][1] <= slices[1][0])
+        self.assertTrue(networks[0][1] <= networks[1][0])
+        # a slice and a network were policed at the same time
+        self.assertTrue(min(slices[0][1], networks[0][1]) > max(slices[0][0], networks[0][0]))
+
+    def test_metrics_exclude_lock_wait(self):
+        objects = self.make_objects("Slice", 4)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+
+        # the four handlers ran one after another; waiting for the policy's
+        # lock would add up to another 0.3s
+        metrics = self.engine.get_policy_metrics()
+        self.assertEqual(metrics[("SlicePolicy", "create")]["count"], 4)
+        self.assertTrue(metrics[("SlicePolicy", "create")]["total"] < 0.3)
+
+    def test_metrics(self):
+        objects = self.make_objects("Slice", 2)
+        self.engine.execute_model_policies([(o, "create") for o in objects])
+        self.engine.execute_model_policies([(o, "update") for o in objects])
+
+        metrics = self.engine.get_policy_metrics()
+        self.assertEqual(metrics[("SlicePolicy", "create")]["count"], 2)
+        self.assertEqual(metrics[("SlicePolicy", "create")]["failures"], 0)
+        self.assertTrue(metrics[("SlicePolicy", "create")]["max"] >= 0.05)
+        self.assertEqual(metrics[("FailingPolicy", "update")]["failures"], 2)
+        self.assertFalse(("SitePolicy", "create") in metrics)
+
+        for o in objects:
+            self.assertTrue(o.policy_status.startswith("2 - "))
+
+    def test_policy_status_batched(self):
+        objects = self.make_objects("Slice", 3)
+        with patch.object(FakeModel, "save") as save:
+            self.engine.execute_model_policies([(o, "create") for o in objects])
+            self.assertEqual(save.call_count, 0)
+            self.assertEqual(self.model_accessor.update_bookkeeping.call_count, 0)
+
+            self.engine.flush_policy_status()
+            self.assertEqual(save.call_count, 0)
+
+        self.assertEqual(self.model_accessor.update_bookkeeping.call_count, 1)
+        (updates,) = self.model_accessor.update_bookkeeping.call_args[0]
+        self.assertEqual(self.model_accessor.update_bookkeeping.call_args[1], {"silent": True})
+        self.assertEqual(sorted([o.id for (o, values) in updates]), [0, 1, 2])
+        for (o, values) in updates:
+            self.assertEqual(values, {"policed": 1, "policy_status": "1 - done"})
+
+        # the buffer was emptied
+        self.engine.flush_policy_status()
+        self.assertEqual(self.model_accessor.update_bookkeeping.call_count, 1)
+
+    def test_policy_status_coalesced(self):
+        o = FakeModel("Slice", 1)
+        self.engine.execute_model_policy(o, "update")
+        self.engine.execute_model_policy(o, "create")
+        self.engine.flush_policy_status()
+
+        (updates,) = self.model_accessor.update_bookkeeping.call_args[0]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0][1]["policy_status"], "1 - done")
+        self.assertEqual(updates[0][1]["policed"], 1)
+
+    def test_policy_status_fallback(self):
+        o = FakeModel("Slice", 1)
+        self.model_accessor.update_bookkeeping.side_effect = Exception("unavailable")
+        self.engine.execute_model_policy(o, "create")
+        with patch.object(FakeModel, "save") as save:
+            self.engine.flush_policy_status()
+            save.assert_called_once()
+            self.assertEqual(sorted(save.call_args[1]["update_fields"]), ["policed", "policy_status"])
+
+def make_event(class_names, changed_fields=["name"]):
+    return json.dumps({"pk": 1, "changed_fields": changed_fields, "object": {"class_names": class_names}})
+
+class TestPolicyChangeFeed(unittest.TestCase):
+    def setUp(self):
+        for policy in (SitePolicy, SlicePolicy):
+            policy.model = policy.model_name
+        with patch.object(XOSPolicyEngine, "load_model_policies", return_value=[SitePolicy, SlicePolicy]), \
+             patch.object(XOSPolicyEngine, "load_dependency_graph", return_value={}):
+            self.engine = XOSPolicyEngine(policies_dir=None)
+        self.engine.change_feed_ok = True
+        self.engine.last_full_scan = time.time()
+        self.watched = self.engine.get_watched_models()
+
+        self.model_accessor = patch("synchronizers.new_base.model_policy_loop.model_accessor").start()
+        self.model_accessor.fetch_policies.return_value = []
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_only_changed_models_policed(self):
+        self.assertTrue(self.engine.handle_change_event("Slice", make_event("Slice,XOSBase"), self.watched))
+        model_names = self.engine.select_models()
+        self.assertEqual(model_names, set(["Slice"]))
+        # the dirty set was consumed
+        self.assertEqual(self.engine.select_models(), set())
+
+        self.engine.run_policy_once(model_names)
+        self.model_accessor.fetch_policies.assert_any_call(["Slice"], False)
+        self.model_accessor.fetch_policies.assert_any_call(["Slice"], True)
+
+    def test_base_class_event(self):
+        self.assertTrue(self.engine.handle_change_event("MySlice", make_event("MySlice,Slice,XOSBase"), self.watched))
+        self.assertEqual(self.engine.select_models(), set(["Slice"]))
+
+    def test_ignored_events(self):
+        self.assertFalse(self.engine.handle_change_event("Slice", make_event("Slice", ["policed", "policy_status"]), self.watched))
+        self.assertFalse(self.engine.handle_change_event("Slice", make_event("Slice", ["backend_status"]), self.watched))
+        self.assertFalse(self.engine.handle_change_event("Image", make_event("Image,XOSBase"), self.watched))
+        self.assertTrue(self.engine.handle_change_event("Site", make_event("Site", ["deleted"]), self.watched))
+        self.assertEqual(self.engine.select_models(), set(["Site"]))
+
+    def test_poll_when_feed_down(self):
+        self.engine.change_feed_ok = False
+        self.assertEqual(self.engine.select_models(), None)
+
+    def test_reconcile(self):
+        self.engine.handle_change_event("Slice", make_event("Slice"), self.watched)
+        self.engine.last_full_scan = time.time() - self.engine.reconcile_interval
+        self.assertEqual(self.engine.select_models(), None)
+        self.assertEqual(self.engine.select_models(), set())
+
+    def test_wake_up(self):
+        def publish():
+            time.sleep(0.1)
+            self.engine.handle_change_event("Site", make_event("Site"), self.watched)
+        threading.Thread(target=publish).start()
+
+        start = time.time()
+        self.engine.wait_for_event(timeout=5)
+        self.assertTrue(time.time() - start < 1)
+
+        # an event that arrives before the wait does not block it
+        self.engine.handle_change_event("Site", make_event("Site"), self.watched)
+        start = time.time()
+        self.engine.wait_for_event(timeout=5)
+        self.assertTrue(time.time() - start < 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+from mock import patch
+import mock
+import time
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+from synchronizers.new_base.modelaccessor import ModelAccessor
+
+class Slice(object):
+    pass
+
+class MockObject(object):
+    def __init__(self, id):
+        self.id = id
+        self.pk = id
+        self.enacted = None
+        self.backend_status = ""
+        self.saves = []
+
+    def save(self, update_fields=None):
+        self.saves.append(update_fields)
+
+class MockModelAccessor(ModelAccessor):
+    def __init__(self):
+        self.clock = 1000
+        self.bulk_updates = []
+        super(MockModelAccessor, self).__init__()
+
+    def get_all_model_classes(self):
+        return {"Slice": Slice}
+
+    def fetch_window_start(self):
+        return self.clock - self.FETCH_WINDOW_OVERLAP
+
+    def update_bookkeeping(self, updates):
+        self.bulk_updates.append(updates)
+
+def config_get(overrides):
+    orig_get = Config.get
+    return lambda key: overrides[key] if key in overrides else orig_get(key)
+
+class TestFetchWindow(unittest.TestCase):
+    def setUp(self):
+        self.accessor = MockModelAccessor()
+
+    def test_disabled(self):
+        self.assertEqual(self.accessor.get_fetch_window("pending", Slice), None)
+        self.assertEqual(self.accessor.save_fetch_window(None, iter([MockObject(1)]))[0].id, 1)
+
+    def test_incremental(self):
+        with patch.object(Config, "get", side_effect=config_get({"incremental_fetch": True})):
+            window = self.accessor.get_fetch_window("pending", Slice)
+            self.assertEqual(window["since"], None)
+            self.accessor.save_fetch_window(window, [MockObject(1), MockObject(2)])
+
+            self.accessor.clock = 1100
+            window = self.accessor.get_fetch_window("pending", Slice)
+            self.assertEqual(window["since"], 1000 - ModelAccessor.FETCH_WINDOW_OVERLAP)
+            self.assertEqual(window["ids"], [1, 2])
+            self.accessor.save_fetch_window(window, [MockObject(2)])
+
+            window = self.accessor.get_fetch_window("pending", Slice)
+            self.assertEqual(window["since"], 1100 - ModelAccessor.FETCH_WINDOW_OVERLAP)
+            self.assertEqual(window["ids"], [2])
+
+            # policies are tracked separately
+            self.assertEqual(self.accessor.get_fetch_window("policies", Slice)["since"], None)
+
+    def test_full_scan(self):
+        with patch.object(Config, "get", side_effect=config_get({"incremental_fetch": True})):
+            window = self.accessor.get_fetch_window("pending", Slice)
+            self.accessor.save_fetch_window(window, [])
+            window["full_scan"] = time.time() - Config.get("full_scan_interval")
+            self.assertEqual(self.accessor.get_fetch_window("pending", Slice)["since"], None)
+
+class TestBookkeeping(unittest.TestCase):
+    def setUp(self):
+        self.accessor = MockModelAccessor()
+
+    def test_unbuffered(self):
+        o = MockObject(1)
+        self.accessor.save_bookkeeping(o, ["backend_status"])
+        self.assertEqual(o.saves, [["backend_status"]])
+        self.accessor.flush_bookkeeping()
+        self.assertEqual(self.accessor.bulk_updates, [])
+
+    def test_coalesce(self):
+        with patch.object(Config, "get", side_effect=config_get({"bookkeeping_flush_interval": 60})):
+            o1 = MockObject(1)
+            o2 = MockObject(2)
+            o1.backend_status = "2 - failed"
+            self.accessor.save_bookkeeping(o1, ["backend_status"])
+            o1.enacted = 1234
+            o1.backend_status = "1 - OK"
+            self.accessor.save_bookkeeping(o1, ["enacted", "backend_status"])
+            self.accessor.save_bookkeeping(o2, ["backend_status"])
+            self.assertEqual(self.accessor.bulk_updates, [])
+
+            self.accessor.flush_bookkeeping()
+            self.assertEqual(o1.saves, [])
+            self.assertEqual(len(self.accessor.bulk_updates), 1)
+            updates = dict([(o.id, values) for (o, values) in self.accessor.bulk_updates[0]])
+            self.assertEqual(updates, {1: {"enacted": 1234, "backend_status": "1 - OK"},
+                                       2: {"backend_status": ""}})
+
+            # nothing left to flush
+            self.accessor.flush_bookkeeping()
+            self.assertEqual(len(self.accessor.bulk_updates), 1)
+
+    def test_flush_interval(self):
+        with patch.object(Config, "get", side_effect=config_get({"bookkeeping_flush_interval": 60})):
+            self.accessor.save_bookkeeping(MockObject(1), ["backend_status"])
+            self.accessor.bookkeeping_since -= 60
+            self.accessor.save_bookkeeping(MockObject(2), ["backend_status"])
+            self.assertEqual(len(self.accessor.bulk_updates), 1)
+            self.assertEqual(len(self.accessor.bulk_updates[0]), 2)
+
+    def test_fallback(self):
+        with patch.object(Config, "get", side_effect=config_get({"bookkeeping_flush_interval": 60})):
+            o = MockObject(1)
+            self.accessor.save_bookkeeping(o, ["backend_status"])
+            with patch.object(self.accessor, "update_bookkeeping", side_effect=Exception("unavailable")):
+                self.accessor.flush_bookkeeping()
+            self.assertEqual(o.saves, [["backend_status"]])
+
+if __name__ == '__main__':
+    unittest.main()
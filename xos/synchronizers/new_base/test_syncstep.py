@@ -0,0 +1,239 @@
+import unittest
+from mock import patch
+import mock
+import json
+import threading
+import time
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+import synchronizers.new_base.syncstep
+import synchronizers.new_base.ansible_helper
+from synchronizers.new_base.syncstep import SyncStep
+from synchronizers.new_base.ansible_helper import run_template_batch
+
+class MockObject(object):
+    def __init__(self, pk, fail=False):
+        self.pk = pk
+        self.fail = fail
+        self.backend_register = "{}"
+        self.backend_status = ""
+        self.backend_need_delete = False
+        self.enacted = None
+
+    def save(self, update_fields=None):
+        pass
+
+    def tologdict(self):
+        return {}
+
+class MockSyncStep(SyncStep):
+    provides = []
+    observes = []
+    dependencies = []
+
+    def __init__(self, objs, **args):
+        SyncStep.__init__(self, **args)
+        self.objs = objs
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def fetch_pending(self, deletion=False):
+        return self.objs
+
+    def sync_record(self, o):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if o.fail:
+            raise Exception("failed to sync %s" % o.pk)
+
+class MockBatchSyncStep(SyncStep):
+    provides = []
+    observes = [MockObject]
+    dependencies = []
+    playbook = "sync_mock.yaml"
+    batch_size = 3
+
+    def __init__(self, objs, **args):
+        SyncStep.__init__(self, **args)
+        self.objs = objs
+        self.outputs = {}
+
+    def fetch_pending(self, deletion=False):
+        return self.objs
+
+    def map_sync_inputs(self, o):
+        return {"name": "obj%s" % o.pk}
+
+    def map_sync_outputs(self, o, res):
+        self.outputs[o.pk] = res
+
+class MockTaskResult(object):
+    def __init__(self, result, failed=False):
+        self._result = result
+        self.failed = failed
+
+    def is_failed(self):
+        return self.failed
+
+    def is_unreachable(self):
+        return False
+
+class TestSyncStep(unittest.TestCase):
+    def setUp(self):
+        self.model_accessor = mock.MagicMock()
+        self.model_accessor.obj_exists.return_value = True
+        self.model_accessor.obj_in_list.return_value = False
+        synchronizers.new_base.syncstep.model_accessor = self.model_accessor
+
+    def test_serial_by_default(self):
+        step = MockSyncStep([MockObject(i) for i in range(4)])
+        failed = step.call(failed=[])
+        self.assertEqual(failed, [])
+        self.assertEqual(step.peak, 1)
+
+    def test_parallel(self):
+        objs = [MockObject(i) for i in range(8)]
+        step = MockSyncStep(objs)
+        step.max_parallel = 4
+        failed = step.call(failed=[])
+        self.assertEqual(failed, [])
+        self.assertEqual(step.peak, 4)
+        for o in objs:
+            self.assertEqual(o.backend_status, "1 - OK")
+            self.assertEqual(json.loads(o.backend_register)["exponent"], 0)
+
+    def test_parallel_shard_key(self):
+        objs = [MockObject(i) for i in range(6)]
+        step = MockSyncStep(objs)
+        step.max_parallel = 4
+        step.get_shard_key = lambda o: o.pk % 2
+        step.call(failed=[])
+        self.assertEqual(step.peak, 2)
+
+    def test_parallel_linked_objects(self):
+        # 1 and 3 refer to 0 and 2, for example container Instances and
+        # their parent VMs. Listed first, they must still wait.
+        objs = [MockObject(i) for i in [1, 3, 0, 2, 4, 5]]
+        parents = {1: 0, 3: 2}
+        self.model_accessor.get_foreign_key_ids.side_effect = \
+            lambda o: [("MockObject", parents[o.pk])] if o.pk in parents else []
+
+        step = MockSyncStep(objs)
+        shards = step.get_shards(objs)
+        self.assertEqual(sorted([[o.pk for o in shard] for shard in shards]), [[0, 1], [2, 3], [4], [5]])
+
+        synced = []
+        sync_record = step.sync_record
+        def record(o):
+            sync_record(o)
+            with step.lock:
+                synced.append(o.pk)
+        step.sync_record = record
+        step.max_parallel = 4
+        self.assertEqual(step.call(failed=[]), [])
+        self.assertEqual(step.peak, 4)
+        self.assertTrue(synced.index(0) < synced.index(1))
+        self.assertTrue(synced.index(2) < synced.index(3))
+
+    def test_shards_cycle_logged(self):
+        objs = [MockObject(i) for i in range(3)]
+        parents = {0: 1, 1: 0}
+        self.model_accessor.get_foreign_key_ids.side_effect = \
+            lambda o: [("MockObject", parents[o.pk])] if o.pk in parents else []
+
+        step = MockSyncStep(objs)
+        with patch.object(synchronizers.new_base.syncstep.logger, "warning") as warning:
+            shards = step.get_shards(objs)
+        self.assertEqual(sorted([sorted([o.pk for o in shard]) for shard in shards]), [[0, 1], [2]])
+        self.assertEqual(warning.call_count, 1)
+        self.assertIn("MockObject:0", warning.call_args[0][0])
+        self.assertIn("MockObject:1", warning.call_args[0][0])
+
+    def test_parallel_failures(self):
+        objs = [MockObject(i, fail=(i % 3 == 0)) for i in range(6)]
+        step = MockSyncStep(objs)
+        step.max_parallel = 3
+        prior_failure = MockObject(100)
+        failed = step.call(failed=[prior_failure])
+        self.assertEqual(sorted([o.pk for o in failed]), [0, 3, 100])
+        for o in objs:
+            if o.fail:
+                self.assertTrue(o.backend_status.startswith("2 - "))
+                self.assertEqual(json.loads(o.backend_register)["exponent"], 1)
+            else:
+                self.assertEqual(o.backend_status, "1 - OK")
+
+    def test_batch(self):
+        objs = [MockObject(i) for i in range(5)]
+        step = MockBatchSyncStep(objs)
+        batches = []
+
+        def run_template_batch(name, items, path=''):
+            batches.append([item["name"] for item in items])
+            results = dict([(item["ansible_tag"], [{"changed": True}]) for item in items])
+            errors = {"MockObject_3": "boom"} if "MockObject_3" in results else {}
+            return (results, errors)
+
+        with patch.object(synchronizers.new_base.syncstep, "run_template_batch", run_template_batch):
+            failed = step.call(failed=[])
+
+        self.assertEqual(batches, [["obj0", "obj1", "obj2"], ["obj3", "obj4"]])
+        self.assertEqual([o.pk for o in failed], [3])
+        self.assertEqual(sorted(step.outputs.keys()), [0, 1, 2, 4])
+        self.assertEqual(step.outputs[0], [{"changed": True}])
+        self.assertTrue(objs[3].backend_status.startswith("2 - "))
+        self.assertEqual(objs[4].backend_status, "1 - OK")
+
+    def test_batch_keeps_shards_together(self):
+        # 3 refers to 2, so the two must not be split across batches
+        objs = [MockObject(i) for i in range(5)]
+        self.model_accessor.get_foreign_key_ids.side_effect = \
+            lambda o: [("MockObject", 2)] if o.pk == 3 else []
+        step = MockBatchSyncStep(objs)
+
+        self.assertEqual([[o.pk for o in batch] for batch in step.get_batches(objs)], [[0, 1], [2, 3, 4]])
+
+        step.get_shard_key = lambda o: "all"
+        self.assertEqual([[o.pk for o in batch] for batch in step.get_batches(objs)], [[0, 1, 2, 3, 4]])
+
+    def test_run_template_batch_results(self):
+        items = [{"ansible_tag": "a"}, {"ansible_tag": "b"}, {"ansible_tag": "c"}]
+        aresults = [MockTaskResult({"changed": False}),
+                    MockTaskResult({"results": [{"item": items[0], "x": 1},
+                                                {"item": items[1], "failed": True, "msg": "b broke"},
+                                                {"item": items[2], "skipped": True}]}, failed=True),
+                    MockTaskResult({"results": [{"item": items[0], "x": 2},
+                                                {"item": items[2], "x": 3}]})]
+
+        with patch.object(synchronizers.new_base.ansible_helper, "get_playbook_fn", side_effect=lambda opts, path: (opts, "/tmp/pb")), \
+             patch.object(synchronizers.new_base.ansible_helper, "render_playbook", return_value=({}, "/tmp/pb")), \
+             patch.object(synchronizers.new_base.ansible_helper, "run_playbook", return_value=(None, aresults)):
+            (results, errors) = run_template_batch("sync_mock.yaml", items)
+
+        self.assertEqual(results["a"], [{"item": items[0], "x": 1}, {"item": items[0], "x": 2}])
+        self.assertEqual(results["c"], [{"item": items[2], "x": 3}])
+        self.assertEqual(errors, {"b": "b broke"})
+
+    def test_run_template_batch_whole_batch_failure(self):
+        items = [{"ansible_tag": "a"}, {"ansible_tag": "b"}]
+        aresults = [MockTaskResult({"msg": "unreachable"}, failed=True)]
+
+        with patch.object(synchronizers.new_base.ansible_helper, "get_playbook_fn", side_effect=lambda opts, path: (opts, "/tmp/pb")), \
+             patch.object(synchronizers.new_base.ansible_helper, "render_playbook", return_value=({}, "/tmp/pb")), \
+             patch.object(synchronizers.new_base.ansible_helper, "run_playbook", return_value=(None, aresults)):
+            (results, errors) = run_template_batch("sync_mock.yaml", items)
+
+        self.assertEqual(errors, {"a": "unreachable", "b": "unreachable"})
+
+if __name__ == '__main__':
+    unittest.main()
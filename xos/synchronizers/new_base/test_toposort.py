@@ -0,0 +1,61 @@
+import unittest
+
+import os, sys
+sys.path.append("../..")
+
+from synchronizers.new_base.toposort import toposort, CycleError
+
+class TestToposort(unittest.TestCase):
+    def assertOrdered(self, g, order):
+        position = dict([(n, i) for (i, n) in enumerate(order)])
+        for (n, deps) in g.items():
+            for m in deps:
+                if (n in position) and (m in position):
+                    self.assertTrue(position[m] < position[n], "%s should come before %s in %s" % (m, n, order))
+
+    def test_order(self):
+        g = {"a": ["b", "c"], "b": ["d"], "c": ["d"], "e": []}
+        order = toposort(g)
+        self.assertEqual(sorted(order), ["a", "b", "c", "d", "e"])
+        self.assertOrdered(g, order)
+
+    def test_steps(self):
+        g = {"a": ["b"], "b": ["c"]}
+        # only steps are returned, even those that are not in the graph,
+        # and their order follows dependencies through other nodes
+        order = toposort(g, ["c", "x", "a"])
+        self.assertEqual(sorted(order), ["a", "c", "x"])
+        self.assertTrue(order.index("c") < order.index("a"))
+
+    def test_steps_order_kept(self):
+        self.assertEqual(toposort({}, ["c", "a", "b"]), ["c", "a", "b"])
+
+    def test_cycle(self):
+        g = {"a": ["b"], "b": ["c"], "c": ["a"]}
+        with self.assertRaises(CycleError) as e:
+            toposort(g, ["a"])
+        self.assertEqual(e.exception.cycle, ["a", "b", "c", "a"])
+
+    def test_self_cycle(self):
+        with self.assertRaises(CycleError) as e:
+            toposort({"a": ["a"]})
+        self.assertEqual(e.exception.cycle, ["a", "a"])
+
+    def test_cycle_reported(self):
+        g = {"a": ["b"], "b": ["c"], "c": ["b", "d"]}
+        cycles = []
+        order = toposort(g, ["a", "b", "c", "d"], cycles)
+        self.assertEqual(cycles, [["b", "c", "b"]])
+        self.assertEqual(sorted(order), ["a", "b", "c", "d"])
+        self.assertTrue(order.index("d") < order.index("c"))
+        self.assertTrue(order.index("b") < order.index("a"))
+
+    def test_deep_chain(self):
+        # deeper than the recursion limit
+        n = 5000
+        g = dict([(i, [i + 1]) for i in range(n)])
+        self.assertEqual(toposort(g, [0, n]), [n, 0])
+        self.assertEqual(toposort(g), range(n, -1, -1))
+
+if __name__ == '__main__':
+    unittest.main()
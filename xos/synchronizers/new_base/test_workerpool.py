@@ -0,0 +1,89 @@
+import unittest
+import threading
+import time
+
+import os, sys
+sys.path.append("../..")
+config = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/test_config.yaml")
+from xosconfig import Config
+Config.init(config, 'synchronizer-config-schema.yaml')
+
+from synchronizers.new_base.workerpool import WorkerPool, DAGScheduler
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(4, name="test")
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_pool_size(self):
+        self.assertEqual(self.pool.size, 4)
+        self.assertEqual(len(self.pool.threads), 4)
+
+    def test_exit_hook(self):
+        exits = []
+        pool = WorkerPool(3, exit_hook=lambda: exits.append(threading.current_thread().name))
+        pool.shutdown()
+        self.assertEqual(len(exits), 3)
+
+    def test_dependency_order(self):
+        graph = {"c": ["b"], "b": ["a"], "d": ["a"]}
+        order = []
+        lock = threading.Lock()
+
+        def run(node):
+            time.sleep(0.01)
+            with lock:
+                order.append(node)
+
+        metrics = DAGScheduler(self.pool, graph, ["a", "b", "c", "d"], run).run()
+
+        self.assertEqual(sorted(order), ["a", "b", "c", "d"])
+        self.assertTrue(order.index("a") < order.index("b") < order.index("c"))
+        self.assertTrue(order.index("a") < order.index("d"))
+        self.assertEqual(sorted(metrics.keys()), ["a", "b", "c", "d"])
+        self.assertTrue(metrics["c"]["run_latency"] >= 0)
+        self.assertTrue(metrics["c"]["queue_latency"] >= 0)
+
+    def test_independent_nodes_run_concurrently(self):
+        active = [0]
+        peak = [0]
+        lock = threading.Lock()
+
+        def run(node):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+        DAGScheduler(self.pool, {}, range(8), run).run()
+
+        self.assertEqual(peak[0], 4)
+
+    def test_unknown_and_self_dependencies(self):
+        done = []
+        DAGScheduler(self.pool, {"a": ["a", "#Phantom"]}, ["a"], done.append).run()
+        self.assertEqual(done, ["a"])
+
+    def test_cycle(self):
+        done = []
+        DAGScheduler(self.pool, {"a": ["b"], "b": ["a"], "c": ["a"]}, ["a", "b", "c"], done.append).run()
+        self.assertEqual(sorted(done), ["a", "b", "c"])
+        self.assertEqual(done[-1], "c")
+
+    def test_exception_does_not_block_dependents(self):
+        done = []
+
+        def run(node):
+            if node == "a":
+                raise Exception("boom")
+            done.append(node)
+
+        DAGScheduler(self.pool, {"b": ["a"]}, ["a", "b"], run).run()
+        self.assertEqual(done, ["b"])
+
+if __name__ == '__main__':
+    unittest.main()
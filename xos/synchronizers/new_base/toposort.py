@@ -1,72 +1,84 @@
 #!/usr/bin/env python
 
-import time
-import traceback
-import commands
-import threading
+""" toposort.py
+
+    Topological sort of a dependency graph, shared by the synchronizer
+    (XOSObserver.load_sync_steps) and the TOSCA engine.
+
+    The graph maps each node to the list of nodes it depends on. The sort
+    is a depth-first search that uses an explicit stack instead of
+    recursion and runs in O(V + E).
+"""
+
 import json
-import pdb
-
-from datetime import datetime
-from collections import defaultdict
-
-# Topological sort
-# Notes:
-# - Uses a stack instead of recursion
-# - Forfeits optimization involving tracking currently visited nodes
-def toposort(g, steps=None):
-	# Get set of all nodes, including those without outgoing edges
-	keys = set(g.keys())
-	values = set({})
-	for v in g.values():
-		values=values | set(v)
-	
-	all_nodes=list(keys|values)
-	if (not steps):
-		steps = all_nodes
-
-	# Final order
-	order = []
-
-	# DFS stack, not using recursion
-	stack = []
-
-	# Unmarked set
-	unmarked = all_nodes
-
-	# visiting = [] - skip, don't expect 1000s of nodes, |E|/|V| is small
-
-	while unmarked:
-		stack.insert(0,unmarked[0]) # push first unmarked
-
-		while (stack):
-			n = stack[0]
-			add = True
-			try:
-				for m in g[n]:
-					if (m in unmarked):
-					    add = False
-					    stack.insert(0,m)
-			except KeyError:
-				pass
-			if (add):
-				if (n in steps and n not in order):
-					order.append(n)
-				item = stack.pop(0)
-				try:
-					unmarked.remove(item)
-				except ValueError:
-					pass
-
-	noorder = list(set(steps) - set(order))
-	return order + noorder
+
+# DFS node states
+VISITING = 1
+DONE = 2
+
+class CycleError(Exception):
+    def __init__(self, cycle):
+        """ cycle is the list of nodes in the cycle, ending with its first """
+        self.cycle = cycle
+        super(CycleError, self).__init__("Dependency cycle: %s" % " -> ".join([str(x) for x in cycle]))
+
+def toposort(g, steps=None, cycles=None):
+    """ Return the nodes of g ordered so that every node comes after the
+        nodes it depends on. If steps is given, only the nodes in steps are
+        returned, including those that are not in g.
+
+        If g has a cycle, CycleError is raised. If a list is passed as
+        cycles, each cycle found is appended to it instead, and the sort
+        continues as if the edge that closes the cycle did not exist.
+    """
+    if steps is None:
+        roots = g.keys()
+    else:
+        roots = steps
+
+    state = {}
+    # position of each node being visited in the stack, to report cycles
+    depth = {}
+    order = []
+
+    for root in roots:
+        if root in state:
+            continue
+
+        state[root] = VISITING
+        depth[root] = 0
+        stack = [(root, iter(g.get(root, [])))]
+
+        while stack:
+            (n, deps) = stack[-1]
+            for m in deps:
+                m_state = state.get(m)
+                if m_state is None:
+                    state[m] = VISITING
+                    depth[m] = len(stack)
+                    stack.append((m, iter(g.get(m, []))))
+                    break
+                elif m_state == VISITING:
+                    cycle = [x for (x, _) in stack[depth[m]:]] + [m]
+                    if cycles is None:
+                        raise CycleError(cycle)
+                    cycles.append(cycle)
+            else:
+                stack.pop()
+                state[n] = DONE
+                del depth[n]
+                order.append(n)
+
+    if steps is not None:
+        steps = set(steps)
+        order = [n for n in order if n in steps]
+
+    return order
 
 def main():
-	graph_file=open('xos.deps').read()
-	g = json.loads(graph_file)
-	print toposort(g)
+    graph_file=open('xos.deps').read()
+    g = json.loads(graph_file)
+    print toposort(g)
 
 if (__name__=='__main__'):
-	main()
-
-#print toposort({'a':'b','b':'c','c':'d','d':'c'},['d','c','b','a'])
+    main()
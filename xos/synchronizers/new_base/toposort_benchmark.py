@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+""" toposort_benchmark.py
+
+    Time toposort on random acyclic graphs of increasing size, against the
+    previous implementation, which kept its unmarked set and DFS stack in
+    lists and so was quadratic in the number of nodes.
+
+    Usage:
+        python toposort_benchmark.py [-n 100,500,1000,2000] [-d 3] [-r 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")))
+
+from synchronizers.new_base.toposort import toposort
+
+
+def list_toposort(g, steps=None):
+    """ The previous toposort """
+    keys = set(g.keys())
+    values = set({})
+    for v in g.values():
+        values = values | set(v)
+
+    all_nodes = list(keys | values)
+    if (not steps):
+        steps = all_nodes
+
+    order = []
+    stack = []
+    unmarked = all_nodes
+
+    while unmarked:
+        stack.insert(0, unmarked[0])
+
+        while (stack):
+            n = stack[0]
+            add = True
+            try:
+                for m in g[n]:
+                    if (m in unmarked):
+                        add = False
+                        stack.insert(0, m)
+            except KeyError:
+                pass
+            if (add):
+                if (n in steps and n not in order):
+                    order.append(n)
+                item = stack.pop(0)
+                try:
+                    unmarked.remove(item)
+                except ValueError:
+                    pass
+
+    noorder = list(set(steps) - set(order))
+    return order + noorder
+
+
+def make_graph(count, degree):
+    """ A random acyclic graph where each node depends on up to degree
+        nodes with a lower number.
+    """
+    g = {}
+    for i in range(count):
+        name = "node%d" % i
+        g[name] = ["node%d" % j for j in set([random.randrange(i) for k in range(min(i, degree))])]
+    return g
+
+
+def time_sort(func, g, repeat):
+    best = None
+    for i in range(repeat):
+        tStart = time.time()
+        func(g)
+        elapsed = time.time() - tStart
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="sizes", default="100,500,1000,2000", help="comma-separated graph sizes")
+    parser.add_argument("-d", dest="degree", type=int, default=3, help="dependencies per node")
+    parser.add_argument("-r", dest="repeat", type=int, default=3, help="runs, the best is reported")
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    print "%8s  %12s  %12s  %8s" % ("nodes", "list (s)", "dfs (s)", "speedup")
+    for count in [int(x) for x in args.sizes.split(",")]:
+        g = make_graph(count, args.degree)
+        old = time_sort(list_toposort, g, args.repeat)
+        new = time_sort(toposort, g, args.repeat)
+        print "%8d  %12.4f  %12.4f  %7.1fx" % (count, old, new, old / new)
+
+
+if __name__ == "__main__":
+    main()
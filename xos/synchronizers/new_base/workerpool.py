@@ -0,0 +1,147 @@
+""" workerpool.py
+
+    A fixed-size pool of worker threads, and a scheduler that uses it to run
+    the nodes of a dependency graph, starting each node only once all of its
+    dependencies have completed.
+"""
+
+import Queue
+import threading
+import time
+
+from xos.logger import Logger, logging
+
+logger = Logger(level=logging.INFO)
+
+
+class WorkerPool(object):
+    """ A fixed number of threads that execute submitted callables.
+
+        exit_hook, if set, is called by each worker thread just before it
+        exits. The synchronizer uses this to close per-thread database
+        connections.
+    """
+
+    def __init__(self, size, name="worker", exit_hook=None):
+        self.size = max(1, int(size))
+        self.name = name
+        self.exit_hook = exit_hook
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        for i in range(self.size):
+            t = threading.Thread(target=self.worker, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    return
+                (func, args) = job
+                try:
+                    func(*args)
+                except:
+                    logger.log_exc("%s: exception in worker" % self.name)
+        finally:
+            if self.exit_hook:
+                try:
+                    self.exit_hook()
+                except:
+                    logger.log_exc("%s: exception in exit_hook" % self.name)
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def shutdown(self):
+        """ Let the workers drain the queue, then stop them """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+
+class DAGScheduler(object):
+    """ Runs func(node) for every node in a dependency graph on a WorkerPool.
+
+        graph maps a node to the list of nodes it depends on. Dependencies
+        that are not in nodes are treated as already satisfied. A node is
+        dispatched only after all of its dependencies have returned, so func
+        may inspect the outcome of a dependency without waiting on it.
+
+        After run() returns, self.metrics holds the queue latency (ready to
+        started) and run latency (started to finished) of each node.
+    """
+
+    def __init__(self, pool, graph, nodes, func):
+        self.pool = pool
+        self.func = func
+        self.nodes = list(nodes)
+        self.metrics = {}
+
+        self.cond = threading.Condition()
+        self.remaining = set(self.nodes)
+        self.dispatched = set()
+        self.running = 0
+        self.ready_time = {}
+
+        node_set = set(self.nodes)
+        self.waiting_on = {}
+        self.dependents = {}
+        for node in self.nodes:
+            deps = set([d for d in graph.get(node, []) if (d in node_set) and (d != node)])
+            self.waiting_on[node] = deps
+            for d in deps:
+                self.dependents.setdefault(d, []).append(node)
+
+    def dispatch(self, node):
+        # caller holds self.cond
+        self.dispatched.add(node)
+        self.running += 1
+        self.ready_time[node] = time.time()
+        self.pool.submit(self.execute, node)
+
+    def execute(self, node):
+        start = time.time()
+        try:
+            self.func(node)
+        finally:
+            end = time.time()
+            self.cond.acquire()
+            try:
+                self.metrics[node] = {"queue_latency": start - self.ready_time[node],
+                                      "run_latency": end - start}
+                self.running -= 1
+                self.remaining.discard(node)
+                for dependent in self.dependents.get(node, []):
+                    self.waiting_on[dependent].discard(node)
+                    if (not self.waiting_on[dependent]) and (dependent not in self.dispatched):
+                        self.dispatch(dependent)
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+    def run(self):
+        self.cond.acquire()
+        try:
+            for node in self.nodes:
+                if not self.waiting_on[node]:
+                    self.dispatch(node)
+
+            while self.remaining:
+                if self.running == 0:
+                    # Nothing is in flight, yet nodes remain: the graph has a
+                    # cycle. Break it by releasing the first blocked node.
+                    blocked = [n for n in self.nodes if n not in self.dispatched]
+                    logger.warning("DAGScheduler: dependency cycle among %s, dispatching %s" % (blocked, blocked[0]))
+                    self.waiting_on[blocked[0]] = set()
+                    self.dispatch(blocked[0])
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+        return self.metrics
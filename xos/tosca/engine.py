@@ -6,6 +6,7 @@ import tempfile
 import traceback
 
 from toscaparser.tosca_template import ToscaTemplate
+from synchronizers.new_base.toposort import toposort
 from core.models import Slice,Instance,User,Flavor,Node,Image
 from nodeselect import XOSNodeSelector
 from imageselect import XOSImageSelector
@@ -81,53 +82,8 @@ class XOSTosca(object):
 
 
     def topsort_dependencies(self):
-        # stolen from observer
-        g = self.nodetemplates_by_name
-
-	# Get set of all nodes, including those without outgoing edges
-	keys = set(g.keys())
-	values = set({})
-	for v in g.values():
-		values=values | set(v.dependencies_names)
-
-	all_nodes=list(keys|values)
-        steps = all_nodes
-
-	# Final order
-	order = []
-
-	# DFS stack, not using recursion
-	stack = []
-
-	# Unmarked set
-	unmarked = all_nodes
-
-	# visiting = [] - skip, don't expect 1000s of nodes, |E|/|V| is small
-
-	while unmarked:
-		stack.insert(0,unmarked[0]) # push first unmarked
-
-		while (stack):
-			n = stack[0]
-			add = True
-			try:
-				for m in g[n].dependencies_names:
-					if (m in unmarked):
-					    add = False
-					    stack.insert(0,m)
-			except KeyError:
-				pass
-			if (add):
-				if (n in steps and n not in order):
-					order.append(n)
-				item = stack.pop(0)
-				try:
-					unmarked.remove(item)
-				except ValueError:
-					pass
-
-	noorder = list(set(steps) - set(order))
-	return order + noorder
+        g = dict([(name, nodetemplate.dependencies_names) for (name, nodetemplate) in self.nodetemplates_by_name.items()])
+        return toposort(g)
 
     def execute(self, user):
         for nodetemplate in self.ordered_nodetemplates:
@@ -0,0 +1,183 @@
+"""
+Concurrent variant of the gRPC ORM
+
+ORMStub makes one blocking call at a time. AsyncORMStub offers the same
+models on top of an existing ORMStub, but its calls return futures, so a
+caller can have many reads in flight at once over the channel the ORMStub
+already holds. Results are ordinary ORMWrappers, sharing the ORMStub's
+object cache and foreign key maps.
+
+Usage:
+    aapi = AsyncORMStub(api)        # api is a connected ORMStub
+
+    futures = [aapi.Slice.objects.get(id=id) for id in ids]
+    slices = gather(futures)
+
+    sites = gather([aapi.fk_resolve(s, "site") for s in slices])
+
+Calls are not retried when the core is unavailable.
+"""
+
+import threading
+
+from orm import ORMQuerySet, make_ORMWrapper, make_ORMWrapper_list
+
+class ORMResult(object):
+    """ A future whose value is already known """
+
+    def __init__(self, value):
+        self.value = value
+
+    def done(self):
+        return True
+
+    def result(self, timeout=None):
+        return self.value
+
+    def exception(self, timeout=None):
+        return None
+
+    def add_done_callback(self, fn):
+        fn(self)
+
+class ORMFuture(object):
+    """ The future result of an ORM call. Wraps the grpc future of the call
+        and converts its response with transform, once.
+    """
+
+    def __init__(self, future, transform):
+        self.future = future
+        self.transform = transform
+        self.lock = threading.Lock()
+        self.converted = False
+        self.value = None
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        response = self.future.result(timeout)
+        with self.lock:
+            if not self.converted:
+                self.value = self.transform(response)
+                self.converted = True
+        return self.value
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda f: fn(self))
+
+def gather(futures, timeout=None):
+    """ Wait for a list of futures and return their results, in order """
+    return [f.result(timeout) for f in futures]
+
+class AsyncORMObjectManager(object):
+    """ Like ORMObjectManager, but returns futures """
+
+    def __init__(self, stub, modelName):
+        self._stub = stub
+        self._modelName = modelName
+        self._manager = getattr(stub.orm, modelName).objects
+
+    def wrap_single(self, obj):
+        return make_ORMWrapper(obj, self._stub.orm)
+
+    def wrap_list(self, obj):
+        return ORMQuerySet(make_ORMWrapper_list(obj.items, self._stub.orm))
+
+    def all(self):
+        return self._stub.invoke("List%s" % self._modelName, self._stub.orm.make_empty(), self.wrap_list)
+
+    def filter(self, **kwargs):
+        q = self._manager.make_filter_query(**kwargs)
+        return self._stub.invoke("Filter%s" % self._modelName, q, self.wrap_list)
+
+    def get(self, **kwargs):
+        if kwargs.keys() == ["id"]:
+            return self._stub.get_object(self._modelName, kwargs["id"], self.wrap_single)
+        else:
+            q = self._manager.make_filter_query(**kwargs)
+            return self._stub.invoke("Filter%s" % self._modelName, q, lambda x: self.wrap_single(x.items[0]))
+
+    def bulk_get(self, ids):
+        orm = self._stub.orm
+        if (not ids) or (self._modelName not in orm.bulk_get_models):
+            return ORMResult(ORMQuerySet(make_ORMWrapper_list(orm.bulk_get(self._modelName, ids), orm)))
+        return self._stub.invoke("BulkGet%s" % self._modelName, orm.make_IDList(ids), self.wrap_list)
+
+class AsyncORMModelClass(object):
+    def __init__(self, stub, model_name):
+        self.model_name = model_name
+        self.objects = AsyncORMObjectManager(stub, model_name)
+
+class AsyncORMStub(object):
+    """ Issues ORM calls without waiting for them. If max_in_flight is set,
+        a call blocks while that many calls are outstanding.
+    """
+
+    def __init__(self, orm, max_in_flight=None):
+        self.orm = orm
+        self.in_flight = None
+        if max_in_flight:
+            self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        for model_name in orm.all_model_names:
+            setattr(self, model_name, AsyncORMModelClass(self, model_name))
+
+    def invoke(self, name, request, transform, metadata=None):
+        metadata = list(metadata or [])
+        self.orm.add_default_metadata(metadata)
+        method = getattr(self.orm.grpc_stub, name)
+
+        if not self.in_flight:
+            return ORMFuture(method.future(request, metadata=metadata), transform)
+
+        self.in_flight.acquire()
+        try:
+            future = method.future(request, metadata=metadata)
+        except:
+            self.in_flight.release()
+            raise
+        future.add_done_callback(lambda f: self.in_flight.release())
+        return ORMFuture(future, transform)
+
+    def get_object(self, model_name, id, transform):
+        """ Fetch one object by id, from the ORMStub's cache if possible, and
+            return a future of transform(object).
+        """
+        cache = self.orm.cache
+        if cache:
+            obj = cache.get(model_name, id)
+            if obj is not None:
+                return ORMResult(transform(obj))
+
+        def fetched(obj):
+            if cache:
+                cache.put(model_name, obj)
+            return transform(obj)
+
+        return self.invoke("Get%s" % model_name, self.orm.make_ID(id=id), fetched)
+
+    def fk_resolve(self, obj, name):
+        """ Return a future of obj's foreign key name. The result is kept in
+            obj, so reading obj.<name> afterwards needs no call.
+        """
+        if name in obj.cache:
+            return ORMResult(make_ORMWrapper(obj.cache[name], self.orm))
+
+        fk_entry = obj._fkmap[name]
+        if fk_entry["kind"] != "fk":
+            # generic foreign keys are resolved synchronously
+            return ORMResult(getattr(obj, name))
+
+        fk_id = getattr(obj, fk_entry["src_fieldName"])
+        if not fk_id:
+            return ORMResult(None)
+
+        def resolved(model):
+            obj.cache[name] = model
+            return make_ORMWrapper(model, self.orm)
+
+        return self.get_object(fk_entry["modelName"], fk_id, resolved)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+""" async_orm_benchmark.py
+
+    Time fetching objects one by one with the blocking ORM against the
+    concurrent AsyncORMStub at increasing numbers of calls in flight.
+
+    Uses the fake stub with a simulated per-call latency, so it measures
+    how well round trips overlap rather than server throughput.
+
+    Usage:
+        python async_orm_benchmark.py [-n 200] [-l 0.005]
+"""
+
+import argparse
+import sys
+import time
+
+sys.path.append("..")
+
+import xosapi.orm
+from xosapi.async_orm import AsyncORMStub, gather
+from fake_stub import FakeStub, FakeSymDb, FakeObj
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=200, help="objects to fetch")
+    parser.add_argument("-l", dest="latency", type=float, default=0.005, help="simulated seconds per call")
+    args = parser.parse_args()
+
+    stub = FakeStub()
+    orm = xosapi.orm.ORMStub(stub=stub, package_name="xos", sym_db=FakeSymDb(), empty=FakeObj, enable_backoff=False)
+    ids = []
+    for i in range(args.count):
+        site = orm.Site(name="site_%d" % i)
+        site.save()
+        ids.append(site.id)
+    stub.latency = args.latency
+
+    tStart = time.time()
+    for id in ids:
+        orm.Site.objects.get(id=id)
+    blocking_time = time.time() - tStart
+
+    print "objects fetched:     %d, %.1f ms per call" % (args.count, args.latency * 1000)
+    print "blocking ORM:        %.3f s" % blocking_time
+
+    for max_in_flight in [1, 4, 16, 64]:
+        aorm = AsyncORMStub(orm, max_in_flight=max_in_flight)
+        tStart = time.time()
+        gather([aorm.Site.objects.get(id=id) for id in ids])
+        elapsed = time.time() - tStart
+        print "async, %3d in flight: %.3f s (%.1fx)" % (max_in_flight, elapsed, blocking_time / elapsed)
+
+if __name__ == "__main__":
+    main()
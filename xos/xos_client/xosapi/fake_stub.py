@@ -4,6 +4,8 @@
 """
 
 import functools
+import threading
+import time
 
 ContentTypeMap = {}
 
@@ -35,10 +37,21 @@ class FakeObj(object):
         self.is_set[name] = True
         super(FakeObj, self).__setattr__(name, value)
 
+    def CopyFrom(self, other):
+        for (k, v) in other.__dict__.items():
+            if k not in ["is_set", "fields"]:
+                setattr(self, k, v)
+        super(FakeObj, self).__setattr__("is_set", dict(other.is_set))
+
     @property
     def self_content_type_id(self):
         return "xos.%s" % self.__class__.__name__.lower()
 
+def copy_obj(obj):
+    result = obj.__class__()
+    result.CopyFrom(obj)
+    return result
+
 class FakeExtensionManager(object):
     def __init__(self, obj, extensions):
         self.obj = obj
@@ -111,6 +124,8 @@ class Slice(FakeObj):
 class Site(FakeObj):
     FIELDS = ( {"name": "id", "default": 0},
                {"name": "name", "default": ""},
+               {"name": "policed", "default": None},
+               {"name": "backend_status", "default": ""},
                {"name": "slice_ids", "default": 0, "fk_reverse": "Slice"} )
 
     def __init__(self, **kwargs):
@@ -144,29 +159,181 @@ class Tag(FakeObj):
 class ID(FakeObj):
     pass
 
+class IDList(FakeObj):
+    pass
+
+class FakeRepeated(list):
+    def __init__(self, cls):
+        self.cls = cls
+
+    def add(self):
+        obj = self.cls()
+        self.append(obj)
+        return obj
+
+class QueryElement(FakeObj):
+    EQUAL = 0
+    GREATER_THAN = 1
+    LESS_THAN = 2
+    GREATER_THAN_OR_EQUAL = 3
+    LESS_THAN_OR_EQUAL = 4
+
+    FIELDS = ( {"name": "operator", "default": 0},
+               {"name": "name", "default": ""},
+               {"name": "sValue", "default": ""},
+               {"name": "iValue", "default": 0} )
+
+    def __init__(self, **kwargs):
+        return super(QueryElement, self).__init__(self.FIELDS, **kwargs)
+
+class Query(FakeObj):
+    DEFAULT = 0
+
+    FIELDS = ( {"name": "kind", "default": 0},
+               {"name": "offset", "default": 0},
+               {"name": "limit", "default": 0},
+               {"name": "after_id", "default": 0} )
+
+    def __init__(self, **kwargs):
+        super(Query, self).__init__(self.FIELDS, **kwargs)
+        super(FakeObj, self).__setattr__("elements", FakeRepeated(QueryElement))
+
 class FakeItemList(object):
-    def __init__(self, items):
-        self.items = items
+    def __init__(self, items=None):
+        self.items = items or []
 
-class FakeStub(object):
+class FakeItemsField(object):
+    def __init__(self, objName):
+        self.name = "items"
+        self.message_type = FakeMessageType(objName)
+
+class FakeMessageType(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakePluralDescriptor(object):
+    def __init__(self, objName):
+        self.fields = [FakeItemsField(objName)]
+
+def make_plural_class(objName):
+    return type(objName + "s", (FakeItemList,), {"DESCRIPTOR": FakePluralDescriptor(objName)})
+
+class FakeFuture(object):
+    """ The parts of grpc.Future that the ORM uses """
     def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        self._event.wait(timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._event.wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+class FakeMethod(object):
+    """ A stub method, callable directly or through future() like a grpc
+        UnaryUnaryMultiCallable. Calls take stub.latency seconds.
+    """
+    def __init__(self, stub, fn):
+        self.stub = stub
+        self.fn = fn
+
+    def __call__(self, request, metadata=None):
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        return self.fn(request, metadata=metadata)
+
+    def future(self, request, metadata=None):
+        future = FakeFuture()
+
+        def run():
+            try:
+                future.set(result=self(request, metadata))
+            except Exception, e:
+                future.set(exception=e)
+
+        if self.stub.latency:
+            t = threading.Thread(target=run)
+            t.daemon = True
+            t.start()
+        else:
+            run()
+        return future
+
+class FakeStub(object):
+    def __init__(self, bulk=True, stream=True, latency=0):
         self.id_counter = 1
         self.objs = {}
+        self.calls = []
+        self.stream_limits = []
+        self.latency = latency
         for name in ["Slice", "Site", "Tag", "Service"]:
-            setattr(self, "Get%s" % name, functools.partial(self.get, name))
-            setattr(self, "List%s" % name, functools.partial(self.list, name))
-            setattr(self, "Create%s" % name, functools.partial(self.create, name))
-            setattr(self, "Delete%s" % name, functools.partial(self.delete, name))
-            setattr(self, "Update%s" % name, functools.partial(self.update, name))
+            if bulk:
+                self.add_method("BulkGet%s" % name, functools.partial(self.bulk_get, name))
+                self.add_method("BulkUpdate%s" % name, functools.partial(self.bulk_update, name))
+            if stream:
+                self.add_method("Stream%s" % name, functools.partial(self.stream, name))
+            self.add_method("Get%s" % name, functools.partial(self.get, name))
+            self.add_method("List%s" % name, functools.partial(self.list, name))
+            self.add_method("Filter%s" % name, functools.partial(self.filter, name))
+            self.add_method("Create%s" % name, functools.partial(self.create, name))
+            self.add_method("Delete%s" % name, functools.partial(self.delete, name))
+            self.add_method("Update%s" % name, functools.partial(self.update, name))
+
+    def add_method(self, name, fn):
+        setattr(self, name, FakeMethod(self, fn))
 
 
     def make_key(self, name, id):
         return "%s:%d" % (name, id.id)
 
     def get(self, classname, id, metadata=None):
+        self.calls.append("Get%s" % classname)
         obj = self.objs.get(self.make_key(classname, id), None)
         return obj
 
+    def bulk_get(self, classname, idlist, metadata=None):
+        self.calls.append("BulkGet%s" % classname)
+        items = []
+        for id in idlist.ids:
+            obj = self.objs.get(self.make_key(classname, FakeObj(id=id)), None)
+            if obj is not None:
+                items.append(obj)
+        return FakeItemList(items)
+
+    def bulk_update(self, classname, objs, metadata=None):
+        self.calls.append("BulkUpdate%s" % classname)
+        for obj in objs.items:
+            self.update(classname, obj, metadata)
+        return objs
+
     def list(self, classname, empty, metadata=None):
         items = []
         for (k,v) in self.objs.items():
@@ -175,6 +342,25 @@ class FakeStub(object):
                     items.append(v)
         return FakeItemList(items)
 
+    def filter(self, classname, query, metadata=None):
+        # only supports EQUAL
+        self.calls.append("Filter%s" % classname)
+        items = self.list(classname, None).items
+        for el in query.elements:
+            value = el.iValue if el.is_set.get("iValue") else el.sValue
+            items = [x for x in items if getattr(x, el.name) == value]
+        return FakeItemList(items)
+
+    def stream(self, classname, query, metadata=None):
+        # only supports the pagination fields of the query
+        self.calls.append("Stream%s" % classname)
+        self.stream_limits.append(query.limit)
+        items = sorted(self.list(classname, None).items, key=lambda x: x.id)
+        items = [x for x in items if x.id > query.after_id][query.offset:]
+        if query.limit:
+            items = items[:query.limit]
+        return iter(items)
+
     def create(self, classname, obj, metadata=None):
         obj.id = self.id_counter
         self.id_counter = self.id_counter + 1
@@ -185,6 +371,13 @@ class FakeStub(object):
     def update(self, classname, obj, metadata=None):
         # TODO: partial update support?
         k = self.make_key(classname, FakeObj(id=obj.id))
+        preserve_fields = dict(metadata or []).get("preserve_fields")
+        if preserve_fields and (k in self.objs):
+            old = self.objs[k]
+            obj = copy_obj(obj)
+            for name in preserve_fields.split(","):
+                if hasattr(old, name):
+                    setattr(obj, name, getattr(old, name))
         self.objs[k] = obj
         return obj
 
@@ -195,8 +388,10 @@ class FakeStub(object):
 class FakeSymDb(object):
     def __init__(self):
         self._classes = {}
-        for name in ["Slice", "Site", "ID", "Tag", "Service"]:
+        for name in ["Slice", "Site", "ID", "IDList", "Query", "Tag", "Service"]:
             self._classes["xos.%s" % name] = globals()[name]
+        for name in ["Slice", "Site", "Tag", "Service"]:
+            self._classes["xos.%ss" % name] = make_plural_class(name)
 
 
 
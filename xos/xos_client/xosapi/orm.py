@@ -19,25 +19,156 @@ c=grpc_client.SecureClient("xos-core.cord.lab", username="padmin@vicci.org", pas
 u=c.xos_orm.User.objects.get(id=1)
 """
 
+import collections
 import functools
+import json
+import logging
+import threading
 import time
 
+from xosconfig.bookkeeping import BOOKKEEPING_FIELDS
+
+logger = logging.getLogger(__name__)
+
 convenience_wrappers = {}
 
+def copy_message(msg):
+    result = msg.__class__()
+    result.CopyFrom(msg)
+    return result
+
+class ORMCache(object):
+    """ An identity map of the objects fetched by id, shared by all
+        wrappers of an ORMStub, so that resolving the same foreign key twice
+        only goes to the server once.
+
+        Entries are keyed by (model name, id), hold a private copy of the
+        protobuf message, and are evicted least recently used once there
+        are more than size of them. They are dropped when XOS publishes a
+        change event for the object (see listen_for_changes), and in any
+        case expire ttl seconds after they were fetched, which bounds how
+        stale an entry can be if an event is missed.
+    """
+
+    def __init__(self, size=1000, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listener = None
+
+    def get(self, model_name, id):
+        key = (model_name, id)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if (entry is not None) and (entry[0] > time.time()):
+                # reinsert as the most recently used
+                self.entries[key] = entry
+                self.hits = self.hits + 1
+                return copy_message(entry[1])
+            self.misses = self.misses + 1
+            return None
+
+    def put(self, model_name, obj):
+        if (obj is None) or (not obj.id):
+            return
+        key = (model_name, obj.id)
+        entry = (time.time() + self.ttl, copy_message(obj))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, model_names, id):
+        with self.lock:
+            for model_name in model_names:
+                if self.entries.pop((model_name, id), None) is not None:
+                    self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                    "entries": len(self.entries)}
+
+    def handle_change_event(self, channel, data):
+        """ Drop the object named by a change event published by
+            XOSBase.push_redis_event. The channel is the concrete class
+            name; the object is cached under its base classes too when it
+            was fetched through them.
+        """
+        try:
+            event = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        id = event.get("pk")
+        if not id:
+            return
+        names = [channel]
+        class_names = event.get("object", {}).get("class_names")
+        if class_names:
+            names = names + class_names.split(",")
+        self.invalidate(names, id)
+
+    def listen_for_changes(self, redis_host="redis"):
+        """ Subscribe to the model change events published to Redis. Events
+            missed while not subscribed can't be replayed, so the cache is
+            cleared each time the subscription is (re)established.
+        """
+        while True:
+            try:
+                import redis
+                r = redis.Redis(redis_host)
+                pubsub = r.pubsub()
+                pubsub.psubscribe("*")
+                self.clear()
+                for item in pubsub.listen():
+                    if item["type"] in ["message", "pmessage"]:
+                        self.handle_change_event(item["channel"], item["data"])
+            except ImportError:
+                logger.info("ORM cache: redis module not available, entries expire after %d seconds" % self.ttl)
+                return
+            except Exception:
+                logger.exception("ORM cache: change feed failed, clearing the cache")
+
+            self.clear()
+            time.sleep(10)
+
+    def start_listener(self, redis_host="redis"):
+        if self.listener:
+            return
+        self.listener = threading.Thread(target=self.listen_for_changes, args=(redis_host,), name="orm-cache")
+        self.listener.daemon = True
+        self.listener.start()
+
 class ORMWrapper(object):
     """ Wraps a protobuf object to provide ORM features """
 
+    # Lists of thousands of wrappers are common, so the wrapper's own state
+    # is kept in slots. __dict__ is only filled in by create_attr().
+    __slots__ = ("_wrapped_class", "stub", "cache", "reverse_cache", "poisoned", "is_new",
+                 "_siblings", "_fkmap", "_reverse_fkmap", "_bookkeeping_set", "__dict__")
+
     def __init__(self, wrapped_class, stub, is_new=False):
-        super(ORMWrapper, self).__setattr__("_wrapped_class", wrapped_class)
-        super(ORMWrapper, self).__setattr__("stub", stub)
-        super(ORMWrapper, self).__setattr__("cache", {})
-        super(ORMWrapper, self).__setattr__("reverse_cache", {})
-        super(ORMWrapper, self).__setattr__("poisoned", {})
-        super(ORMWrapper, self).__setattr__("is_new", is_new)
-        fkmap=self.gen_fkmap()
-        super(ORMWrapper, self).__setattr__("_fkmap", fkmap)
-        reverse_fkmap=self.gen_reverse_fkmap()
-        super(ORMWrapper, self).__setattr__("_reverse_fkmap", reverse_fkmap)
+        object.__setattr__(self, "_wrapped_class", wrapped_class)
+        object.__setattr__(self, "stub", stub)
+        object.__setattr__(self, "cache", {})
+        object.__setattr__(self, "reverse_cache", {})
+        object.__setattr__(self, "poisoned", {})
+        object.__setattr__(self, "is_new", is_new)
+        object.__setattr__(self, "_siblings", None)
+        # bookkeeping fields assigned since the object was fetched or saved
+        object.__setattr__(self, "_bookkeeping_set", None)
+        (fkmap, reverse_fkmap) = stub.get_fk_maps(self)
+        object.__setattr__(self, "_fkmap", fkmap)
+        object.__setattr__(self, "_reverse_fkmap", reverse_fkmap)
 
     def create_attr(self, name, value=None):
         """ setattr(self, ...) will fail for attributes that don't exist in the
@@ -100,8 +231,11 @@ class ORMWrapper(object):
             return None
 
         if fk_kind=="fk":
-            id=self.stub.make_ID(id=fk_id)
-            dest_model = self.stub.invoke("Get%s" % fk_entry["modelName"], id)
+            dest_model = None
+            if self._siblings:
+                dest_model = self.fk_prefetch(name, fk_entry)
+            if dest_model is None:
+                dest_model = self.stub.get_object(fk_entry["modelName"], fk_id)
 
         elif fk_kind=="generic_fk":
             dest_model = self.stub.genericForeignKeyResolve(getattr(self, fk_entry["ct_fieldName"]), fk_id)._wrapped_class
@@ -113,6 +247,29 @@ class ORMWrapper(object):
 
         return make_ORMWrapper(dest_model, self.stub)
 
+    def set_siblings(self, siblings):
+        """ Record the list of objects this object was loaded with, so that
+            resolving a foreign key of one of them resolves it for all.
+        """
+        super(ORMWrapper, self).__setattr__("_siblings", siblings)
+
+    def fk_prefetch(self, name, fk_entry):
+        """ Resolve foreign key name for this object and its siblings with a
+            single BulkGet, filling in their caches. Returns the model for
+            this object, or None if it was not retrieved.
+        """
+        src_fieldName = fk_entry["src_fieldName"]
+        pending = [x for x in self._siblings if (name not in x.cache) and (name not in x.poisoned) and getattr(x, src_fieldName)]
+        ids = list(set([getattr(x, src_fieldName) for x in pending]))
+
+        models = dict([(m.id, m) for m in self.stub.bulk_get(fk_entry["modelName"], ids)])
+        for x in pending:
+            model = models.get(getattr(x, src_fieldName))
+            if model is not None:
+                x.cache[name] = model
+
+        return models.get(getattr(self, src_fieldName))
+
     def reverse_fk_resolve(self, name):
         if name not in self.reverse_cache:
             fk_entry = self._reverse_fkmap[name]
@@ -150,24 +307,28 @@ class ORMWrapper(object):
         if (name == "pk"):
             name = "id"
 
-        if name in self.poisoned.keys():
+        if name in self.poisoned:
             # see explanation in fk_set()
             raise Exception("foreign key was poisoned")
 
-        if name in self._fkmap.keys():
+        if name in self._fkmap:
             return self.fk_resolve(name)
 
-        if name in self._reverse_fkmap.keys():
+        if name in self._reverse_fkmap:
             return self.reverse_fk_resolve(name)
 
         return getattr(self._wrapped_class, name, *args, **kwargs)
 
     def __setattr__(self, name, value):
-        if name in self._fkmap.keys():
+        if name in self._fkmap:
             self.fk_set(name, value)
-        elif name in self.__dict__:
+        elif (name in WRAPPER_SLOTS) or (name in self.__dict__):
             super(ORMWrapper,self).__setattr__(name, value)
         else:
+            if name in BOOKKEEPING_FIELDS:
+                if self._bookkeeping_set is None:
+                    object.__setattr__(self, "_bookkeeping_set", set())
+                self._bookkeeping_set.add(name)
             setattr(self._wrapped_class, name, value)
 
     def __repr__(self):
@@ -208,6 +369,7 @@ class ORMWrapper(object):
             self.poisoned.clear()
 
     def save(self, update_fields=None):
+        self.stub.forget_object(self._wrapped_class)
         if self.is_new:
            new_class = self.stub.invoke("Create%s" % self._wrapped_class.__class__.__name__, self._wrapped_class)
            self._wrapped_class = new_class
@@ -216,9 +378,21 @@ class ORMWrapper(object):
            metadata = []
            if update_fields:
                metadata.append( ("update_fields", ",".join(update_fields)) )
+           elif self.get_preserve_fields():
+               metadata.append( ("preserve_fields", ",".join(self.get_preserve_fields())) )
            self.stub.invoke("Update%s" % self._wrapped_class.__class__.__name__, self._wrapped_class, metadata=metadata)
+        object.__setattr__(self, "_bookkeeping_set", None)
+
+    def get_preserve_fields(self):
+        """ The bookkeeping fields that a full save must not overwrite.
+            The synchronizer writes these through UpdateBookkeeping, often
+            without publishing a change event, so unless the caller assigned
+            them our copy may be stale.
+        """
+        return [x for x in BOOKKEEPING_FIELDS if (not self._bookkeeping_set) or (x not in self._bookkeeping_set)]
 
     def delete(self):
+        self.stub.forget_object(self._wrapped_class)
         id = self.stub.make_ID(id=self._wrapped_class.id)
         self.stub.invoke("Delete%s" % self._wrapped_class.__class__.__name__, id)
 
@@ -242,6 +416,8 @@ class ORMWrapper(object):
 #    def self_content_type_id(self):
 #        return getattr(self.stub, self._wrapped_class.__class__.__name__).content_type_id
 
+WRAPPER_SLOTS = frozenset(ORMWrapper.__slots__)
+
 class ORMQuerySet(list):
     """ Makes lists look like django querysets """
     def first(self):
@@ -253,6 +429,77 @@ class ORMQuerySet(list):
     def exists(self):
         return len(self)>0
 
+class ORMLazyQuerySet(ORMQuerySet):
+    """ A queryset that is filled in from a generator as it is used.
+        Iterating it fetches results only as far as the caller reads, and
+        so do first() and exists(). Any other list operation fetches them
+        all first. iterator() reads the results without keeping them.
+    """
+
+    def __init__(self, generator):
+        super(ORMLazyQuerySet, self).__init__()
+        self._generator = generator
+
+    def _fetch_one(self):
+        if self._generator is None:
+            return False
+        try:
+            list.append(self, next(self._generator))
+            return True
+        except StopIteration:
+            self._generator = None
+            return False
+
+    def _fetch_all(self):
+        while self._fetch_one():
+            pass
+
+    def __iter__(self):
+        i = 0
+        while (i < list.__len__(self)) or self._fetch_one():
+            yield list.__getitem__(self, i)
+            i = i + 1
+
+    def iterator(self):
+        if list.__len__(self):
+            self._fetch_all()
+            return list.__iter__(self)
+        generator = self._generator
+        self._generator = None
+        return generator or iter([])
+
+    def __nonzero__(self):
+        return self.exists()
+
+    def __radd__(self, other):
+        self._fetch_all()
+        return other + list(self)
+
+    def first(self):
+        for x in self:
+            return x
+        return None
+
+    def exists(self):
+        return self.first() is not None
+
+def fetch_all_first(method):
+    def wrapper(self, *args):
+        self._fetch_all()
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+# The list methods read the list's storage directly, so the results must all
+# be there before any of them runs.
+for name in ["__len__", "__getitem__", "__getslice__", "__contains__", "__reversed__", "__repr__",
+             "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+             "__add__", "__iadd__", "__mul__", "__rmul__", "__imul__",
+             "__setitem__", "__delitem__", "__setslice__", "__delslice__",
+             "append", "extend", "insert", "pop", "remove", "index", "count", "sort", "reverse"]:
+    setattr(ORMLazyQuerySet, name, fetch_all_first(getattr(list, name)))
+
 class ORMLocalObjectManager(object):
     """ Manages a local list of objects """
 
@@ -266,9 +513,7 @@ class ORMLocalObjectManager(object):
         if self._cache is not None:
             return self._cache
 
-        models = []
-        for id in self._idList:
-            models.append(self._stub.invoke("Get%s" % self._modelName, self._stub.make_ID(id=id)))
+        models = self._stub.bulk_get(self._modelName, self._idList)
 
         self._cache = models
 
@@ -276,7 +521,7 @@ class ORMLocalObjectManager(object):
 
     def all(self):
         models = self.resolve_queryset()
-        return [make_ORMWrapper(x,self._stub) for x in models]
+        return make_ORMWrapper_list(models, self._stub)
 
     def exists(self):
         return len(self._idList)>0
@@ -286,7 +531,7 @@ class ORMLocalObjectManager(object):
 
     def first(self):
         if self._idList:
-            model = make_ORMWrapper(self._stub.invoke("Get%s" % self._modelName, self._stub.make_ID(id=self._idList[0])), self._stub)
+            model = make_ORMWrapper(self._stub.get_object(self._modelName, self._idList[0]), self._stub)
             return model
         else:
             return None
@@ -300,6 +545,9 @@ class ORMObjectManager(object):
     SYNCHRONIZER_DIRTY_POLICIES = 4
     SYNCHRONIZER_DELETED_POLICIES = 5
 
+    # objects fetched per Stream call by all() and filter()
+    PAGE_SIZE = 500
+
     def __init__(self, stub, modelName, packageName):
         self._stub = stub
         self._modelName = modelName
@@ -309,21 +557,41 @@ class ORMObjectManager(object):
         return make_ORMWrapper(obj, self._stub)
 
     def wrap_list(self, obj):
-        result=[]
-        for item in obj.items:
-            result.append(make_ORMWrapper(item, self._stub))
-        return ORMQuerySet(result)
+        return ORMQuerySet(make_ORMWrapper_list(obj.items, self._stub))
+
+    def stream(self, q):
+        """ Yield the results of query q, PAGE_SIZE objects at a time, so that
+            neither the server nor the client builds the whole result set.
+            Objects within a page are siblings for foreign key prefetching.
+        """
+        q.limit = self.PAGE_SIZE
+        while True:
+            items = list(self._stub.invoke("Stream%s" % self._modelName, q))
+            for obj in make_ORMWrapper_list(items, self._stub):
+                yield obj
+            if len(items) < self.PAGE_SIZE:
+                return
+            q.after_id = items[-1].id
 
     def all(self):
+        if self._modelName in self._stub.stream_models:
+            q = self._stub.make_Query()
+            q.kind = q.DEFAULT
+            return ORMLazyQuerySet(self.stream(q))
         return self.wrap_list(self._stub.invoke("List%s" % self._modelName, self._stub.make_empty()))
 
     def first(self):
-        objs=self.wrap_list(self._stub.invoke("List%s" % self._modelName, self._stub.make_empty()))
-        if not objs:
-            return None
-        return objs[0]
-
-    def filter(self, **kwargs):
+        if self._modelName in self._stub.stream_models:
+            q = self._stub.make_Query()
+            q.kind = q.DEFAULT
+            q.limit = 1
+            items = list(self._stub.invoke("Stream%s" % self._modelName, q))
+            if not items:
+                return None
+            return self.wrap_single(items[0])
+        return self.all().first()
+
+    def make_filter_query(self, **kwargs):
         q = self._stub.make_Query()
         q.kind = q.DEFAULT
 
@@ -351,22 +619,64 @@ class ORMObjectManager(object):
             else:
                 el.sValue = val
 
+        return q
+
+    def filter(self, **kwargs):
+        q = self.make_filter_query(**kwargs)
+        if self._modelName in self._stub.stream_models:
+            return ORMLazyQuerySet(self.stream(q))
         return self.wrap_list(self._stub.invoke("Filter%s" % self._modelName, q))
 
-    def filter_special(self, kind):
+    def filter_special(self, kind, updated_since=None, ids=None):
         q = self._stub.make_Query()
         q.kind = kind
+        # incremental variant: only objects updated since updated_since, or
+        # with an id in ids, are considered
+        if updated_since is not None:
+            q.updated_since = updated_since
+            q.incremental = True
+        if ids:
+            q.ids.extend(ids)
         return self.wrap_list(self._stub.invoke("Filter%s" % self._modelName, q))
 
     def get(self, **kwargs):
         if kwargs.keys() == ["id"]:
             # the fast and easy case, look it up by id
-            return self.wrap_single(self._stub.invoke("Get%s" % self._modelName, self._stub.make_ID(id=kwargs["id"])))
+            return self.wrap_single(self._stub.get_object(self._modelName, kwargs["id"]))
         else:
             # the slightly more difficult case, filter and return the first item
             objs = self.filter(**kwargs)
             return objs[0]
 
+    def bulk_update(self, objs, fields=None):
+        """ Save several existing objects with one BulkUpdate call. If fields
+            is set, only those fields are updated.
+        """
+        if not objs:
+            return
+        if not fields:
+            # objects that assigned different bookkeeping fields can't share
+            # a preserve_fields list
+            groups = collections.OrderedDict()
+            for o in objs:
+                groups.setdefault(tuple(o.get_preserve_fields()), []).append(o)
+            if len(groups) > 1:
+                for group in groups.values():
+                    self.bulk_update(group)
+                return
+        items = self._stub.make_plural(self._modelName)
+        items.items.extend([o._wrapped_class for o in objs])
+        for o in objs:
+            self._stub.forget_object(o._wrapped_class)
+        metadata = []
+        if fields:
+            metadata.append( ("update_fields", ",".join(fields)) )
+        elif objs[0].get_preserve_fields():
+            metadata.append( ("preserve_fields", ",".join(objs[0].get_preserve_fields())) )
+        self._stub.invoke("BulkUpdate%s" % self._modelName, items, metadata=metadata)
+        for o in objs:
+            object.__setattr__(o, "_bookkeeping_set", None)
+
     def new(self, **kwargs):
         cls = self._stub.all_grpc_classes[self._modelName]
         o = make_ORMWrapper(cls(), self._stub, is_new=True)
@@ -392,15 +702,20 @@ class ORMModelClass(object):
         return self.objects.new(*args, **kwargs)
 
 class ORMStub(object):
-    def __init__(self, stub, package_name, invoker=None, caller_kind="grpcapi", sym_db = None, empty = None, enable_backoff=True):
+    def __init__(self, stub, package_name, invoker=None, caller_kind="grpcapi", sym_db = None, empty = None, enable_backoff=True, schema=None):
         self.grpc_stub = stub
         self.all_model_names = []
         self.all_grpc_classes = {}
+        self.bulk_get_models = set()
+        self.stream_models = set()
+        self.plural_classes = {}
         self.content_type_map = {}
         self.reverse_content_type_map = {}
         self.invoker = invoker
         self.caller_kind = caller_kind
         self.enable_backoff = enable_backoff
+        self.cache = None
+        self.fk_maps = {}
 
         if not sym_db:
             from google.protobuf import symbol_database as _symbol_database
@@ -413,22 +728,60 @@ class ORMStub(object):
             empty = Empty
         self._empty = empty
 
+        # schema may be the result of an earlier get_schema() for the same
+        # protos, which saves scanning the stub and descriptors again
+        if schema is None:
+            schema = self.scan_stub(stub, package_name)
+        self.load_schema(schema, package_name)
+
+    def scan_stub(self, stub, package_name):
+        """ Work out the models and what calls they support from the stub
+            and the protobuf descriptors.
+        """
+        schema = {"model_names": [], "bulk_get_models": [], "stream_models": [], "content_types": {}}
+
         for name in dir(stub):
+           if name.startswith("BulkGet"):
+               # servers that predate BulkGet won't have these
+               schema["bulk_get_models"].append(name[7:])
+
+           if name.startswith("Stream"):
+               schema["stream_models"].append(name[6:])
+
            if name.startswith("Get"):
                model_name = name[3:]
-               setattr(self,model_name, ORMModelClass(self, model_name, package_name))
-
-               self.all_model_names.append(model_name)
+               schema["model_names"].append(model_name)
 
                grpc_class = self._sym_db._classes["%s.%s" % (package_name, model_name)]
-               self.all_grpc_classes[model_name] = grpc_class
-
                ct = grpc_class.DESCRIPTOR.GetOptions().Extensions._FindExtensionByName("xos.contentTypeId")
                if ct:
                    ct = grpc_class.DESCRIPTOR.GetOptions().Extensions[ct]
                    if ct:
-                       self.content_type_map[ct] = model_name
-                       self.reverse_content_type_map[model_name] = ct
+                       schema["content_types"][model_name] = ct
+
+        return schema
+
+    def load_schema(self, schema, package_name):
+        self.bulk_get_models.update(schema["bulk_get_models"])
+        self.stream_models.update(schema["stream_models"])
+
+        for model_name in schema["model_names"]:
+            setattr(self,model_name, ORMModelClass(self, model_name, package_name))
+            self.all_model_names.append(model_name)
+            self.all_grpc_classes[model_name] = self._sym_db._classes["%s.%s" % (package_name, model_name)]
+
+        for (model_name, ct) in schema["content_types"].items():
+            self.content_type_map[ct] = model_name
+            self.reverse_content_type_map[model_name] = ct
+
+    def get_schema(self):
+        """ Return what scan_stub() found, in a form that can be saved as
+            JSON and passed back to the constructor.
+        """
+        return {"model_names": list(self.all_model_names),
+                "bulk_get_models": sorted(self.bulk_get_models),
+                "stream_models": sorted(self.stream_models),
+                "content_types": dict(self.reverse_content_type_map)}
 
     def genericForeignKeyResolve(self, content_type_id, id):
         model_name = self.content_type_map[content_type_id]
@@ -477,15 +830,112 @@ class ORMStub(object):
             return method(request, metadata=metadata)
 
 
+    def get_fk_maps(self, wrapper):
+        """ Return the (fkmap, reverse_fkmap) of wrapper. They only depend
+            on the wrapper and protobuf classes, so are built once per pair
+            and shared by all wrappers.
+        """
+        key = (wrapper.__class__, wrapper._wrapped_class.__class__)
+        maps = self.fk_maps.get(key)
+        if maps is None:
+            maps = (wrapper.gen_fkmap(), wrapper.gen_reverse_fkmap())
+            self.fk_maps[key] = maps
+        return maps
+
+    def set_cache(self, cache):
+        """ Share an ORMCache between all the wrappers of this stub. Pass
+            None to go to the server for every fetch.
+        """
+        self.cache = cache
+
+    def get_object(self, model_name, id):
+        """ Retrieve one object by id, from the cache if possible """
+        if self.cache:
+            obj = self.cache.get(model_name, id)
+            if obj is not None:
+                return obj
+
+        obj = self.invoke("Get%s" % model_name, self.make_ID(id=id))
+        if self.cache:
+            self.cache.put(model_name, obj)
+        return obj
+
+    def forget_object(self, obj):
+        """ Drop obj from the cache, because we are about to change it. It
+            may be cached under any of its classes.
+        """
+        if self.cache and obj.id:
+            names = [obj.__class__.__name__]
+            class_names = getattr(obj, "class_names", None)
+            if class_names:
+                names = names + class_names.split(",")
+            self.cache.invalidate(names, obj.id)
+
+    def bulk_get(self, model_name, ids):
+        """ Retrieve the objects with the given ids, in order, using a single
+            BulkGet if the server supports it. Objects that are in the cache
+            are not fetched again.
+        """
+        if not ids:
+            return []
+
+        cached = {}
+        if self.cache:
+            for id in ids:
+                obj = self.cache.get(model_name, id)
+                if obj is not None:
+                    cached[id] = obj
+        missing = [id for id in ids if id not in cached]
+
+        if not missing:
+            fetched = []
+        elif model_name not in self.bulk_get_models:
+            fetched = [self.invoke("Get%s" % model_name, self.make_ID(id=id)) for id in missing]
+        else:
+            fetched = list(self.invoke("BulkGet%s" % model_name, self.make_IDList(missing)).items)
+
+        if self.cache:
+            for obj in fetched:
+                self.cache.put(model_name, obj)
+
+        if not cached:
+            return fetched
+
+        for obj in fetched:
+            if obj is not None:
+                cached[obj.id] = obj
+        return [cached[id] for id in ids if id in cached]
+
     def make_ID(self, id):
         return self._sym_db._classes["xos.ID"](id=id)
 
+    def make_IDList(self, ids):
+        return self._sym_db._classes["xos.IDList"](ids=ids)
+
+    def make_plural(self, model_name):
+        """ Return a new instance of the list message for model_name, the
+            one with a single "items" field of type model_name.
+        """
+        if model_name not in self.plural_classes:
+            for (full_name, cls) in self._sym_db._classes.items():
+                if not full_name.startswith("xos."):
+                    continue
+                fields = getattr(getattr(cls, "DESCRIPTOR", None), "fields", [])
+                if (len(fields) == 1) and (fields[0].name == "items") and fields[0].message_type and \
+                        (fields[0].message_type.name == model_name):
+                    self.plural_classes[model_name] = cls
+                    break
+        return self.plural_classes[model_name]()
+
     def make_empty(self):
         return self._empty()
 
     def make_Query(self):
         return self._sym_db._classes["xos.Query"]()
 
+    def make_BookkeepingUpdates(self):
+        return self._sym_db._classes["xos.BookkeepingUpdates"]()
+
     def listObjects(self):
         return self.all_model_names
 
@@ -502,6 +952,16 @@ def make_ORMWrapper(wrapped_class, *args, **kwargs):
 
     return cls(wrapped_class, *args, **kwargs)
 
+def make_ORMWrapper_list(wrapped_classes, stub):
+    """ Wrap a list of objects, linking them as siblings so that foreign
+        keys are resolved for the whole list at once.
+    """
+    result = [make_ORMWrapper(x, stub) for x in wrapped_classes]
+    if len(result) > 1:
+        for x in result:
+            x.set_siblings(result)
+    return result
+
 import convenience.addresspool
 import convenience.privilege
 import convenience.instance
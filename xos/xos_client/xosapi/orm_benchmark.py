@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+""" orm_benchmark.py
+
+    Time wrapping a large List result in ORMWrappers and reading a field
+    of each, with foreign key maps built once per class (the current
+    behavior) against building them for every wrapper (the old behavior).
+
+    Uses the fake stub, so only the client-side cost is measured.
+
+    Usage:
+        python orm_benchmark.py [-n 10000] [-r 5]
+"""
+
+import argparse
+import sys
+import time
+
+sys.path.append("..")
+
+import xosapi.orm
+from fake_stub import FakeStub, FakeSymDb, FakeObj, Slice
+
+class UncachedORMStub(xosapi.orm.ORMStub):
+    """ Builds the foreign key maps for every wrapper """
+    def get_fk_maps(self, wrapper):
+        return (wrapper.gen_fkmap(), wrapper.gen_reverse_fkmap())
+
+def time_wrap(orm, items, repeat):
+    best = None
+    for i in range(repeat):
+        tStart = time.time()
+        for obj in xosapi.orm.make_ORMWrapper_list(items, orm):
+            obj.name
+        elapsed = time.time() - tStart
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", type=int, default=10000, help="objects in the list")
+    parser.add_argument("-r", dest="repeat", type=int, default=5, help="runs, the best is reported")
+    args = parser.parse_args()
+
+    items = [Slice(id=i + 1, name="slice_%d" % i, site_id=1) for i in range(args.count)]
+
+    results = []
+    for (label, cls) in (("per-wrapper fk maps", UncachedORMStub), ("shared fk maps", xosapi.orm.ORMStub)):
+        orm = cls(stub=FakeStub(), package_name="xos", sym_db=FakeSymDb(), empty=FakeObj, enable_backoff=False)
+        results.append((label, time_wrap(orm, items, args.repeat)))
+
+    print "objects wrapped:        %d" % args.count
+    for (label, elapsed) in results:
+        print "%-22s  %.3f s (%.1f us/object)" % (label + ":", elapsed, elapsed * 1e6 / args.count)
+    print "speedup:                %.1fx" % (results[0][1] / results[1][1])
+
+if __name__ == "__main__":
+    main()
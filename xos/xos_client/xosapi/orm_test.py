@@ -1,4 +1,5 @@
 import exceptions
+import json
 import shutil
 import sys
 import unittest
@@ -94,8 +95,13 @@ class TestORM(unittest.TestCase):
         orm = self.make_coreapi()
         site = orm.Site(name="mysite")
         site.save()
+        if USE_FAKE_STUB:
+            orm.grpc_stub.stream_limits = []
         site = orm.Site.objects.first()
         self.assertNotEqual(site, None)
+        if USE_FAKE_STUB:
+            # a single object was requested
+            self.assertEqual(orm.grpc_stub.stream_limits, [1])
 
     def test_content_type_map(self):
         orm = self.make_coreapi()
@@ -189,11 +195,304 @@ class TestORM(unittest.TestCase):
         self.assertNotEqual(tag.content_object, None)
         self.assertEqual(tag.content_object.id, site.id)
 
+    def test_reverse_foreign_key_bulk_get(self):
+        orm = self.make_coreapi()
+        site = orm.Site(name="mysite")
+        site.save()
+        slices = [orm.Slice(name="mysite_%d" % i, site_id = site.id) for i in range(3)]
+        for slice in slices:
+            slice.save()
+        site.slice_ids = [x.id for x in slices]
+        if USE_FAKE_STUB:
+            orm.grpc_stub.calls = []
+        got_slices = site.slice.all()
+        self.assertEqual([x.id for x in got_slices], [x.id for x in slices])
+        if USE_FAKE_STUB:
+            self.assertEqual(orm.grpc_stub.calls, ["BulkGetSlice"])
+
+    def test_foreign_key_prefetch(self):
+        orm = self.make_coreapi()
+        sites = [orm.Site(name="mysite_%d" % i) for i in range(2)]
+        for site in sites:
+            site.save()
+        for i in range(4):
+            orm.Slice(name="myslice_%d" % i, site_id = sites[i % 2].id).save()
+        slices = list(orm.Slice.objects.all())
+        if USE_FAKE_STUB:
+            orm.grpc_stub.calls = []
+        for slice in slices:
+            self.assertEqual(slice.site.id, slice.site_id)
+        if USE_FAKE_STUB:
+            self.assertEqual(orm.grpc_stub.calls, ["BulkGetSite"])
+
+    def test_bulk_update(self):
+        orm = self.make_coreapi()
+        sites = [orm.Site(name="mysite_%d" % i) for i in range(2)]
+        for site in sites:
+            site.save()
+        for site in sites:
+            site.name = site.name + "_renamed"
+        orm.Site.objects.bulk_update(sites, fields=["name"])
+        for site in sites:
+            self.assertEqual(orm.Site.objects.get(id = site.id).name, site.name)
+
+    def test_schema(self):
+        orm = self.make_coreapi()
+        schema = json.loads(json.dumps(orm.get_schema()))
+        orm2 = xosapi.orm.ORMStub(stub=orm.grpc_stub, package_name = "xos", sym_db = orm._sym_db, empty = orm._empty, enable_backoff = False, schema = schema)
+        self.assertEqual(orm2.all_model_names, orm.all_model_names)
+        self.assertEqual(orm2.bulk_get_models, orm.bulk_get_models)
+        self.assertEqual(orm2.stream_models, orm.stream_models)
+        self.assertEqual(orm2.content_type_map, orm.content_type_map)
+        self.assertEqual(orm2.Slice.content_type_id, orm.Slice.content_type_id)
+
+    def test_fkmap_shared(self):
+        orm = self.make_coreapi()
+        s1 = orm.Slice(name="foo")
+        s2 = orm.Slice(name="bar")
+        self.assertTrue(s1._fkmap is s2._fkmap)
+        self.assertTrue(s1._reverse_fkmap is s2._reverse_fkmap)
+        self.assertTrue("site" in s1._fkmap)
+
+    def test_create_attr(self):
+        orm = self.make_coreapi()
+        s = orm.Slice(name="foo")
+        s.create_attr("extra", 1)
+        s.extra = 2
+        self.assertEqual(s.extra, 2)
+        self.assertEqual(s.name, "foo")
+
+    def test_objects_all_paged(self):
+        orm = self.make_coreapi()
+        orig_len_sites = len(orm.Site.objects.all())
+        for i in range(5):
+            orm.Site(name="mysite_%d" % i).save()
+        page_size = xosapi.orm.ORMObjectManager.PAGE_SIZE
+        try:
+            xosapi.orm.ORMObjectManager.PAGE_SIZE = 2
+            if USE_FAKE_STUB:
+                orm.grpc_stub.calls = []
+            sites = orm.Site.objects.all()
+            self.assertTrue(sites.first() is not None)
+            if USE_FAKE_STUB:
+                # only the first page was fetched
+                self.assertEqual(orm.grpc_stub.calls, ["StreamSite"])
+            ids = [x.id for x in sites]
+            self.assertEqual(len(ids), orig_len_sites + 5)
+            self.assertEqual(ids, sorted(ids))
+            self.assertEqual(len(set(ids)), len(ids))
+        finally:
+            xosapi.orm.ORMObjectManager.PAGE_SIZE = page_size
+
+if USE_FAKE_STUB:
+    class TestORMWithoutBulk(unittest.TestCase):
+        def test_reverse_foreign_key_fallback(self):
+            stub = FakeStub(bulk=False)
+            orm = xosapi.orm.ORMStub(stub=stub, package_name = "xos", sym_db = FakeSymDb(), empty = FakeObj, enable_backoff = False)
+            site = orm.Site(name="mysite")
+            site.save()
+            slices = [orm.Slice(name="mysite_%d" % i, site_id = site.id) for i in range(2)]
+            for slice in slices:
+                slice.save()
+            site.slice_ids = [x.id for x in slices]
+            stub.calls = []
+            self.assertEqual([x.id for x in site.slice.all()], [x.id for x in slices])
+            self.assertEqual(stub.calls, ["GetSlice", "GetSlice"])
+
+        def test_objects_all_without_stream(self):
+            stub = FakeStub(stream=False)
+            orm = xosapi.orm.ORMStub(stub=stub, package_name = "xos", sym_db = FakeSymDb(), empty = FakeObj, enable_backoff = False)
+            orm.Site(name="mysite").save()
+            self.assertEqual(len(orm.Site.objects.all()), 1)
+            self.assertEqual(orm.Site.objects.first().name, "mysite")
+
+        def test_objects_all_is_a_list(self):
+            stub = FakeStub()
+            orm = xosapi.orm.ORMStub(stub=stub, package_name = "xos", sym_db = FakeSymDb(), empty = FakeObj, enable_backoff = False)
+            for i in range(3):
+                orm.Site(name="mysite_%d" % i).save()
+
+            sites = orm.Site.objects.all()
+            self.assertTrue(isinstance(sites, list))
+            self.assertEqual(sites.first().name, "mysite_0")
+            self.assertEqual([x.name for x in [] + sites], ["mysite_0", "mysite_1", "mysite_2"])
+            self.assertEqual([x.name for x in sites[1:]], ["mysite_1", "mysite_2"])
+
+            sites = orm.Site.objects.all()
+            self.assertEqual(sites.count(sites[0]), 1)
+            sites.append(None)
+            self.assertEqual(len(sites), 4)
+
+    class TestAsyncORM(unittest.TestCase):
+        def setUp(self):
+            self.stub = FakeStub()
+            self.orm = xosapi.orm.ORMStub(stub=self.stub, package_name = "xos", sym_db = FakeSymDb(), empty = FakeObj, enable_backoff = False)
+            self.aorm = xosapi.async_orm.AsyncORMStub(self.orm)
+            self.sites = [self.orm.Site(name="mysite_%d" % i) for i in range(4)]
+            for site in self.sites:
+                site.save()
+            self.stub.calls = []
+            self.stub.latency = 0.01
+
+        def test_get_concurrent(self):
+            futures = [self.aorm.Site.objects.get(id=x.id) for x in self.sites]
+            self.assertEqual([x.name for x in xosapi.async_orm.gather(futures)], [x.name for x in self.sites])
+
+        def test_filter(self):
+            sites = self.aorm.Site.objects.filter(name="mysite_2").result()
+            self.assertEqual([x.id for x in sites], [self.sites[2].id])
+            self.assertEqual(self.aorm.Site.objects.get(name="mysite_1").result().id, self.sites[1].id)
+
+        def test_all(self):
+            self.assertEqual(len(self.aorm.Site.objects.all().result()), 4)
+
+        def test_bulk_get(self):
+            ids = [x.id for x in self.sites]
+            self.assertEqual([x.id for x in self.aorm.Site.objects.bulk_get(ids).result()], ids)
+
+        def test_fk_resolve(self):
+            self.stub.latency = 0
+            slice = self.orm.Slice(name="myslice", site_id = self.sites[0].id)
+            slice.save()
+            self.stub.calls = []
+            self.assertEqual(self.aorm.fk_resolve(slice, "site").result().name, "mysite_0")
+            # resolved once, then kept in the wrapper
+            self.assertEqual(slice.site.name, "mysite_0")
+            self.assertEqual(self.aorm.fk_resolve(slice, "site").result().name, "mysite_0")
+            self.assertEqual(self.stub.calls, ["GetSite"])
+
+        def test_cache(self):
+            self.orm.set_cache(xosapi.orm.ORMCache())
+            self.aorm.Site.objects.get(id=self.sites[0].id).result()
+            self.assertEqual(self.aorm.Site.objects.get(id=self.sites[0].id).result().name, "mysite_0")
+            self.assertEqual(self.stub.calls, ["GetSite"])
+
+        def test_max_in_flight(self):
+            aorm = xosapi.async_orm.AsyncORMStub(self.orm, max_in_flight=2)
+            futures = [aorm.Site.objects.get(id=x.id) for x in self.sites]
+            self.assertEqual([x.id for x in xosapi.async_orm.gather(futures)], [x.id for x in self.sites])
+
+    class TestORMCache(unittest.TestCase):
+        def setUp(self):
+            self.stub = FakeStub()
+            self.orm = xosapi.orm.ORMStub(stub=self.stub, package_name = "xos", sym_db = FakeSymDb(), empty = FakeObj, enable_backoff = False)
+            self.cache = xosapi.orm.ORMCache(size=10, ttl=60)
+            self.orm.set_cache(self.cache)
+            self.site = self.orm.Site(name="mysite")
+            self.site.save()
+            self.stub.calls = []
+
+        def test_get(self):
+            site = self.orm.Site.objects.get(id=self.site.id)
+            # changes that are not saved don't leak into the cache
+            site.name = "changed"
+            self.assertEqual(self.orm.Site.objects.get(id=self.site.id).name, "mysite")
+            self.assertEqual(self.stub.calls, ["GetSite"])
+
+        def test_foreign_key_shared(self):
+            slices = [self.orm.Slice(name="myslice_%d" % i, site_id = self.site.id) for i in range(2)]
+            for slice in slices:
+                slice.save()
+            for slice in slices:
+                self.assertEqual(self.orm.Slice.objects.get(id=slice.id).site.name, "mysite")
+            self.assertEqual(self.stub.calls.count("GetSite"), 1)
+
+        def test_bulk_get_partial(self):
+            other = self.orm.Site(name="othersite")
+            other.save()
+            self.orm.Site.objects.get(id=self.site.id)
+            self.stub.calls = []
+            sites = self.orm.bulk_get("Site", [other.id, self.site.id])
+            self.assertEqual([x.name for x in sites], ["othersite", "mysite"])
+            self.assertEqual(self.stub.calls, ["BulkGetSite"])
+            self.assertEqual(self.cache.get_stats()["entries"], 2)
+
+        def test_change_event(self):
+            self.orm.Site.objects.get(id=self.site.id)
+            event = json.dumps({"pk": self.site.id, "changed_fields": ["name"],
+                                "object": {"class_names": "Site,XOSBase"}})
+            self.cache.handle_change_event("Site", event)
+            self.orm.Site.objects.get(id=self.site.id)
+            self.assertEqual(self.stub.calls, ["GetSite", "GetSite"])
+
+        def test_save_invalidates(self):
+            site = self.orm.Site.objects.get(id=self.site.id)
+            site.name = "renamed"
+            site.save()
+            self.assertEqual(self.orm.Site.objects.get(id=self.site.id).name, "renamed")
+            self.assertEqual(self.stub.calls, ["GetSite", "GetSite"])
+
+        def test_save_invalidates_base_classes(self):
+            site = self.orm.Site.objects.get(id=self.site.id)
+            site._wrapped_class.class_names = "Site,XOSBase"
+            self.cache.put("XOSBase", site._wrapped_class)
+            site.name = "renamed"
+            site.save()
+            self.assertEqual(self.cache.get("XOSBase", self.site.id), None)
+
+        def test_save_preserves_bookkeeping(self):
+            self.orm.Site.objects.get(id=self.site.id)
+
+            # the synchronizer writes policed without a change event, so
+            # the cached copy keeps the old value
+            key = "Site:%d" % self.site.id
+            stored = Site()
+            stored.CopyFrom(self.stub.objs[key])
+            stored.policed = 5
+            self.stub.objs[key] = stored
+
+            site = self.orm.Site.objects.get(id=self.site.id)
+            self.assertEqual(site.policed, None)
+            site.name = "renamed"
+            site.backend_status = "ok"
+            site.save()
+
+            self.assertEqual(self.stub.objs[key].name, "renamed")
+            self.assertEqual(self.stub.objs[key].policed, 5)
+            # bookkeeping fields the caller assigned are written
+            self.assertEqual(self.stub.objs[key].backend_status, "ok")
+
+        def test_bulk_update_preserves_bookkeeping(self):
+            other = self.orm.Site(name="othersite")
+            other.save()
+            sites = [self.orm.Site.objects.get(id=x.id) for x in [self.site, other]]
+            for (key, x) in self.stub.objs.items():
+                stored = Site()
+                stored.CopyFrom(x)
+                stored.policed = 5
+                self.stub.objs[key] = stored
+            sites[0].name = "renamed"
+            sites[1].policed = 7
+            self.stub.calls = []
+            self.orm.Site.objects.bulk_update(sites)
+
+            # one call per distinct set of assigned bookkeeping fields
+            self.assertEqual(self.stub.calls, ["BulkUpdateSite", "BulkUpdateSite"])
+            self.assertEqual(self.stub.objs["Site:%d" % self.site.id].name, "renamed")
+            self.assertEqual(self.stub.objs["Site:%d" % self.site.id].policed, 5)
+            self.assertEqual(self.stub.objs["Site:%d" % other.id].policed, 7)
+
+        def test_ttl(self):
+            self.cache.ttl = 0
+            self.orm.Site.objects.get(id=self.site.id)
+            self.orm.Site.objects.get(id=self.site.id)
+            self.assertEqual(self.stub.calls, ["GetSite", "GetSite"])
+
+        def test_size(self):
+            self.cache.size = 1
+            other = self.orm.Site(name="othersite")
+            other.save()
+            self.orm.Site.objects.get(id=self.site.id)
+            self.orm.Site.objects.get(id=other.id)
+            self.orm.Site.objects.get(id=self.site.id)
+            self.assertEqual(self.stub.calls, ["GetSite", "GetSite", "GetSite"])
+
 if USE_FAKE_STUB:
     sys.path.append("..")
 
     import xosapi.orm
-    from fake_stub import FakeStub, FakeSymDb, FakeObj
+    import xosapi.async_orm
+    from fake_stub import FakeStub, FakeSymDb, FakeObj, Site
 
     print "Using Fake Stub"
 
@@ -1,11 +1,15 @@
 import argparse
 import base64
 import functools
+import glob
 import grpc
+import hashlib
+import json
 import orm
 import os
 import pdb
 import sys
+import zlib
 from google.protobuf.empty_pb2 import Empty
 from grpc import metadata_call_credentials, ChannelCredentials, composite_channel_credentials, ssl_channel_credentials
 
@@ -15,12 +19,33 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 sys.path = [currentdir] + sys.path
 
 import chameleon.grpc_client.grpc_client as chameleon_client
+try:
+    from chameleon.protos.schema_pb2_grpc import SchemaServiceStub
+except ImportError:
+    from chameleon.protos.schema_pb2 import SchemaServiceStub
 
 from twisted.internet import reactor
 
 
 SERVER_CA="/usr/local/share/ca-certificates/local_certs.crt"
 
+# Metadata key used to tell the core which schema we have cached, and by the
+# core to tell us the hash of its schema. See SchemaService in the core.
+SCHEMA_HASH_KEY = "x-xos-schema-hash"
+
+def hash_schema(protos):
+    """ sha256 over the name, text and uncompressed descriptor of each proto
+        file, in name order. The core computes the same.
+    """
+    h = hashlib.sha256()
+    for proto in sorted(protos, key=lambda x: x.file_name):
+        for part in (proto.file_name, proto.proto, zlib.decompress(proto.descriptor)):
+            if isinstance(part, unicode):
+                part = part.encode("utf-8")
+            h.update("%d:" % len(part))
+            h.update(part)
+    return h.hexdigest()
+
 class UsernamePasswordCallCredentials(grpc.AuthMetadataPlugin):
   """Metadata wrapper for raw access token credentials."""
   def __init__(self, username, password):
@@ -42,12 +67,92 @@ class SessionIdCallCredentials(grpc.AuthMetadataPlugin):
 class XOSClient(chameleon_client.GrpcClient):
     # We layer our own reconnect_callback functionality so we can setup the
     # ORM before calling reconnect_callback.
+    #
+    # The compiled schema is kept in work_dir, together with the hash of the
+    # schema it was compiled from. When we (re)connect and the core's schema
+    # has the same hash, it is not downloaded or compiled again, modules
+    # already imported are not reloaded, and the ORM is set up from the
+    # model list saved last time.
+
+    # hash of the schema in work_dir, and of the modules we have imported
+    schema_hash = None
+    loaded_schema_hash = None
+    schema_unchanged = False
 
     def set_reconnect_callback(self, reconnect_callback):
         self.reconnect_callback2 = reconnect_callback
         return self
 
+    def read_cache_file(self, name):
+        try:
+            return open(os.path.join(self.work_dir, name)).read()
+        except IOError:
+            return None
+
+    def write_cache_file(self, name, data):
+        fn = os.path.join(self.work_dir, name)
+        open(fn + ".tmp", "w").write(data)
+        os.rename(fn + ".tmp", fn)
+
+    def save_schema(self, schemas):
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+        for pattern in ["schema.hash", "orm_schema.json", "*.proto", "*.desc", "*_pb2.py*", "*_pb2_grpc.py*"]:
+            for fn in glob.glob(os.path.join(self.work_dir, pattern)):
+                os.remove(fn)
+
+        for proto_file in schemas.protos:
+            with open(os.path.join(self.work_dir, proto_file.file_name), "w") as f:
+                f.write(proto_file.proto)
+            with open(os.path.join(self.work_dir, proto_file.file_name.replace(".proto", ".desc")), "wb") as f:
+                f.write(zlib.decompress(proto_file.descriptor))
+
+    def _retrieve_schema(self):
+        """ Download the schema into work_dir, unless the copy there is
+            current. Replaces Chameleon's version.
+        """
+        # schema.hash is written once the schema has been compiled
+        cached_hash = self.read_cache_file("schema.hash")
+        metadata = []
+        if cached_hash:
+            metadata.append( (SCHEMA_HASH_KEY, cached_hash) )
+
+        stub = SchemaServiceStub(self.channel)
+        (schemas, call) = stub.GetSchema.with_call(Empty(), metadata=metadata, timeout=120)
+        server_hash = dict(call.trailing_metadata()).get(SCHEMA_HASH_KEY)
+
+        if cached_hash and (server_hash == cached_hash) and (not schemas.protos):
+            self.schema_hash = cached_hash
+            self.schema_unchanged = True
+            return schemas.swagger_from
+
+        # cores that don't know about the hash always send the schema
+        self.schema_hash = hash_schema(schemas.protos)
+        self.schema_unchanged = (self.schema_hash == cached_hash)
+        if not self.schema_unchanged:
+            self.save_schema(schemas)
+
+        return schemas.swagger_from
+
+    def _compile_proto_files(self, swagger_from):
+        if self.schema_unchanged:
+            return
+        super(XOSClient, self)._compile_proto_files(swagger_from)
+        self.write_cache_file("schema.hash", self.schema_hash)
+
+    def load_orm_schema(self):
+        try:
+            saved = json.loads(self.read_cache_file("orm_schema.json") or "{}")
+        except ValueError:
+            return None
+        if saved.get("hash") != self.schema_hash:
+            return None
+        return saved["schema"]
+
     def reconnected(self):
+        # modules imported from an older schema must be reloaded
+        must_reload = (self.loaded_schema_hash != self.schema_hash)
+
         for api in ['modeldefs', 'utility', 'xos']:
             pb2_file_name = os.path.join(self.work_dir, api + "_pb2.py")
             pb2_grpc_file_name = os.path.join(self.work_dir, api + "_pb2_grpc.py")
@@ -56,10 +161,12 @@ class XOSClient(chameleon_client.GrpcClient):
                 orig_sys_path = sys.path
                 try:
                     sys.path.append(self.work_dir)
+                    imported = (api + "_pb2") in sys.modules
                     m_protos = __import__(api + "_pb2")
-                    reload(m_protos)
                     m_grpc = __import__(api + "_pb2_grpc")
-                    reload(m_grpc)
+                    if imported and must_reload:
+                        reload(m_protos)
+                        reload(m_grpc)
                 finally:
                     sys.path = orig_sys_path
 
@@ -70,8 +177,13 @@ class XOSClient(chameleon_client.GrpcClient):
             else:
                 print >> sys.stderr, "failed to locate api", api
 
+        self.loaded_schema_hash = self.schema_hash
+
         if hasattr(self, "xos"):
-            self.xos_orm = orm.ORMStub(self.xos, "xos")
+            schema = self.load_orm_schema()
+            self.xos_orm = orm.ORMStub(self.xos, "xos", schema=schema)
+            if (schema is None) and self.schema_hash:
+                self.write_cache_file("orm_schema.json", json.dumps({"hash": self.schema_hash, "schema": self.xos_orm.get_schema()}))
 
         if self.reconnect_callback2:
             self.reconnect_callback2()